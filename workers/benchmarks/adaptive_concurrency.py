@@ -0,0 +1,77 @@
+import argparse
+import asyncio
+import logging
+import statistics
+import sys
+import time
+
+import httpx
+
+import workers.pb.job_manager_pb2 as pb
+from workers.local.job_manager import LocalJobManager, serve, test_jobs
+from workers.local.vllm_server import MockVLLM, MockVLLMServer
+from workers.wrapper_classes.concurrency_controller import ConcurrencyController
+from workers.wrapper_classes.worker_wrapper import Worker, Metadata
+
+
+async def run_case(worker_count: int, adaptive: bool, args: argparse.Namespace) -> dict:
+    manager = LocalJobManager(test_jobs(args.jobs, args.paragraphs), health_timeout=60)
+    grpc_server, port = serve(manager)
+    mock = MockVLLM(capacity=args.capacity, latency=args.latency)
+    vllm_server = MockVLLMServer(mock).start()
+
+    client = httpx.AsyncClient(base_url=vllm_server.url, timeout=httpx.Timeout(300.0))
+
+    async def worker_func(ctx: dict, job_data: pb.GetJobResponse, metadata: Metadata, need_return: bool) -> None:
+        # one completion per paragraph, all at once like the handlers do
+        requests = [client.post("/v1/chat/completions", json={"model": "mock-model", "messages": [{"role": "user", "content": paragraph}]}) for paragraph in job_data.test_data.paragraphs]
+        await asyncio.gather(*requests)
+
+    controller = None
+    if adaptive:
+        controller = ConcurrencyController([f"{vllm_server.url}/metrics"], min_limit=1, max_limit=args.max_workers, interval=args.interval)
+
+    worker = Worker(f"127.0.0.1:{port}", retry_after=1)
+    waiting = []
+    start = time.perf_counter()
+    pool = asyncio.create_task(worker.run_pool(worker_func, worker_count, controller=controller))
+    while not manager.done.is_set() and not pool.done():
+        await asyncio.sleep(0.1)
+        waiting.append(mock.waiting)
+    elapsed = time.perf_counter() - start
+
+    pool.cancel()
+    await asyncio.gather(pool, return_exceptions=True)
+    await worker.close()
+    await client.aclose()
+    grpc_server.stop(grace=None)
+    vllm_server.shutdown()
+
+    return {
+        "mode": f"adaptive from {worker_count}" if adaptive else f"fixed {worker_count}",
+        "final workers": worker.active.limit,
+        "jobs/s": round(args.jobs / elapsed, 2),
+        "mean request latency (s)": round(mock.latency_sum / max(mock.request_count, 1), 2),
+        "mean vLLM waiting": round(statistics.fmean(waiting), 1),
+    }
+
+
+async def main(args: argparse.Namespace) -> None:
+    logging.basicConfig(format="[%(asctime)s] %(levelname)-8s %(message)s", level=logging.WARNING, datefmt="%Y-%m-%d %H:%M:%S", stream=sys.stdout)
+
+    print(f"jobs: {args.jobs} x {args.paragraphs} paragraphs, mock vLLM capacity: {args.capacity}, latency: {args.latency}s")
+    for worker_count in args.fixed:
+        print(await run_case(worker_count, False, args))
+    print(await run_case(args.fixed[0], True, args))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="fixed worker counts vs the adaptive controller against a mock vLLM server")
+    parser.add_argument("--jobs", type=int, default=60)
+    parser.add_argument("--paragraphs", type=int, default=8, help="LLM requests per job")
+    parser.add_argument("--capacity", type=int, default=32, help="requests the mock vLLM server runs at once")
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--fixed", type=int, nargs="+", default=[1, 16], help="fixed worker counts to compare, the first is also the adaptive starting point")
+    parser.add_argument("--max-workers", type=int, default=16)
+    parser.add_argument("--interval", type=float, default=0.5, help="controller interval in seconds")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,94 @@
+import argparse
+import asyncio
+import logging
+import statistics
+import sys
+import time
+
+import grpc
+
+import workers.pb.job_manager_pb2 as pb
+import workers.pb.job_manager_pb2_grpc as pb_grpc
+from workers.local.job_manager import LocalJobManager, serve, test_jobs
+from workers.wrapper_classes.worker_wrapper import Worker, Metadata
+
+
+class BlockingStub:
+    """Exposes the synchronous stub behind awaitables, reproducing the worker's old blocking rpc calls."""
+
+    def __init__(self, stub: pb_grpc.JobManagerStub) -> None:
+        self.stub = stub
+
+    def __getattr__(self, name: str):
+        method = getattr(self.stub, name)
+
+        async def call(request, **kwargs):
+            return method(request, **kwargs)
+
+        return call
+
+
+async def monitor_stalls(samples: list[float], interval: float) -> None:
+    # measure how late the event loop wakes up a task that only sleeps
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        samples.append(max(0.0, loop.time() - start - interval))
+
+
+async def run_case(blocking: bool, args: argparse.Namespace) -> dict:
+    manager = LocalJobManager(test_jobs(args.jobs), latency=args.latency)
+    server, port = serve(manager)
+
+    worker = Worker(f"127.0.0.1:{port}", retry_after=args.retry_after, job_delivery="poll")
+    if blocking:
+        channel = grpc.insecure_channel(f"127.0.0.1:{port}")
+        worker.stub = BlockingStub(pb_grpc.JobManagerStub(channel))
+
+    async def worker_func(ctx: dict, job_data: pb.GetJobResponse, metadata: Metadata, need_return: bool) -> None:
+        # stand-in for a job waiting on the LLM
+        await asyncio.sleep(args.job_time)
+
+    samples = []
+    monitor = asyncio.create_task(monitor_stalls(samples, args.interval))
+    start = time.perf_counter()
+    pool = asyncio.create_task(worker.run_pool(worker_func, args.worker_count))
+    while not manager.done.is_set() and not pool.done():
+        await asyncio.sleep(0.05)
+    elapsed = time.perf_counter() - start
+
+    for task in (pool, monitor):
+        task.cancel()
+    await asyncio.gather(pool, monitor, return_exceptions=True)
+    await worker.close()
+    server.stop(grace=None)
+
+    samples.sort()
+    return {
+        "mode": "blocking" if blocking else "aio",
+        "jobs/s": round(args.jobs / elapsed, 1),
+        "total stall (s)": round(sum(samples), 3),
+        "mean stall (ms)": round(statistics.fmean(samples) * 1000, 2),
+        "p99 stall (ms)": round(samples[int(len(samples) * 0.99) - 1] * 1000, 2),
+        "max stall (ms)": round(samples[-1] * 1000, 2),
+    }
+
+
+async def main(args: argparse.Namespace) -> None:
+    logging.basicConfig(format="[%(asctime)s] %(levelname)-8s %(message)s", level=logging.WARNING, datefmt="%Y-%m-%d %H:%M:%S", stream=sys.stdout)
+
+    print(f"worker count: {args.worker_count}, jobs: {args.jobs}, rpc latency: {args.latency}s, job time: {args.job_time}s")
+    for blocking in (True, False):
+        print(await run_case(blocking, args))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="event loop stall caused by job manager rpcs, synchronous stub vs grpc.aio")
+    parser.add_argument("--worker-count", type=int, default=16)
+    parser.add_argument("--jobs", type=int, default=400)
+    parser.add_argument("--latency", type=float, default=0.02, help="server side delay per rpc in seconds")
+    parser.add_argument("--job-time", type=float, default=0.1, help="simulated LLM time per job in seconds")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--interval", type=float, default=0.005, help="stall monitor sampling interval in seconds")
+    asyncio.run(main(parser.parse_args()))
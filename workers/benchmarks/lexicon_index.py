@@ -0,0 +1,81 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from workers.handlers.map_descriptions.lexicon_index import PROMPTS_DIR
+
+LITHS_CSV = os.path.join(PROMPTS_DIR, "liths.csv")
+LITH_ATTS_CSV = os.path.join(PROMPTS_DIR, "lith_atts.csv")
+
+
+def rss_kb() -> int:
+    with open("/proc/self/statm") as file:
+        return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+
+
+def measure(mode: str, index_path: str) -> dict:
+    # runs in a fresh interpreter so imports and allocations of the other mode do not count
+    before = rss_kb()
+    start = time.perf_counter()
+    if mode == "pandas":
+        # what map_worker.startup used to do
+        import pandas as pd
+
+        from workers.handlers.map_descriptions.lexicon import LexiconMatcher
+
+        liths = pd.read_csv(LITHS_CSV, header=None)
+        lith_atts = pd.read_csv(LITH_ATTS_CSV, header=None)
+        matchers = (LexiconMatcher(liths.iloc[:, 0]), LexiconMatcher(lith_atts.iloc[:, 0]))
+    else:
+        from workers.handlers.map_descriptions.lexicon_index import read_index
+
+        lexicon = read_index(index_path)
+    elapsed = time.perf_counter() - start
+    return {"mode": mode, "startup (ms)": round(elapsed * 1000, 1), "rss growth (MB)": round((rss_kb() - before) / 1024, 1), "pandas imported": "pandas" in sys.modules}
+
+
+def main(args: argparse.Namespace) -> None:
+    if args.measure:
+        print(json.dumps(measure(args.measure, args.index)))
+        return
+
+    from workers.handlers.map_descriptions.lexicon_index import LexiconSource, read_index
+
+    with tempfile.TemporaryDirectory() as directory:
+        index_path = os.path.join(directory, "lexicon.idx")
+        start = time.perf_counter()
+        built = LexiconSource(index_path, LITHS_CSV, LITH_ATTS_CSV).build()
+        print(f"compiled {len(built)} terms into {os.path.getsize(index_path) / 1024:.1f}KB in {(time.perf_counter() - start) * 1000:.1f}ms")
+
+        # the loaded index has to match exactly what the CSVs produce
+        loaded = read_index(index_path)
+        assert (loaded.liths, loaded.lith_atts, loaded.lith_att_types) == (built.liths, built.lith_atts, built.lith_att_types)
+        for built_matcher, loaded_matcher in ((built.lith_matcher, loaded.lith_matcher), (built.lith_att_matcher, loaded.lith_att_matcher)):
+            assert (built_matcher.goto, built_matcher.fail, built_matcher.outputs) == (loaded_matcher.goto, loaded_matcher.fail, loaded_matcher.outputs)
+        print("loaded index matches the CSVs")
+
+        for mode in ("pandas", "index"):
+            results = []
+            for _ in range(args.runs):
+                output = subprocess.run([sys.executable, "-m", "workers.benchmarks.lexicon_index", "--measure", mode, "--index", index_path], capture_output=True, text=True, check=True)
+                results.append(json.loads(output.stdout))
+            best = min(results, key=lambda result: result["startup (ms)"])
+            print(best)
+
+        # a hot swap is a load plus a reference assignment
+        start = time.perf_counter()
+        for _ in range(args.runs):
+            read_index(index_path)
+        print(f"hot swap load: {(time.perf_counter() - start) / args.runs * 1000:.1f}ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="startup time and memory of the compiled lexicon index against the pandas CSV path")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--measure", choices=["pandas", "index"], help=argparse.SUPPRESS)
+    parser.add_argument("--index", type=str, help=argparse.SUPPRESS)
+    main(parser.parse_args())
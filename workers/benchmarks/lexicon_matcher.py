@@ -0,0 +1,87 @@
+import argparse
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+import workers.prompts
+from workers.prompts.map_descrip_prompts import CONTEXT, sample_description
+from workers.handlers.map_descriptions.lexicon import LexiconMatcher, init_tag_process, tag_batch, tag_batch_in_process
+from workers.handlers.map_descriptions.map_worker import match_word
+
+PROMPTS_DIR = os.path.dirname(workers.prompts.__file__)
+SEPARATORS = [" ", " ", " ", ", ", ". ", "; ", "-", "/", " (", ") ", "\n", "_", ""]
+
+
+def generate_descriptions(terms: list[str], count: int, seed: int = 0) -> list[str]:
+    # random legend-like text made of lexicon terms, filler words and awkward separators
+    rng = random.Random(seed)
+    filler = ["rocks", "mostly", "of", "with", "minor", "beds", "unit", "interbedded", "and", "Age", "Miocene", "ÉTAGE", "x2"]
+    descriptions = []
+    for _ in range(count):
+        words = [rng.choice(terms) if rng.random() < 0.4 else rng.choice(filler) for _ in range(rng.randint(5, 80))]
+        words = [word.upper() if rng.random() < 0.05 else word.capitalize() if rng.random() < 0.1 else word for word in words]
+        descriptions.append("".join(word + rng.choice(SEPARATORS) for word in words))
+    return descriptions
+
+
+def main(args: argparse.Namespace) -> None:
+    liths = pd.read_csv(os.path.join(PROMPTS_DIR, "liths.csv"), header=None)
+    lith_atts = pd.read_csv(os.path.join(PROMPTS_DIR, "lith_atts.csv"), header=None)
+    terms = [*liths.iloc[:, 0], *lith_atts.iloc[:, 0]]
+    descriptions = [sample_description, *(example[0] for example in CONTEXT), *generate_descriptions(terms, args.descriptions)]
+
+    start = time.perf_counter()
+    matchers = (LexiconMatcher(liths.iloc[:, 0]), LexiconMatcher(lith_atts.iloc[:, 0]))
+    build_time = time.perf_counter() - start
+
+    # equivalence with match_word on every description
+    for description in descriptions:
+        for table, matcher in zip((liths, lith_atts), matchers):
+            expected = set(table.index[table.iloc[:, 0].apply(lambda x: match_word(x, description))])
+            assert matcher.match(description) == expected, f"mismatch on {description!r}: {matcher.match(description) ^ expected}"
+    print(f"matcher agrees with match_word on {len(descriptions)} descriptions")
+    single = [(sorted(matchers[0].match(description)), sorted(matchers[1].match(description))) for description in descriptions]
+    assert tag_batch(*matchers, descriptions) == single, "batch tagging differs from per description matching"
+    print("batch tagging agrees with per description matching")
+
+    start = time.perf_counter()
+    for description in descriptions:
+        for table in (liths, lith_atts):
+            table[table.iloc[:, 0].apply(lambda x: match_word(x, description))]
+    regex_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for description in descriptions:
+        for table, matcher in zip((liths, lith_atts), matchers):
+            table.iloc[sorted(matcher.match(description))]
+    matcher_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    tag_batch(*matchers, descriptions)
+    batch_time = time.perf_counter() - start
+
+    # same split as tag_descriptions, pool startup is excluded since the pool lives as long as the worker
+    with ProcessPoolExecutor(args.processes, initializer=init_tag_process, initargs=matchers) as pool:
+        chunk_size = -(-len(descriptions) // args.processes)
+        chunks = [descriptions[i : i + chunk_size] for i in range(0, len(descriptions), chunk_size)]
+        list(pool.map(tag_batch_in_process, chunks))
+        start = time.perf_counter()
+        pooled = [tags for chunk in pool.map(tag_batch_in_process, chunks) for tags in chunk]
+        pool_time = time.perf_counter() - start
+    assert pooled == single, "process pool tagging differs from per description matching"
+
+    print(f"automaton built in {build_time * 1000:.1f}ms")
+    print(f"pandas apply + match_word: {regex_time / len(descriptions) * 1e6:.0f}us per description")
+    print(f"lexicon matcher:           {matcher_time / len(descriptions) * 1e6:.0f}us per description ({regex_time / matcher_time:.1f}x)")
+    print(f"batch tagging:             {batch_time / len(descriptions) * 1e6:.0f}us per description ({regex_time / batch_time:.1f}x)")
+    print(f"batch tagging, {args.processes} processes: {pool_time / len(descriptions) * 1e6:.0f}us per description ({regex_time / pool_time:.1f}x)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="equivalence and speed of the lexicon matcher against match_word")
+    parser.add_argument("--descriptions", type=int, default=2000, help="number of generated descriptions")
+    parser.add_argument("--processes", type=int, default=2, help="processes for the pooled batch tagging")
+    main(parser.parse_args())
@@ -0,0 +1,84 @@
+import argparse
+import json
+import os
+import random
+import time
+
+import pandas as pd
+
+from workers.benchmarks.lexicon_matcher import generate_descriptions
+from workers.handlers.map_descriptions.lexicon import tag_batch
+from workers.handlers.map_descriptions.lexicon_index import PROMPTS_DIR, Lexicon
+from workers.handlers.map_descriptions.map_worker import build_messages
+from workers.prompts.map_descrip_prompts import CONTEXT, SYSTEM_PROMPT
+
+
+def dataframe_messages(prefix: list[dict], liths: pd.DataFrame, lith_atts: pd.DataFrame, description: str, lith_rows: list[int], lith_att_rows: list[int]) -> tuple[str, list[dict]]:
+    # the previous prompt assembly in generate_triplets
+    prompt = "Find the relevant triplets in the following text."
+    prompt += "Your relationships must only include the lithologies and lithology attributes given below.\n"
+    filtered_liths = liths.iloc[lith_rows]
+    filtered_lith_atts = lith_atts.iloc[lith_att_rows]
+    prompt += "Here are relevant lithologies found in the text:\n"
+    for _, row in filtered_liths.iterrows():
+        prompt += row[0] + "\n"
+    prompt += "Here are relevant lithology attributes found in the text (attribute and attribute type):\n"
+    for _, row in filtered_lith_atts.iterrows():
+        prompt += row[0] + "\t" + row[1] + "\n"
+    prompt += "\n"
+    prompt += "###\n"
+    prompt += description
+
+    messages = prefix.copy()
+    messages.append({"role": "user", "content": prompt})
+    return prompt, messages
+
+
+def main(args: argparse.Namespace) -> None:
+    liths_path, lith_atts_path = os.path.join(PROMPTS_DIR, "liths.csv"), os.path.join(PROMPTS_DIR, "lith_atts.csv")
+    liths, lith_atts = pd.read_csv(liths_path, header=None), pd.read_csv(lith_atts_path, header=None)
+    lexicon = Lexicon.from_csv(liths_path, lith_atts_path)
+    prefix = [{"role": "system", "content": SYSTEM_PROMPT}]
+    for example in CONTEXT:
+        prefix.append({"role": "user", "content": example[0]})
+        prefix.append({"role": "assistant", "content": example[1]})
+
+    # map legends repeat a lot, descriptions are drawn from a smaller set of distinct ones
+    distinct = generate_descriptions([*lexicon.liths, *lexicon.lith_atts], args.distinct)
+    rng = random.Random(1)
+    descriptions = [rng.choice(distinct) for _ in range(args.prompts)]
+    jobs = [(description, lith_rows, lith_att_rows) for description, (lith_rows, lith_att_rows) in zip(descriptions, tag_batch(lexicon.lith_matcher, lexicon.lith_att_matcher, descriptions)) if lith_rows and lith_att_rows]
+
+    # same prompt text and the same serialized prefix as before
+    expected_prefix = json.dumps(prefix)
+    for description, lith_rows, lith_att_rows in jobs[: args.check]:
+        old_prompt, old_messages = dataframe_messages(prefix, liths, lith_atts, description, lith_rows, lith_att_rows)
+        new_prompt, new_messages = build_messages(tuple(prefix), lexicon, description, lith_rows, lith_att_rows)
+        assert old_prompt == new_prompt and old_messages == new_messages
+        assert json.dumps(new_messages[:-1]) == expected_prefix
+    print(f"prompts identical to the previous assembly on {min(args.check, len(jobs))} descriptions")
+
+    start = time.perf_counter()
+    for description, lith_rows, lith_att_rows in jobs:
+        dataframe_messages(prefix, liths, lith_atts, description, lith_rows, lith_att_rows)
+    dataframe_rate = len(jobs) / (time.perf_counter() - start)
+
+    results = [("dataframe iterrows + str +=", dataframe_rate)]
+    for label, lexicon in (("memoized, cold cache", Lexicon.from_csv(liths_path, lith_atts_path)), ("memoized, warm cache", lexicon)):
+        start = time.perf_counter()
+        for description, lith_rows, lith_att_rows in jobs:
+            build_messages(tuple(prefix), lexicon, description, lith_rows, lith_att_rows)
+        results.append((label, len(jobs) / (time.perf_counter() - start)))
+        print(f"{label}: {lexicon.prompt_block.cache_info()}")
+
+    print(f"{len(jobs)} prompts from {args.distinct} distinct descriptions")
+    for label, rate in results:
+        print(f"{label:28} {rate:10.0f} prompts/s ({rate / dataframe_rate:.1f}x)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="prompts per second of map description prompt assembly")
+    parser.add_argument("--prompts", type=int, default=20000)
+    parser.add_argument("--distinct", type=int, default=2000, help="distinct descriptions the prompts are drawn from")
+    parser.add_argument("--check", type=int, default=2000, help="prompts compared against the previous assembly")
+    main(parser.parse_args())
@@ -0,0 +1,106 @@
+import argparse
+import json
+import os
+import random
+import statistics
+import time
+
+from workers.handlers.map_descriptions import types as map_types
+from workers.handlers.utils.serialization import dumps, orjson
+from workers.handlers.weaviate import types as weaviate_types
+from workers.wrapper_classes.weaviate_wrapper import WeaviateText
+
+WORDS = "the sandstone is interbedded with red shale and thin beds of limestone containing fossils of the Devonian age".split()
+# a few of the non ascii characters that show up in papers and legends
+ACCENTED = ["Pérez", "Müller", "Québec", "°C", "–", "±", "µm", "Ångström"]
+
+
+def text(rng: random.Random, words: int) -> str:
+    return " ".join(rng.choice(ACCENTED) if rng.random() < 0.02 else rng.choice(WORDS) for _ in range(words)).capitalize() + "."
+
+
+def triplets(rng: random.Random, module, count: int):
+    relationships = list(module.RelationshipType)
+    return module.TripletList(
+        reasoning=text(rng, 30),
+        triplets=[module.Triplet(reasoning=text(rng, 25), head=rng.choice(WORDS), tail=rng.choice(WORDS), relationship=rng.choice(relationships)) for _ in range(count)],
+    )
+
+
+def weaviate_results(rng: random.Random, count: int, per_result: int) -> list:
+    return [
+        weaviate_types.ParagraphResult(
+            triplet_list=triplets(rng, weaviate_types, per_result),
+            paragraph_data=WeaviateText(preprocessor_id="haystack_v0.0.2", paper_id=f"{rng.getrandbits(64):016x}", hashed_text=f"{rng.getrandbits(128):032x}", weaviate_id=f"{rng.getrandbits(128):032x}", paragraph=text(rng, 180)),
+        )
+        for _ in range(count)
+    ]
+
+
+def map_results(rng: random.Random, count: int, per_result: int) -> list:
+    return [map_types.ParagraphResult(triplet_list=triplets(rng, map_types, per_result), description=text(rng, 40), prompt="", legend_id=rng.randrange(10**6)) for _ in range(count)]
+
+
+def previous_serialize_triplet(triplet) -> dict:
+    return {"src": triplet.head, "relationship_type": triplet.relationship.name, "dst": triplet.tail, "reasoning": triplet.reasoning}
+
+
+def previous_weaviate(header: dict, output_list: list, out) -> str:
+    # weaviate store_results before: dicts, json.dumps and an ascii pass over the whole payload
+    results = [
+        {
+            "text": {"text_type": "weaviate_text", "preprocessor_id": result.paragraph_data.preprocessor_id, "paper_id": result.paragraph_data.paper_id, "hashed_text": result.paragraph_data.hashed_text, "weaviate_id": result.paragraph_data.weaviate_id, "paragraph_text": result.paragraph_data.paragraph},
+            "relationships": [previous_serialize_triplet(triplet) for triplet in result.triplet_list.triplets],
+        }
+        for result in output_list
+    ]
+    return json.dumps({**header, "results": results}, ensure_ascii=False).encode("ascii", errors="ignore").decode()
+
+
+def previous_map(header: dict, output_list: list, out) -> str:
+    # map store_results before: the same with indent=4, and the payload printed for every job
+    results = [
+        {"text": {"text_type": "map_descriptions", "paragraph_text": result.description, "legend_id": result.legend_id}, "relationships": [previous_serialize_triplet(triplet) for triplet in result.triplet_list.triplets]}
+        for result in output_list
+    ]
+    output_json = json.dumps({**header, "results": results}, ensure_ascii=False, indent=4).encode("ascii", errors="ignore").decode()
+    print(output_json, file=out)
+    return output_json
+
+
+def current(header: dict, output_list: list, out) -> bytes:
+    return dumps({**header, "results": [result.serialize() for result in output_list]})
+
+
+def measure(serialize, header: dict, output_list: list, out, repeat: int) -> tuple[float, int]:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = serialize(header, output_list, out)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times), len(output)
+
+
+def main(args: argparse.Namespace) -> None:
+    rng = random.Random(0)
+    header = {"run_id": "run_1", "extraction_pipeline_id": "pipeline_1", "model_name": "meta-llama/Meta-Llama-3-8B-Instruct", "model_version": 1}
+    batches = {
+        "weaviate": (weaviate_results(rng, args.triplets // args.per_result, args.per_result), previous_weaviate),
+        "map descriptions": (map_results(rng, args.triplets // args.per_result, args.per_result), previous_map),
+    }
+    print(f"batches of {args.triplets} triplets, {args.per_result} per result, encoder: {'orjson' if orjson else 'json'}")
+    with open(os.devnull, "w") as out:
+        for name, (output_list, previous) in batches.items():
+            # same payload apart from accented letters, which used to be dropped and are now folded
+            assert json.loads(current(header, output_list, out)).keys() == json.loads(previous(header, output_list, out)).keys()
+            before, before_size = measure(previous, header, output_list, out, args.repeat)
+            after, after_size = measure(current, header, output_list, out, args.repeat)
+            print({"batch": name, "before (ms)": round(before * 1000, 2), "after (ms)": round(after * 1000, 2), "speedup": f"{before / after:.1f}x", "before (KB)": before_size // 1024, "after (KB)": after_size // 1024})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="time to serialize a batch of results for the results endpoint, before and after the serialization layer")
+    parser.add_argument("--triplets", type=int, default=500)
+    parser.add_argument("--per-result", type=int, default=5, help="triplets per paragraph or description")
+    parser.add_argument("--repeat", type=int, default=50)
+    main(parser.parse_args())
@@ -0,0 +1,62 @@
+import argparse
+import asyncio
+import glob
+import os
+import random
+import resource
+import tempfile
+import time
+
+import pyarrow.dataset as ds
+
+from workers.benchmarks.result_serialization import weaviate_results
+from workers.wrapper_classes.result_sink import FORMATS, ArrowResultSink
+
+
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def run(args: argparse.Namespace, format: str, payloads: list[dict], directory: str) -> dict:
+    sink = ArrowResultSink(directory, format, row_group_size=args.row_group_size, rows_per_file=args.rows_per_file)
+    sink.start()
+    start = time.perf_counter()
+    rows = 0
+    while rows < args.triplets:
+        payload = payloads[rows // args.triplets_per_job % len(payloads)]
+        await sink.submit(payload)
+        rows += args.triplets_per_job
+    await sink.close()
+    elapsed = time.perf_counter() - start
+
+    files = glob.glob(os.path.join(directory, f"*{FORMATS[format]}"))
+    dataset = ds.dataset(files, format="ipc" if format == "arrow" else "parquet")
+    assert dataset.count_rows() == sink.counts["rows"] == rows
+    return {
+        "format": format,
+        "triplets per second": round(rows / elapsed),
+        "files": len(files),
+        "row groups": sink.counts["row_groups"],
+        "MB on disk": round(sum(os.path.getsize(file) for file in files) / 2**20, 1),
+        "peak rss (MB)": round(peak_rss_mb()),
+    }
+
+
+async def main(args: argparse.Namespace) -> None:
+    rng = random.Random(0)
+    # a few distinct jobs sent over and over, every job has triplets_per_job triplets
+    header = {"run_id": "run_1", "extraction_pipeline_id": "pipeline_1", "model_name": "meta-llama/Meta-Llama-3-8B-Instruct", "model_version": 0}
+    payloads = [{**header, "results": [result.serialize() for result in weaviate_results(rng, args.triplets_per_job // 5, 5)]} for _ in range(20)]
+    print(f"{args.triplets} triplets in jobs of {args.triplets_per_job}, row groups of {args.row_group_size}, files of {args.rows_per_file} rows, peak rss before {peak_rss_mb():.0f}MB")
+    for format in FORMATS:
+        with tempfile.TemporaryDirectory() as directory:
+            print(await run(args, format, payloads, directory))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="throughput, file layout and memory of the local result sink")
+    parser.add_argument("--triplets", type=int, default=2_000_000)
+    parser.add_argument("--triplets-per-job", type=int, default=500)
+    parser.add_argument("--row-group-size", type=int, default=50_000)
+    parser.add_argument("--rows-per-file", type=int, default=1_000_000)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,73 @@
+import argparse
+import asyncio
+import json
+import statistics
+import time
+
+from workers.handlers.map_descriptions.types import TripletList
+from workers.local.vllm_server import DEFAULT_RESPONSE, MockVLLM, MockVLLMServer
+from workers.wrapper_classes.decoding_policy import DecodingPolicy
+from workers.wrapper_classes.vllm_endpoints import EndpointPool
+from workers.wrapper_classes.vllm_wrapper import VLLMWrapper
+
+
+def triplet(index: int, relationship: str = "lithology has color of") -> dict:
+    return {"reasoning": f"The text says the sandstone of bed {index} is red.", "head": "sandstone", "tail": "red", "relationship": relationship}
+
+
+# what the model answers, each followed by --trailing-tokens of rambling until max_tokens
+SCENARIOS = {
+    "valid triplets": json.dumps({"reasoning": "Three beds of red sandstone are described.", "triplets": [triplet(i) for i in range(3)]}),
+    "empty triplets": DEFAULT_RESPONSE,
+    # reasoning generated after the array, with whitespace before the closing brace
+    "reasoning after triplets": '{"triplets": %s, "reasoning": "Two beds of red sandstone are described." }' % json.dumps([triplet(i) for i in range(2)]),
+    "invalid first triplet": json.dumps({"reasoning": "Many beds are described.", "triplets": [triplet(0, "lithology has age of"), *(triplet(i) for i in range(1, 12))]}),
+}
+
+
+async def run(wrapper: VLLMWrapper, mock: MockVLLM, requests: int) -> dict:
+    tokens = mock.generated_tokens
+    latencies, outputs = [], []
+
+    async def request():
+        start = time.perf_counter()
+        outputs.append(await wrapper.guided_generate([{"role": "user", "content": "mock"}]))
+        latencies.append(time.perf_counter() - start)
+
+    await asyncio.gather(*(request() for _ in range(requests)))
+    # tokens of aborted requests are counted by the mock until it notices the closed connection
+    await asyncio.sleep(mock.token_latency * 5)
+    return {"tokens per request": (mock.generated_tokens - tokens) / requests, "mean latency (ms)": round(statistics.fmean(latencies) * 1000, 1), "output": outputs[0]}
+
+
+async def main(args: argparse.Namespace) -> None:
+    mock = MockVLLM(capacity=args.requests, latency=args.latency, token_latency=args.token_latency, trailing_tokens=args.trailing_tokens)
+    server = MockVLLMServer(mock).start()
+    endpoints = EndpointPool([server.url])
+    await endpoints.start()
+    print(f"{args.requests} concurrent requests per scenario, {args.latency * 1000}ms to first token + {args.token_latency * 1000}ms per token, {args.trailing_tokens} trailing tokens")
+
+    for scenario, response in SCENARIOS.items():
+        mock.response = response
+        results = {}
+        for stream in (False, True):
+            # keep every request unconstrained first so both modes take the same paths
+            wrapper = VLLMWrapper("mock-model", TripletList, policy=DecodingPolicy(threshold=1.0), stream=stream, endpoints=endpoints)
+            results[stream] = await run(wrapper, mock, args.requests)
+            await wrapper.shutdown()
+        # streaming must not change what is extracted
+        assert results[False].pop("output") == results[True].pop("output")
+        saved = 1 - results[True]["tokens per request"] / results[False]["tokens per request"]
+        print({"scenario": scenario, "full completion": results[False], "streaming": results[True], "tokens saved": f"{saved:.0%}"})
+
+    await endpoints.close()
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="tokens and latency of full completions against streaming with early abort, on the mock vLLM server")
+    parser.add_argument("--requests", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds to the first token")
+    parser.add_argument("--token-latency", type=float, default=0.002, help="seconds per generated token")
+    parser.add_argument("--trailing-tokens", type=int, default=400, help="tokens the model generates after its answer")
+    asyncio.run(main(parser.parse_args()))
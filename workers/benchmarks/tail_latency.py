@@ -0,0 +1,103 @@
+import argparse
+import asyncio
+import json
+import logging
+import random
+import statistics
+import sys
+import time
+
+import workers.pb.job_manager_pb2 as pb
+import workers.handlers.weaviate.weaviate_worker as weaviate_worker
+from workers.handlers.weaviate.types import TripletList
+from workers.local.vllm_server import MockVLLM, MockVLLMServer
+from workers.local.weaviate_server import MockWeaviate, MockWeaviateServer, generate_paragraphs
+from workers.wrapper_classes.hedging import LatencyTracker
+from workers.wrapper_classes.vllm_endpoints import EndpointPool
+from workers.wrapper_classes.vllm_wrapper import VLLMWrapper
+from workers.wrapper_classes.weaviate_wrapper import WeaviateWrapper
+from workers.wrapper_classes.worker_wrapper import Metadata
+
+RESPONSE = json.dumps({"reasoning": "The text describes red sandstone.", "triplets": [{"reasoning": "The sandstone is red.", "head": "sandstone", "tail": "red", "relationship": "lithology has color of"}]})
+
+
+def percentile(values: list[float], share: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(share * len(values)))]
+
+
+async def run(ctx: dict, ids: list[str], args: argparse.Namespace) -> dict:
+    job_times, kept = [], []
+    for _ in range(args.jobs):
+        job_data = pb.WeaviateJob(paragraph_ids=random.sample(ids, args.batch_size))
+        start = time.perf_counter()
+        output = await weaviate_worker.process_paragraphs(ctx, job_data, Metadata(run_id="benchmark", pipeline_id="benchmark"), return_results=True)
+        job_times.append(time.perf_counter() - start)
+        kept.append(len(json.loads(output)["results"]) / args.batch_size)
+    return {"p50 job (ms)": round(percentile(job_times, 0.5) * 1000), "p99 job (ms)": round(percentile(job_times, 0.99) * 1000), "paragraphs kept": f"{statistics.fmean(kept):.1%}"}
+
+
+async def main(args: argparse.Namespace) -> None:
+    logging.basicConfig(format="[%(asctime)s] %(levelname)-8s %(message)s", level=logging.ERROR, datefmt="%Y-%m-%d %H:%M:%S", stream=sys.stdout)
+    random.seed(0)
+
+    paragraphs = generate_paragraphs(args.paragraphs)
+    weaviate_server = MockWeaviateServer(MockWeaviate(paragraphs)).start()
+    vllm_servers = [
+        MockVLLMServer(MockVLLM(capacity=args.batch_size * 2, latency=args.llm_latency, response=RESPONSE, straggler_rate=args.straggler_rate, straggler_latency=args.straggler_latency, seed=i)).start()
+        for i in range(args.endpoints)
+    ]
+    endpoints = EndpointPool([server.url for server in vllm_servers])
+    await endpoints.start()
+    # every endpoint is healthy before the first job
+    await asyncio.sleep(0.2)
+
+    print(
+        f"{args.jobs} jobs of {args.batch_size} paragraphs on {args.endpoints} endpoints, LLM {args.llm_latency * 1000}ms/request, "
+        f"{args.straggler_rate:.0%} of requests stuck for {args.straggler_latency}s"
+    )
+    ids = list(paragraphs)
+    # a tracker that never hedges sees every request, its percentile is the true p95 the hedged modes should learn
+    modes = {
+        "baseline": (0, LatencyTracker(args.hedge_percentile, budget=0)),
+        "deadline": (args.deadline, None),
+        "hedged": (0, LatencyTracker(args.hedge_percentile, budget=args.hedge_budget)),
+        "hedged + deadline": (args.deadline, LatencyTracker(args.hedge_percentile, budget=args.hedge_budget)),
+    }
+    for mode, (deadline, tracker) in modes.items():
+        weaviate_worker.PARAGRAPH_DEADLINE = deadline
+        ctx = {"weaviate": WeaviateWrapper(weaviate_server.url, "mock-key"), "prompt": [{"role": "system", "content": "mock"}]}
+        ctx["vllm"] = VLLMWrapper("mock-model", TripletList, endpoints=endpoints, hedging=tracker)
+        if tracker is not None and tracker.budget:
+            # the hedge delay is a percentile of latencies seen so far, learn it before measuring
+            await run(ctx, ids, argparse.Namespace(**{**vars(args), "jobs": max(1, tracker.min_samples // args.batch_size + 1)}))
+        result = {"mode": mode, **await run(ctx, ids, args)}
+        if tracker is not None and not tracker.budget:
+            true_delay = tracker.delay()
+            result["true p95 (ms)"] = round(true_delay * 1000)
+        elif tracker is not None:
+            result["hedging"] = tracker.stats()
+            # hedged requests are still recorded, otherwise every hedge drops a tail sample and the delay sinks to the median
+            assert 0.5 * true_delay <= tracker.delay() <= 2 * true_delay, f"hedge delay {tracker.delay():.3f}s is far from the true p95 of {true_delay:.3f}s"
+        print(result)
+        await ctx["vllm"].shutdown()
+
+    await endpoints.close()
+    weaviate_server.shutdown()
+    for server in vllm_servers:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="p50 and p99 job latency with per-paragraph deadlines and hedged requests against stragglers, on mock servers")
+    parser.add_argument("--paragraphs", type=int, default=2000)
+    parser.add_argument("--jobs", type=int, default=100)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--endpoints", type=int, default=2)
+    parser.add_argument("--llm-latency", type=float, default=0.1, help="seconds per LLM request")
+    parser.add_argument("--straggler-rate", type=float, default=0.01, help="share of LLM requests that are stuck")
+    parser.add_argument("--straggler-latency", type=float, default=3.0, help="seconds a stuck request takes on top")
+    parser.add_argument("--deadline", type=float, default=1.0, help="PARAGRAPH_DEADLINE of the deadline modes")
+    parser.add_argument("--hedge-percentile", type=float, default=0.95)
+    parser.add_argument("--hedge-budget", type=float, default=0.1)
+    asyncio.run(main(parser.parse_args()))
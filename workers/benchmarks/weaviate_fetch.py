@@ -0,0 +1,50 @@
+import argparse
+import random
+import time
+
+from workers.local.weaviate_server import MockWeaviate, MockWeaviateServer, generate_paragraphs
+from workers.wrapper_classes.weaviate_wrapper import WeaviateWrapper
+
+
+def main(args: argparse.Namespace) -> None:
+    paragraphs = generate_paragraphs(args.paragraphs)
+    mock = MockWeaviate(paragraphs, latency=args.latency, latency_per_object=args.latency_per_object)
+    server = MockWeaviateServer(mock).start()
+    wrapper = WeaviateWrapper(server.url, "mock-key")
+
+    ids = list(paragraphs)
+    print(f"mock Weaviate latency: {args.latency * 1000}ms per query + {args.latency_per_object * 1000}ms per object, {args.missing:.0%} missing ids")
+    for batch_size in args.batch_sizes:
+        batch = random.sample(ids, batch_size)
+        # replace a share of the ids with ones Weaviate does not know
+        for i in random.sample(range(batch_size), int(batch_size * args.missing)):
+            batch[i] = f"ffffffff-ffff-ffff-ffff-{i:012d}"
+
+        # chunk size 1 issues one query per id like the previous implementation
+        for label, chunk_size in (("per id", 1), (f"chunks of {args.chunk_size}", args.chunk_size)):
+            mock.queries = 0
+            start = time.perf_counter()
+            results = list(wrapper.get_paragraphs_for_ids(batch, chunk_size=chunk_size))
+            elapsed = time.perf_counter() - start
+            print(
+                {
+                    "batch size": batch_size,
+                    "mode": label,
+                    "found": len(results),
+                    "round trips": mock.queries,
+                    "latency (ms)": round(elapsed * 1000, 1),
+                }
+            )
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="per id vs chunked paragraph retrieval against a mock Weaviate server")
+    parser.add_argument("--paragraphs", type=int, default=2000)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[10, 50, 100, 500])
+    parser.add_argument("--chunk-size", type=int, default=100)
+    parser.add_argument("--latency", type=float, default=0.005, help="seconds per query")
+    parser.add_argument("--latency-per-object", type=float, default=0.0001, help="seconds per returned object")
+    parser.add_argument("--missing", type=float, default=0.1, help="share of ids that do not exist")
+    main(parser.parse_args())
@@ -0,0 +1,86 @@
+import argparse
+import asyncio
+import logging
+import random
+import statistics
+import sys
+import time
+
+import workers.pb.job_manager_pb2 as pb
+import workers.handlers.weaviate.weaviate_worker as weaviate_worker
+from workers.handlers.weaviate.types import TripletList
+from workers.local.vllm_server import MockVLLM, MockVLLMServer
+from workers.local.weaviate_server import MockWeaviate, MockWeaviateServer, generate_paragraphs
+from workers.wrapper_classes.vllm_endpoints import EndpointPool
+from workers.wrapper_classes.vllm_wrapper import VLLMWrapper
+from workers.wrapper_classes.weaviate_wrapper import WeaviateWrapper
+from workers.wrapper_classes.worker_wrapper import Metadata
+
+
+async def sequential_job(ctx: dict, job_data: pb.WeaviateJob) -> None:
+    # the previous implementation: read every paragraph first, then start the LLM requests
+    tasks = [weaviate_worker.request_vllm(ctx, paragraph_data) for paragraph_data in ctx["weaviate"].get_paragraphs_for_ids(job_data.paragraph_ids)]
+    await asyncio.gather(*tasks)
+
+
+async def streaming_job(ctx: dict, job_data: pb.WeaviateJob) -> None:
+    await weaviate_worker.process_paragraphs(ctx, job_data, Metadata(run_id="benchmark", pipeline_id="benchmark"), return_results=True)
+
+
+async def main(args: argparse.Namespace) -> None:
+    logging.basicConfig(format="[%(asctime)s] %(levelname)-8s %(message)s", level=logging.WARNING, datefmt="%Y-%m-%d %H:%M:%S", stream=sys.stdout)
+
+    paragraphs = generate_paragraphs(args.paragraphs)
+    weaviate_server = MockWeaviateServer(MockWeaviate(paragraphs, latency=args.weaviate_latency, latency_per_object=args.latency_per_object)).start()
+    vllm_server = MockVLLMServer(MockVLLM(capacity=args.batch_size, latency=args.llm_latency)).start()
+
+    ctx = {"weaviate": WeaviateWrapper(weaviate_server.url, "mock-key"), "prompt": [{"role": "system", "content": "mock"}]}
+    endpoints = EndpointPool([vllm_server.url])
+    await endpoints.start()
+    ctx["vllm"] = VLLMWrapper("mock-model", TripletList, endpoints=endpoints)
+
+    # record when the first LLM request of a job is sent
+    first_request = []
+    generate = ctx["vllm"].guided_generate
+
+    async def timed_generate(*generate_args, **kwargs):
+        if not first_request:
+            first_request.append(time.perf_counter())
+        return await generate(*generate_args, **kwargs)
+
+    ctx["vllm"].guided_generate = timed_generate
+
+    print(f"{args.jobs} jobs of {args.batch_size} paragraphs, Weaviate {args.weaviate_latency * 1000}ms/query + {args.latency_per_object * 1000}ms/object, LLM {args.llm_latency}s/request")
+    ids = list(paragraphs)
+    for label, run_job in (("sequential", sequential_job), ("streaming", streaming_job)):
+        first_request_times, job_times = [], []
+        for _ in range(args.jobs):
+            job_data = pb.WeaviateJob(paragraph_ids=random.sample(ids, args.batch_size))
+            first_request.clear()
+            start = time.perf_counter()
+            await run_job(ctx, job_data)
+            job_times.append(time.perf_counter() - start)
+            first_request_times.append(first_request[0] - start)
+        print(
+            {
+                "mode": label,
+                "mean time to first request (ms)": round(statistics.fmean(first_request_times) * 1000, 1),
+                "mean job latency (ms)": round(statistics.fmean(job_times) * 1000, 1),
+            }
+        )
+
+    await ctx["vllm"].shutdown()
+    await endpoints.close()
+    weaviate_server.shutdown()
+    vllm_server.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="fetch then infer vs streaming fetch-to-LLM pipeline for Weaviate jobs")
+    parser.add_argument("--paragraphs", type=int, default=2000)
+    parser.add_argument("--jobs", type=int, default=5)
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--weaviate-latency", type=float, default=0.02, help="seconds per Weaviate query")
+    parser.add_argument("--latency-per-object", type=float, default=0.002, help="seconds per returned Weaviate object")
+    parser.add_argument("--llm-latency", type=float, default=0.3, help="seconds per LLM request")
+    asyncio.run(main(parser.parse_args()))
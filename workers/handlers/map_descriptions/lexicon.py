@@ -0,0 +1,143 @@
+import re
+from bisect import bisect_right
+from collections import deque
+from typing import Iterable
+
+# joins the descriptions of a batch, it is not a word character and never part of a term,
+# so boundaries at the edge of a description behave exactly like the start or end of a string
+BATCH_SEPARATOR = "\x00"
+
+
+def is_word_char(char: str) -> bool:
+    # same definition of a word character as \b in re for str patterns
+    return char.isalnum() or char == "_"
+
+
+class LexiconMatcher:
+    """Finds every lexicon term in a text in one pass over the text (Aho-Corasick automaton).
+
+    Matches follow `match_word` exactly: the text is lowercased, a term must start at a word boundary
+    and end at a word boundary or right before a "." or ",". Terms are reported by their position in
+    the list the matcher was built from.
+    """
+
+    def __init__(self, terms: Iterable[str]) -> None:
+        self.terms = [str(term) for term in terms]
+        self.goto = [{}]
+        self.fail = [0]
+        self.outputs = [[]]
+        # an empty term cannot be found by the automaton, these keep the regex
+        self.fallback_terms = []
+
+        for index, term in enumerate(self.terms):
+            if not term:
+                self.fallback_terms.append(index)
+                continue
+            node = 0
+            for char in term:
+                if char not in self.goto[node]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.outputs.append([])
+                    self.goto[node][char] = len(self.goto) - 1
+                node = self.goto[node][char]
+            self.outputs[node].append(index)
+
+        # breadth first so the failure link of a node's parent is known before the node
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self.goto[node].items():
+                queue.append(child)
+                fallback = self.fail[node]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(char, 0)
+                self.outputs[child] = self.outputs[child] + self.outputs[self.fail[child]]
+
+        self.init_boundaries()
+
+    @classmethod
+    def from_automaton(cls, terms: list[str], goto: list[dict[str, int]], fail: list[int], outputs: list[list[int]]) -> "LexiconMatcher":
+        # rebuilds a matcher from a compiled automaton without walking the terms again
+        matcher = cls.__new__(cls)
+        matcher.terms = terms
+        matcher.goto = goto
+        matcher.fail = fail
+        matcher.outputs = outputs
+        matcher.fallback_terms = [index for index, term in enumerate(terms) if not term]
+        matcher.init_boundaries()
+        return matcher
+
+    def init_boundaries(self) -> None:
+        self.lengths = [len(term) for term in self.terms]
+        self.starts_with_word = [bool(term) and is_word_char(term[0]) for term in self.terms]
+        self.ends_with_word = [bool(term) and is_word_char(term[-1]) for term in self.terms]
+
+    def match(self, text: str) -> set[int]:
+        return self.match_lowered(text.lower())
+
+    def match_batch(self, texts: list[str]) -> list[set[int]]:
+        # one automaton pass over the whole batch, hits are assigned back to their text by offset
+        lowered = [text.lower() for text in texts]
+        offsets = []
+        position = 0
+        for text in lowered:
+            offsets.append(position)
+            position += len(text) + len(BATCH_SEPARATOR)
+
+        matches = [set() for _ in texts]
+        for index, start in self.find_all(BATCH_SEPARATOR.join(lowered)):
+            matches[bisect_right(offsets, start) - 1].add(index)
+        for index in self.fallback_terms:
+            for text, text_matches in zip(lowered, matches):
+                if re.search(r"\b" + re.escape(self.terms[index]) + r"(\b|\.|,)", text):
+                    text_matches.add(index)
+        return matches
+
+    def match_lowered(self, text: str) -> set[int]:
+        matched = {index for index, _ in self.find_all(text)}
+        for index in self.fallback_terms:
+            if re.search(r"\b" + re.escape(self.terms[index]) + r"(\b|\.|,)", text):
+                matched.add(index)
+        return matched
+
+    def find_all(self, text: str) -> Iterable[tuple[int, int]]:
+        # yields (term index, start) for every occurrence that satisfies the boundary rules
+        goto, fail, outputs = self.goto, self.fail, self.outputs
+        text_length = len(text)
+        node = 0
+        for end, char in enumerate(text):
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            for index in outputs[node]:
+                start = end - self.lengths[index] + 1
+                # \b before the term
+                before_is_word = start > 0 and is_word_char(text[start - 1])
+                if before_is_word == self.starts_with_word[index]:
+                    continue
+                # \b, "." or "," after the term
+                after = text[end + 1] if end + 1 < text_length else ""
+                if after in (".", ",") or (bool(after) and is_word_char(after)) != self.ends_with_word[index]:
+                    yield index, start
+
+
+def tag_batch(lith_matcher: LexiconMatcher, lith_att_matcher: LexiconMatcher, texts: list[str]) -> list[tuple[list[int], list[int]]]:
+    # matched lith and lith attribute rows for every text, in lexicon order
+    lith_matches = lith_matcher.match_batch(texts)
+    lith_att_matches = lith_att_matcher.match_batch(texts)
+    return [(sorted(liths), sorted(lith_atts)) for liths, lith_atts in zip(lith_matches, lith_att_matches)]
+
+
+# matchers of a tagging process, set once by the pool initializer so they are not pickled with every batch
+process_matchers = None
+
+
+def init_tag_process(lith_matcher: LexiconMatcher, lith_att_matcher: LexiconMatcher) -> None:
+    global process_matchers
+    process_matchers = (lith_matcher, lith_att_matcher)
+
+
+def tag_batch_in_process(texts: list[str]) -> list[tuple[list[int], list[int]]]:
+    return tag_batch(*process_matchers, texts)
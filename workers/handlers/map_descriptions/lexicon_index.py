@@ -0,0 +1,226 @@
+import argparse
+import functools
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+import workers.prompts
+from workers.handlers.map_descriptions.lexicon import LexiconMatcher
+from workers.handlers.map_descriptions.types import triplet_list_schema
+
+PROMPTS_DIR = os.path.dirname(workers.prompts.__file__)
+MAGIC = b"KGLEXIDX"
+VERSION = 1
+# magic, version, length of the json section table that follows
+HEADER = struct.Struct("<8sII")
+# rendered prompt sections kept per lexicon, keyed by the matched term set
+LEXICON_BLOCK_CACHE_SIZE = int(os.getenv("LEXICON_BLOCK_CACHE_SIZE", "4096"))
+
+
+class Lexicon:
+    """The lithologies and lithology attributes map description prompts are built from, with their matchers.
+
+    A lexicon is never modified after it is built, a reload creates a new one and swaps it in, so a job
+    that holds on to a lexicon sees the same terms from tagging to prompt assembly. Rendered prompt
+    sections are cached on the lexicon itself and go away with it.
+    """
+
+    def __init__(self, liths: list[str], lith_atts: list[str], lith_att_types: list[str], lith_matcher: LexiconMatcher = None, lith_att_matcher: LexiconMatcher = None, source: str = "") -> None:
+        self.liths = liths
+        self.lith_atts = lith_atts
+        self.lith_att_types = lith_att_types
+        self.lith_matcher = lith_matcher or LexiconMatcher(liths)
+        self.lith_att_matcher = lith_att_matcher or LexiconMatcher(lith_atts)
+        self.source = source
+        self.prompt_block = functools.lru_cache(maxsize=LEXICON_BLOCK_CACHE_SIZE)(self.render_prompt_block)
+        self.triplet_schema = functools.lru_cache(maxsize=LEXICON_BLOCK_CACHE_SIZE)(self.render_triplet_schema)
+
+    def render_prompt_block(self, lith_rows: tuple[int, ...], lith_att_rows: tuple[int, ...]) -> str:
+        # the part of a map description prompt that lists the matched terms
+        lines = ["Here are relevant lithologies found in the text:\n"]
+        lines.extend(self.liths[row] + "\n" for row in lith_rows)
+        lines.append("Here are relevant lithology attributes found in the text (attribute and attribute type):\n")
+        lines.extend(self.lith_atts[row] + "\t" + self.lith_att_types[row] + "\n" for row in lith_att_rows)
+        return "".join(lines)
+
+    @classmethod
+    def from_csv(cls, liths_path: str, lith_atts_path: str) -> "Lexicon":
+        # parsed exactly like the prompts have always read them
+        import pandas as pd
+
+        liths = pd.read_csv(liths_path, header=None)
+        lith_atts = pd.read_csv(lith_atts_path, header=None)
+        return cls(
+            [str(term) for term in liths.iloc[:, 0]],
+            [str(term) for term in lith_atts.iloc[:, 0]],
+            [str(term) for term in lith_atts.iloc[:, 1]],
+            source=f"{liths_path}, {lith_atts_path}",
+        )
+
+    def render_triplet_schema(self, lith_rows: tuple[int, ...], lith_att_rows: tuple[int, ...]) -> str:
+        # serialized once per term set, vLLM reuses the compiled grammar for byte identical schemas
+        heads = list(dict.fromkeys(self.liths[row] for row in lith_rows))
+        tails = list(dict.fromkeys([*(self.lith_atts[row] for row in lith_att_rows), *heads]))
+        return json.dumps(triplet_list_schema(heads, tails))
+
+    def __len__(self) -> int:
+        return len(self.liths) + len(self.lith_atts)
+
+
+def pack_strings(strings: list[str]) -> bytes:
+    # terms never contain NUL, see lexicon.BATCH_SEPARATOR
+    return "\0".join(strings).encode()
+
+
+def unpack_strings(data: bytes, count: int) -> list[str]:
+    return data.decode().split("\0") if count else []
+
+
+def pack_matcher(matcher: LexiconMatcher) -> dict[str, bytes]:
+    # flattens the automaton into arrays, the edges of node n are edge_start[n]:edge_start[n + 1]
+    edge_start, edge_targets, output_start, outputs = array("I", [0]), array("I"), array("I", [0]), array("I")
+    edge_chars = []
+    for node_edges, node_outputs in zip(matcher.goto, matcher.outputs):
+        edge_chars.extend(node_edges)
+        edge_targets.extend(node_edges.values())
+        edge_start.append(len(edge_targets))
+        outputs.extend(node_outputs)
+        output_start.append(len(outputs))
+    return {
+        "edge_start": edge_start.tobytes(),
+        "edge_chars": "".join(edge_chars).encode("utf-32-le"),
+        "edge_targets": edge_targets.tobytes(),
+        "fail": array("I", matcher.fail).tobytes(),
+        "output_start": output_start.tobytes(),
+        "outputs": outputs.tobytes(),
+    }
+
+
+def write_index(lexicon: Lexicon, path: str) -> None:
+    sections = {
+        "liths": pack_strings(lexicon.liths),
+        "lith_atts": pack_strings(lexicon.lith_atts),
+        "lith_att_types": pack_strings(lexicon.lith_att_types),
+    }
+    for prefix, matcher in (("lith", lexicon.lith_matcher), ("lith_att", lexicon.lith_att_matcher)):
+        for name, data in pack_matcher(matcher).items():
+            sections[f"{prefix}.{name}"] = data
+
+    table = {"byteorder": sys.byteorder, "counts": {"liths": len(lexicon.liths), "lith_atts": len(lexicon.lith_atts)}, "sections": {}}
+    offset = 0
+    for name, data in sections.items():
+        table["sections"][name] = [offset, len(data)]
+        # keep every array 4 byte aligned within the data block
+        offset += len(data) + -len(data) % 4
+    table_bytes = json.dumps(table).encode()
+    table_bytes += b" " * (-(HEADER.size + len(table_bytes)) % 4)
+
+    # written next to the target and renamed over it, a reader never sees a partial index
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "wb") as file:
+        file.write(HEADER.pack(MAGIC, VERSION, len(table_bytes)))
+        file.write(table_bytes)
+        for data in sections.values():
+            file.write(data + b"\0" * (-len(data) % 4))
+    os.replace(temp_path, path)
+
+
+def read_index(path: str) -> Lexicon:
+    with open(path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        magic, version, table_length = HEADER.unpack_from(mapped)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a version {VERSION} lexicon index")
+        table = json.loads(mapped[HEADER.size : HEADER.size + table_length])
+        if table["byteorder"] != sys.byteorder:
+            raise ValueError(f"{path} was built on a {table['byteorder']} endian machine")
+        base = HEADER.size + table_length
+
+        with memoryview(mapped) as view:
+
+            def raw(name: str) -> bytes:
+                offset, length = table["sections"][name]
+                with view[base + offset : base + offset + length] as section:
+                    return bytes(section)
+
+            def ints(name: str) -> list[int]:
+                offset, length = table["sections"][name]
+                with view[base + offset : base + offset + length] as section, section.cast("I") as values:
+                    return values.tolist()
+
+            def matcher(prefix: str, terms: list[str]) -> LexiconMatcher:
+                edge_start, edge_targets = ints(f"{prefix}.edge_start"), ints(f"{prefix}.edge_targets")
+                edge_chars = raw(f"{prefix}.edge_chars").decode("utf-32-le")
+                output_start, outputs = ints(f"{prefix}.output_start"), ints(f"{prefix}.outputs")
+                goto = [dict(zip(edge_chars[start:end], edge_targets[start:end])) for start, end in zip(edge_start, edge_start[1:])]
+                node_outputs = [outputs[start:end] for start, end in zip(output_start, output_start[1:])]
+                return LexiconMatcher.from_automaton(terms, goto, ints(f"{prefix}.fail"), node_outputs)
+
+            liths = unpack_strings(raw("liths"), table["counts"]["liths"])
+            lith_atts = unpack_strings(raw("lith_atts"), table["counts"]["lith_atts"])
+            lith_att_types = unpack_strings(raw("lith_att_types"), table["counts"]["lith_atts"])
+            return Lexicon(liths, lith_atts, lith_att_types, matcher("lith", liths), matcher("lith_att", lith_atts), source=path)
+
+
+class LexiconSource:
+    """Where the map description lexicon comes from: a compiled index, rebuilt from the CSVs whenever they are newer."""
+
+    def __init__(self, index_path: str, liths_path: str, lith_atts_path: str) -> None:
+        self.index_path = index_path
+        self.liths_path = liths_path
+        self.lith_atts_path = lith_atts_path
+
+    def signature(self) -> tuple:
+        # changes whenever any of the files is replaced or modified
+        signature = []
+        for path in (self.index_path, self.liths_path, self.lith_atts_path):
+            try:
+                stat = os.stat(path)
+                signature.append((stat.st_mtime_ns, stat.st_size, stat.st_ino))
+            except FileNotFoundError:
+                signature.append(None)
+        return tuple(signature)
+
+    def index_is_stale(self) -> bool:
+        if not os.path.exists(self.index_path):
+            return True
+        index_mtime = os.stat(self.index_path).st_mtime_ns
+        return any(os.path.exists(path) and os.stat(path).st_mtime_ns > index_mtime for path in (self.liths_path, self.lith_atts_path))
+
+    def build(self) -> Lexicon:
+        lexicon = Lexicon.from_csv(self.liths_path, self.lith_atts_path)
+        try:
+            write_index(lexicon, self.index_path)
+            logging.info("compiled lexicon index %s from %s", self.index_path, lexicon.source)
+        except OSError as e:
+            # a read only image still works, it just compiles on every start
+            logging.warning("could not write lexicon index %s: %s", self.index_path, e)
+        return lexicon
+
+    def load(self) -> Lexicon:
+        if self.index_is_stale():
+            return self.build()
+        try:
+            return read_index(self.index_path)
+        except (ValueError, KeyError, struct.error) as e:
+            logging.warning("rebuilding unreadable lexicon index %s: %s", self.index_path, e)
+            return self.build()
+
+
+def main():
+    logging.basicConfig(format="[%(asctime)s] %(levelname)-8s %(message)s", level=logging.INFO, datefmt="%Y-%m-%d %H:%M:%S", stream=sys.stdout)
+
+    parser = argparse.ArgumentParser(description="compile the map description lexicon CSVs into an index")
+    parser.add_argument("--liths", type=str, default=os.path.join(PROMPTS_DIR, "liths.csv"))
+    parser.add_argument("--lith-atts", type=str, default=os.path.join(PROMPTS_DIR, "lith_atts.csv"))
+    parser.add_argument("--out", type=str, default=os.path.join(PROMPTS_DIR, "lexicon.idx"))
+    args = parser.parse_args()
+
+    LexiconSource(args.out, args.liths, args.lith_atts).build()
+
+
+if __name__ == "__main__":
+    main()
@@ -2,7 +2,6 @@ import os
 import asyncio
 import argparse
 import httpx
-import json
 from workers.prompts.map_descrip_prompts import (
     SYSTEM_PROMPT,
     CONTEXT,
@@ -11,37 +10,66 @@ from workers.prompts.map_descrip_prompts import (
 )
 import logging
 import sys
-import pandas as pd
 import re
+import signal
+import unicodedata
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 
 from workers.wrapper_classes.vllm_wrapper import VLLMWrapper
+from workers.wrapper_classes.skip_index import SkipIndex
 from workers.handlers.map_descriptions.types import TripletList, ParagraphResult
+from workers.handlers.map_descriptions.lexicon import init_tag_process, tag_batch, tag_batch_in_process
+from workers.handlers.map_descriptions.lexicon_index import PROMPTS_DIR, Lexicon, LexiconSource
 import workers.pb.job_manager_pb2 as pb
-from workers.handlers.utils.utils import dump_output
+from workers.handlers.utils.serialization import dumps
+from workers.handlers.utils.utils import MISSED_DEADLINE, NO_TRIPLETS, with_deadline
 
 
 MANAGER_HOST = os.getenv("MANAGER_HOST")
 RESULT_ENDPOINT = os.getenv("RESULT_ENDPOINT")
 MODEL_NAME = os.getenv("MODEL_NAME")
 MODEL_VERSION = PROMPT_ID
+# jobs with at least this many descriptions are tagged in a process pool instead of on the event loop
+LEXICON_PROCESS_POOL_THRESHOLD = int(os.getenv("LEXICON_PROCESS_POOL_THRESHOLD", "2000"))
+LEXICON_PROCESSES = int(os.getenv("LEXICON_PROCESSES", "2"))
+# compiled lexicon, rebuilt from the CSVs when they are newer and hot swapped on change or SIGHUP
+LEXICON_INDEX = os.getenv("LEXICON_INDEX", os.path.join(PROMPTS_DIR, "lexicon.idx"))
+LITHS_CSV = os.getenv("LITHS_CSV", os.path.join(PROMPTS_DIR, "liths.csv"))
+LITH_ATTS_CSV = os.getenv("LITH_ATTS_CSV", os.path.join(PROMPTS_DIR, "lith_atts.csv"))
+LEXICON_WATCH_INTERVAL = float(os.getenv("LEXICON_WATCH_INTERVAL", "30"))
+# results of recent unique descriptions, reused by later jobs that repeat them
+DESCRIPTION_MEMO_SIZE = int(os.getenv("DESCRIPTION_MEMO_SIZE", "10000"))
+# constrain head and tail to the terms matched in each description, decoding is then constrained from the start
+MAP_DYNAMIC_SCHEMA = os.getenv("MAP_DYNAMIC_SCHEMA", "").lower() in ("1", "true", "yes")
+# seconds a job waits for the triplets of a description before leaving it out, 0 waits forever
+DESCRIPTION_DEADLINE = float(os.getenv("DESCRIPTION_DEADLINE", "0"))
+PROMPT_INSTRUCTIONS = "Find the relevant triplets in the following text." + "Your relationships must only include the lithologies and lithology attributes given below.\n"
 
 
 async def startup(ctx: dict):
     timeout = httpx.Timeout(30.0)
     ctx["httpx_client"] = httpx.AsyncClient(timeout=timeout)
 
-    # process prompts into chat template
-    ctx["prompt"] = [
+    # process prompts into chat template, every request shares this exact prefix so vLLM prefix caching hits
+    prompt = [
         {"role": "system", "content": SYSTEM_PROMPT},
     ]
     for example in CONTEXT:
-        ctx["prompt"].append({"role": "user", "content": example[0]})
-        ctx["prompt"].append({"role": "assistant", "content": example[1]})
-    ctx["liths"] = pd.read_csv("/vllm-workspace/workers/prompts/liths.csv", header=None)
-    ctx["lith_atts"] = pd.read_csv("/vllm-workspace/workers/prompts/lith_atts.csv", header=None)
+        prompt.append({"role": "user", "content": example[0]})
+        prompt.append({"role": "assistant", "content": example[1]})
+    ctx["prompt"] = tuple(prompt)
+    ctx["description_memo"] = OrderedDict()
+    ctx["dedup_stats"] = {}
+    ctx["lexicon_source"] = LexiconSource(LEXICON_INDEX, LITHS_CSV, LITH_ATTS_CSV)
+    ctx["lexicon"] = await asyncio.to_thread(ctx["lexicon_source"].load)
+    logging.info("loaded %s lexicon terms from %s", len(ctx["lexicon"]), ctx["lexicon"].source)
+    ctx["lexicon_reload"] = asyncio.Event()
+    ctx["lexicon_watch"] = asyncio.create_task(watch_lexicon(ctx))
+    asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, ctx["lexicon_reload"].set)
 
     # wait for vLLM server to start
-    ctx["vllm"] = VLLMWrapper(MODEL_NAME, TripletList)
+    ctx["vllm"] = VLLMWrapper(MODEL_NAME, TripletList, dispatcher=ctx.get("dispatcher"), cache=ctx.get("llm_cache"), prompt_id=PROMPT_ID, endpoints=ctx.get("vllm_endpoints"))
     await ctx["vllm"].startup()
 
     logging.info("Ready to accept jobs.")
@@ -50,43 +78,112 @@ async def startup(ctx: dict):
 async def shutdown(ctx: dict):
     await ctx["httpx_client"].aclose()
     await ctx["vllm"].shutdown()
+    asyncio.get_running_loop().remove_signal_handler(signal.SIGHUP)
+    ctx["lexicon_watch"].cancel()
+    if ctx.get("tag_pool"):
+        ctx["tag_pool"][1].shutdown(cancel_futures=True)
+
+
+async def watch_lexicon(ctx: dict):
+    # polls the index and CSVs every LEXICON_WATCH_INTERVAL seconds (0 only reloads on SIGHUP)
+    source = ctx["lexicon_source"]
+    signature = source.signature()
+    while True:
+        try:
+            await asyncio.wait_for(ctx["lexicon_reload"].wait(), LEXICON_WATCH_INTERVAL or None)
+        except asyncio.TimeoutError:
+            pass
+        requested = ctx["lexicon_reload"].is_set()
+        ctx["lexicon_reload"].clear()
+        if not requested and source.signature() == signature:
+            continue
+
+        try:
+            lexicon = await asyncio.to_thread(source.load)
+        except Exception:
+            logging.exception("lexicon reload failed, keeping %s", ctx["lexicon"].source)
+            continue
+        finally:
+            signature = source.signature()
+        # jobs already running keep the lexicon they started with
+        ctx["lexicon"] = lexicon
+        logging.info("swapped in %s lexicon terms from %s", len(lexicon), lexicon.source)
 
 
 def match_word(word, description):
     return bool(re.search(r"\b" + re.escape(str(word)) + r"(\b|\.|,)", description.lower()))
 
 
-async def generate_triplets(ctx: dict, map_description: pb.MapDescriptionJob) -> ParagraphResult:
-    description = map_description.text
+async def tag_descriptions(ctx: dict, lexicon: Lexicon, texts: list[str]) -> list[tuple[list[int], list[int]]]:
+    # matched lith and lith attribute rows of every description in a job
+    if len(texts) < LEXICON_PROCESS_POOL_THRESHOLD or LEXICON_PROCESSES < 2:
+        return tag_batch(lexicon.lith_matcher, lexicon.lith_att_matcher, texts)
+
+    # the pool processes hold the matchers they were started with, a swapped lexicon gets a new pool
+    if not ctx.get("tag_pool") or ctx["tag_pool"][0] is not lexicon:
+        if ctx.get("tag_pool"):
+            ctx["tag_pool"][1].shutdown(wait=False)
+        ctx["tag_pool"] = (lexicon, ProcessPoolExecutor(LEXICON_PROCESSES, initializer=init_tag_process, initargs=(lexicon.lith_matcher, lexicon.lith_att_matcher)))
+    pool = ctx["tag_pool"][1]
+    loop = asyncio.get_running_loop()
+    chunk_size = -(-len(texts) // LEXICON_PROCESSES)
+    chunks = await asyncio.gather(*(loop.run_in_executor(pool, tag_batch_in_process, texts[i : i + chunk_size]) for i in range(0, len(texts), chunk_size)))
+    return [tags for chunk in chunks for tags in chunk]
+
 
+def build_messages(prefix: tuple[dict, ...], lexicon: Lexicon, description: str, lith_rows: list[int], lith_att_rows: list[int]) -> tuple[str, list[dict]]:
     # dynamically generate prompt by inserting liths and lith atts matches into the context
-    prompt = "Find the relevant triplets in the following text."
-    prompt += "Your relationships must only include the lithologies and lithology attributes given below.\n"
-    filtered_liths = ctx["liths"][ctx["liths"].iloc[:, 0].apply(lambda x: match_word(x, description))]
-    filtered_lith_atts = ctx["lith_atts"][ctx["lith_atts"].iloc[:, 0].apply(lambda x: match_word(x, description))]
-    # TODO: change? currently skipping descriptions with no matches
-    if filtered_liths.empty or filtered_lith_atts.empty:
-        return None
-    prompt += "Here are relevant lithologies found in the text:\n"
-    for _, row in filtered_liths.iterrows():
-        prompt += row[0] + "\n"
-    prompt += "Here are relevant lithology attributes found in the text (attribute and attribute type):\n"
-    for _, row in filtered_lith_atts.iterrows():
-        prompt += row[0] + "\t" + row[1] + "\n"
-    prompt += "\n"
-    prompt += "###\n"
-    prompt += description
-
-    messages = ctx["prompt"].copy()
-    messages.append({"role": "user", "content": prompt})
-
-    output = await ctx["vllm"].guided_generate(messages)
-    if not output or not output.triplets:
+    prompt = "".join((PROMPT_INSTRUCTIONS, lexicon.prompt_block(tuple(lith_rows), tuple(lith_att_rows)), "\n###\n", description))
+    return prompt, [*prefix, {"role": "user", "content": prompt}]
+
+
+def normalize_description(text: str) -> str:
+    # legends repeat descriptions with different spacing and line breaks
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def skip_key(legend_id: int, description: str) -> bytes:
+    # a legend description extracted with the same model and prompt
+    return SkipIndex.key(f"legend_id:{legend_id}:{normalize_description(description)}", MODEL_NAME, PROMPT_ID)
+
+
+def shared_triplets(ctx: dict, lexicon: Lexicon, map_description: pb.MapDescription, lith_rows: list[int], lith_att_rows: list[int]) -> tuple[asyncio.Task, bool]:
+    # one LLM request per normalized description, shared with every job that asks for it while it is remembered
+    memo = ctx["description_memo"]
+    key = map_description.text
+    if key in memo and memo[key][0] is lexicon:
+        memo.move_to_end(key)
+        return memo[key][1], True
+
+    task = asyncio.create_task(generate_triplets(ctx, lexicon, map_description, lith_rows, lith_att_rows))
+    memo[key] = (lexicon, task)
+    while len(memo) > DESCRIPTION_MEMO_SIZE:
+        memo.popitem(last=False)
+
+    def forget_failed(task: asyncio.Task) -> None:
+        if (task.cancelled() or task.exception()) and memo.get(key, (None, None))[1] is task:
+            del memo[key]
+
+    task.add_done_callback(forget_failed)
+    return task, False
+
+
+async def generate_triplets(ctx: dict, lexicon: Lexicon, map_description: pb.MapDescriptionJob, lith_rows: list[int], lith_att_rows: list[int]) -> ParagraphResult | None:
+    description = map_description.text
+    prompt, messages = build_messages(ctx["prompt"], lexicon, description, lith_rows, lith_att_rows)
+
+    if MAP_DYNAMIC_SCHEMA:
+        output = await ctx["vllm"].guided_generate(messages, True, lexicon.triplet_schema(tuple(lith_rows), tuple(lith_att_rows)))
+    else:
+        output = await ctx["vllm"].guided_generate(messages)
+    if not output:
         return None
+    if not output.triplets:
+        return NO_TRIPLETS
     return ParagraphResult(triplet_list=output, description=description, prompt=prompt, legend_id=map_description.legend_id)
 
 
-async def store_results(ctx: dict, output_list: list[ParagraphResult], run_metadata: dict, return_results: bool) -> dict | None:
+async def store_results(ctx: dict, output_list: list[ParagraphResult], run_metadata: dict, return_results: bool) -> bytes | None:
     # convert results into json and post to an endpoint
     serialized_results = []
     for paragraph_output in output_list:
@@ -95,29 +192,27 @@ async def store_results(ctx: dict, output_list: list[ParagraphResult], run_metad
             serialized_results.append(serialized_output)
 
     # post to Macrostrat endpoint if any triplets have been extracted in this batch
-    output_json = (
-        json.dumps(
-            {
-                "run_id": run_metadata.run_id,
-                "extraction_pipeline_id": run_metadata.pipeline_id,
-                "model_name": MODEL_NAME,
-                "model_version": MODEL_VERSION,
-                "results": serialized_results,
-            },
-            ensure_ascii=False,
-            indent=4,
-        )
-        .encode("ascii", errors="ignore")
-        .decode()  # remove non ascii characters
-    )
+    payload = {
+        "run_id": run_metadata.run_id,
+        "extraction_pipeline_id": run_metadata.pipeline_id,
+        "model_name": MODEL_NAME,
+        "model_version": MODEL_VERSION,
+        "results": serialized_results,
+    }
+    if not return_results and ctx.get("result_sink") is not None:
+        # posted or written in the background, the job finishes without waiting on the endpoint
+        await ctx["result_sink"].submit(payload)
+        # unless it is only writing local files and posting stays inside the job
+        if not ctx.get("inline_upload"):
+            return
+
+    # text fields were folded to ascii by serialize(), the payload is written straight to compact bytes
+    output_json = dumps(payload)
 
     if return_results:
         return output_json
     if serialized_results:
-        # dump_output(output_json)
-        print(output_json)
         response = await ctx["httpx_client"].post(RESULT_ENDPOINT, headers={"Content-Type": "application/json"}, content=output_json)
-        print(response.text)
         response.raise_for_status()
 
 
@@ -127,17 +222,67 @@ async def process_descriptions(
     run_metadata: dict,
     return_results: bool = False,
 ) -> dict | None:
-    description_batch = job_data.descriptions
-
-    # pull paragraph text from Weaviate and extract triplets using the LLM
-    tasks = []
+    description_batch = list(job_data.descriptions)
+    stats = Counter(descriptions=len(description_batch))
+
+    # descriptions already extracted with this model and prompt are not prompted again
+    skip_index = ctx.get("skip_index")
+    if skip_index is not None:
+        seen = await skip_index.contains([skip_key(description.legend_id, description.text) for description in description_batch])
+        stats["skipped"] = sum(seen)
+        description_batch = [description for description, done in zip(description_batch, seen) if not done]
+
+    # legend_ids that share a normalized description are extracted once
+    groups = {}
     for description in description_batch:
-        task = generate_triplets(ctx, description)
-        tasks.append(task)
-    output_list = await asyncio.gather(*tasks)
+        groups.setdefault(normalize_description(description.text), []).append(description)
+    stats["unique"] = len(groups)
+
+    # tag the whole batch up front, descriptions without lith and lith attribute matches are skipped
+    # TODO: change? currently skipping descriptions with no matches
+    lexicon = ctx["lexicon"]
+    texts = list(groups)
+    tags = await tag_descriptions(ctx, lexicon, texts)
+    tasks = {}
+    for text, (lith_rows, lith_att_rows) in zip(texts, tags):
+        if not lith_rows or not lith_att_rows:
+            stats["unmatched"] += 1
+            continue
+        stats["matched"] += len(groups[text])
+        tasks[text], reused = shared_triplets(ctx, lexicon, pb.MapDescription(legend_id=groups[text][0].legend_id, text=text), lith_rows, lith_att_rows)
+        stats["reused" if reused else "requested"] += 1
+    # shielded, a cancelled job or a missed deadline must not cancel requests other jobs are waiting on
+    outputs = await asyncio.gather(*(with_deadline(asyncio.shield(task), DESCRIPTION_DEADLINE, f"description of legend {groups[text][0].legend_id}") for text, task in tasks.items()))
+
+    # fan every result back out to the legend_ids it was extracted for
+    output_list = []
+    extracted = []
+    for text, output in zip(tasks, outputs):
+        if output is MISSED_DEADLINE:
+            stats["missed_deadline"] += 1
+            continue
+        if output is None:
+            continue
+        extracted.extend(groups[text])
+        if output is NO_TRIPLETS:
+            stats["no_triplets"] += 1
+            continue
+        for description in groups[text]:
+            output_list.append(output.model_copy(update={"description": description.text, "legend_id": description.legend_id}))
+    stats["results"] = len(output_list)
+
+    run_stats = ctx["dedup_stats"].setdefault(run_metadata.run_id, Counter())
+    run_stats.update(stats)
+    logging.info("map descriptions: %s", dict(stats))
+    # every matched description used to be one LLM request
+    logging.info("map descriptions in run %s: %s, %s LLM requests saved", run_metadata.run_id, dict(run_stats), run_stats["matched"] - run_stats["requested"])
 
     # serialize results for batch and store in Macrostrat endpoint
     result = await store_results(ctx, output_list, run_metadata, return_results)
+    # recorded once the result sink has their results safe (see DeferredSkipIndex), also when they had no triplets,
+    # descriptions that failed or missed the deadline are tried again
+    if skip_index is not None and not return_results:
+        await skip_index.add([skip_key(description.legend_id, description.text) for description in extracted])
     if return_results:
         return result
 
@@ -1,6 +1,8 @@
+import copy
 from enum import Enum
 from pydantic import BaseModel
 from typing import List
+from workers.handlers.utils.serialization import ascii_text
 
 
 class RelationshipType(str, Enum):
@@ -19,10 +21,10 @@ class Triplet(BaseModel):
 
     def serialize(self):
         return {
-            "src": self.head,
+            "src": ascii_text(self.head),
             "relationship_type": self.relationship.name,
-            "dst": self.tail,
-            "reasoning": self.reasoning,
+            "dst": ascii_text(self.tail),
+            "reasoning": ascii_text(self.reasoning),
         }
 
 
@@ -31,6 +33,17 @@ class TripletList(BaseModel):
     triplets: List[Triplet]
 
 
+TRIPLET_LIST_SCHEMA = TripletList.model_json_schema()
+
+
+def triplet_list_schema(heads: list[str], tails: list[str]) -> dict:
+    # TripletList schema with head and tail limited to the given terms, for guided decoding
+    schema = copy.deepcopy(TRIPLET_LIST_SCHEMA)
+    schema["$defs"]["Triplet"]["properties"]["head"]["enum"] = heads
+    schema["$defs"]["Triplet"]["properties"]["tail"]["enum"] = tails
+    return schema
+
+
 class ParagraphResult(BaseModel):
     triplet_list: TripletList
     description: str
@@ -41,7 +54,7 @@ class ParagraphResult(BaseModel):
         return {
             "text": {
                 "text_type": "map_descriptions",
-                "paragraph_text": self.description,
+                "paragraph_text": ascii_text(self.description),
                 "legend_id": self.legend_id,
             },
             "relationships": [triplet.serialize() for triplet in self.triplet_list.triplets],
@@ -0,0 +1,36 @@
+import codecs
+import functools
+import json
+import unicodedata
+
+# orjson writes compact utf-8 bytes several times faster than json, the json module is the fallback
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+@functools.lru_cache(maxsize=4096)
+def fold(chars: str) -> str:
+    # accented letters are folded to their base letter (é -> e), anything else that is not ascii is dropped
+    return unicodedata.normalize("NFKD", chars).encode("ascii", errors="ignore").decode()
+
+
+def fold_error(error: UnicodeEncodeError) -> tuple[str, int]:
+    return fold(error.object[error.start : error.end]), error.end
+
+
+# the ascii encoder hands every run of non ascii characters to this, the rest of the text never leaves C
+codecs.register_error("ascii_fold", fold_error)
+
+
+def ascii_text(text: str) -> str:
+    if text.isascii():
+        return text
+    return text.encode("ascii", errors="ascii_fold").decode()
+
+
+def dumps(obj) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode()
@@ -1,6 +1,12 @@
+import asyncio
 import json
+import logging
 
 counter = 0
+# returned by with_deadline in place of a result that was not ready in time
+MISSED_DEADLINE = object()
+# returned for an item whose LLM output was valid but had no triplets, None means the request failed
+NO_TRIPLETS = object()
 
 
 def dump_output(output: str, file_path: str = "out/output") -> None:
@@ -17,3 +23,14 @@ def dump_output(output: str, file_path: str = "out/output") -> None:
         pretty_json = json.dumps(json_obj, indent=4)
         file.write(pretty_json)
         file.write("\n")
+
+
+async def with_deadline(awaitable, deadline: float, label: str):
+    # a request that is not done by the deadline is given up so it cannot hold up the rest of the batch, 0 waits forever
+    if not deadline:
+        return await awaitable
+    try:
+        return await asyncio.wait_for(awaitable, deadline)
+    except asyncio.TimeoutError:
+        logging.warning("%s missed its %s second deadline", label, deadline)
+        return MISSED_DEADLINE
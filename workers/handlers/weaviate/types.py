@@ -1,5 +1,6 @@
 from enum import Enum
 from pydantic import BaseModel
+from workers.handlers.utils.serialization import ascii_text
 from workers.wrapper_classes.weaviate_wrapper import WeaviateText
 
 
@@ -20,10 +21,10 @@ class Triplet(BaseModel):
 
     def serialize(self):
         return {
-            "src": self.head,
+            "src": ascii_text(self.head),
             "relationship_type": self.relationship.name,
-            "dst": self.tail,
-            "reasoning": self.reasoning,
+            "dst": ascii_text(self.tail),
+            "reasoning": ascii_text(self.reasoning),
         }
 
 
@@ -44,7 +45,7 @@ class ParagraphResult(BaseModel):
                 "paper_id": self.paragraph_data.paper_id,
                 "hashed_text": self.paragraph_data.hashed_text,
                 "weaviate_id": self.paragraph_data.weaviate_id,
-                "paragraph_text": self.paragraph_data.paragraph,
+                "paragraph_text": ascii_text(self.paragraph_data.paragraph),
             },
             "relationships": [triplet.serialize() for triplet in self.triplet_list.triplets],
         }
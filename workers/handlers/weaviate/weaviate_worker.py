@@ -2,29 +2,37 @@ import os
 import asyncio
 import argparse
 import httpx
-import json
 from workers.prompts.weaviate_prompts import SYSTEM_PROMPT, CONTEXT, PROMPT_ID
 import logging
 import sys
+import time
 from workers.wrapper_classes.weaviate_wrapper import WeaviateWrapper, WeaviateText
 from workers.wrapper_classes.worker_wrapper import Worker
 from workers.wrapper_classes.vllm_wrapper import VLLMWrapper
+from workers.wrapper_classes.skip_index import SkipIndex
+from workers.wrapper_classes.token_budget import split_windows
 from workers.handlers.weaviate.types import TripletList, ParagraphResult
-from workers.handlers.utils.utils import dump_output
+from workers.handlers.utils.serialization import dumps
+from workers.handlers.utils.utils import MISSED_DEADLINE, NO_TRIPLETS, with_deadline
 import workers.pb.job_manager_pb2 as pb
 
 MANAGER_HOST = os.getenv("MANAGER_HOST")
 RESULT_ENDPOINT = os.getenv("RESULT_ENDPOINT")
 MODEL_NAME = os.getenv("MODEL_NAME")
 MODEL_VERSION = PROMPT_ID
+# sentences repeated between consecutive windows of a paragraph that is too long for one request
+WINDOW_OVERLAP = int(os.getenv("WINDOW_OVERLAP", "1"))
+# seconds a paragraph may take from its arrival to its triplets before it is left out of the batch, 0 waits forever
+PARAGRAPH_DEADLINE = float(os.getenv("PARAGRAPH_DEADLINE", "0"))
 
 
 async def startup(ctx: dict):
-    # initialize connections to Weaviate
-    ctx["weaviate"] = WeaviateWrapper(
-        f"http://{os.getenv('WEAVIATE_HOST')}:{os.getenv('WEAVIATE_PORT')}",
-        os.getenv("WEAVIATE_API_KEY"),
-    )
+    # initialize connections to Weaviate, unless paragraphs come from somewhere else (e.g. a file for offline runs)
+    if "weaviate" not in ctx:
+        ctx["weaviate"] = WeaviateWrapper(
+            f"http://{os.getenv('WEAVIATE_HOST')}:{os.getenv('WEAVIATE_PORT')}",
+            os.getenv("WEAVIATE_API_KEY"),
+        )
     timeout = httpx.Timeout(30.0)
     ctx["httpx_client"] = httpx.AsyncClient(timeout=timeout)
 
@@ -37,7 +45,7 @@ async def startup(ctx: dict):
         ctx["prompt"].append({"role": "assistant", "content": example[1]})
 
     # wait for vLLM server to start
-    ctx["vllm"] = VLLMWrapper(MODEL_NAME, TripletList)
+    ctx["vllm"] = VLLMWrapper(MODEL_NAME, TripletList, dispatcher=ctx.get("dispatcher"), cache=ctx.get("llm_cache"), prompt_id=PROMPT_ID, endpoints=ctx.get("vllm_endpoints"))
     await ctx["vllm"].startup()
 
     logging.info("ready to accept jobs.")
@@ -48,17 +56,50 @@ async def shutdown(ctx: dict):
     await ctx["vllm"].shutdown()
 
 
-async def request_vllm(ctx: dict, paragraph_data: WeaviateText) -> ParagraphResult:
+def merge_triplet_lists(outputs: list[TripletList | None]) -> TripletList | None:
+    # windows overlap, a triplet found in more than one of them is kept once
+    outputs = [output for output in outputs if output is not None]
+    if not outputs:
+        return None
+    triplets = {}
+    for output in outputs:
+        for triplet in output.triplets:
+            triplets.setdefault((triplet.head, triplet.tail, triplet.relationship), triplet)
+    return TripletList(reasoning=" ".join(output.reasoning for output in outputs), triplets=list(triplets.values()))
+
+
+async def request_vllm(ctx: dict, paragraph_data: WeaviateText) -> ParagraphResult | None:
     messages = ctx["prompt"].copy()
     messages.append({"role": "user", "content": paragraph_data.paragraph})
-    output = await ctx["vllm"].guided_generate(messages)
-    if not output or not output.triplets:
+    if ctx["vllm"].fits(messages):
+        output = await ctx["vllm"].guided_generate(messages)
+    else:
+        # too long for the context window next to the few-shot prefix, extract from overlapping sentence windows
+        budget = ctx["vllm"].content_budget(ctx["prompt"])
+        if budget <= 0:
+            logging.warning("few-shot prompt leaves no room for paragraph %s", paragraph_data.weaviate_id)
+            return None
+        windows = split_windows(paragraph_data.paragraph, budget, ctx["vllm"].tokens.count, WINDOW_OVERLAP)
+        logging.info("paragraph %s split into %s windows", paragraph_data.weaviate_id, len(windows))
+        outputs = await asyncio.gather(*(ctx["vllm"].guided_generate([*ctx["prompt"], {"role": "user", "content": window}]) for window in windows))
+        output = merge_triplet_lists(outputs)
+        # a paragraph only counts as having no triplets when every window came back valid
+        if output is not None and not output.triplets and any(window_output is None for window_output in outputs):
+            return None
+    if not output:
         return None
+    elif not output.triplets:
+        return NO_TRIPLETS
     else:
         return ParagraphResult(triplet_list=output, paragraph_data=paragraph_data)
 
 
-async def store_results(ctx: dict, output_list: list[ParagraphResult], run_metadata: dict, return_results: bool) -> dict | None:
+def skip_keys(kind: str, values: list[str]) -> list[bytes]:
+    # a paragraph extracted with the same model and prompt, by its Weaviate id or the hash of its text
+    return [SkipIndex.key(f"{kind}:{value}", MODEL_NAME, PROMPT_ID) for value in values]
+
+
+async def store_results(ctx: dict, output_list: list[ParagraphResult], run_metadata: dict, return_results: bool) -> bytes | None:
     # convert results into json and post to an endpoint
     serialized_results = []
     for paragraph_output in output_list:
@@ -67,20 +108,22 @@ async def store_results(ctx: dict, output_list: list[ParagraphResult], run_metad
             serialized_results.append(serialized_output)
 
     # post to Macrostrat endpoint if any triplets have been extracted in this batch
-    output_json = (
-        json.dumps(
-            {
-                "run_id": run_metadata.run_id,
-                "extraction_pipeline_id": run_metadata.pipeline_id,
-                "model_name": MODEL_NAME,
-                "model_version": MODEL_VERSION,
-                "results": serialized_results,
-            },
-            ensure_ascii=False,
-        )
-        .encode("ascii", errors="ignore")
-        .decode()  # remove non ascii characters
-    )
+    payload = {
+        "run_id": run_metadata.run_id,
+        "extraction_pipeline_id": run_metadata.pipeline_id,
+        "model_name": MODEL_NAME,
+        "model_version": MODEL_VERSION,
+        "results": serialized_results,
+    }
+    if not return_results and ctx.get("result_sink") is not None:
+        # posted or written in the background, the job finishes without waiting on the endpoint
+        await ctx["result_sink"].submit(payload)
+        # unless it is only writing local files and posting stays inside the job
+        if not ctx.get("inline_upload"):
+            return
+
+    # text fields were folded to ascii by serialize(), the payload is written straight to compact bytes
+    output_json = dumps(payload)
 
     if return_results:
         return output_json
@@ -95,17 +138,50 @@ async def process_paragraphs(
     run_metadata: dict,
     return_results: bool = False,
 ) -> dict | None:
-    paragraph_batch = job_data.paragraph_ids
-
-    # pull paragraph text from Weaviate and extract triplets using the LLM
+    paragraph_batch = list(job_data.paragraph_ids)
+    start_time = time.perf_counter()
+    first_request_time = None
+    skip_index = ctx.get("skip_index")
+    skipped = 0
+
+    # paragraphs already extracted with this model and prompt are not fetched again
+    if skip_index is not None:
+        seen = await skip_index.contains(skip_keys("weaviate_id", paragraph_batch))
+        skipped = sum(seen)
+        paragraph_batch = [paragraph_id for paragraph_id, done in zip(paragraph_batch, seen) if not done]
+
+    # pull paragraph text from Weaviate and send each paragraph to the LLM as soon as it arrives
     tasks = []
-    for paragraph_data in ctx["weaviate"].get_paragraphs_for_ids(paragraph_batch):
-        task = request_vllm(ctx, paragraph_data)
+    paragraphs = []
+    async for paragraph_data in ctx["weaviate"].stream_paragraphs_for_ids(paragraph_batch):
+        # the same text under another id is not prompted again either
+        if skip_index is not None and paragraph_data.hashed_text and (await skip_index.contains(skip_keys("hashed_text", [paragraph_data.hashed_text])))[0]:
+            skipped += 1
+            continue
+        if first_request_time is None:
+            first_request_time = time.perf_counter() - start_time
+        task = asyncio.create_task(with_deadline(request_vllm(ctx, paragraph_data), PARAGRAPH_DEADLINE, f"paragraph {paragraph_data.weaviate_id}"))
         tasks.append(task)
-    output_list = await asyncio.gather(*tasks)
+        paragraphs.append(paragraph_data)
+    outputs = await asyncio.gather(*tasks)
+    missed = sum(output is MISSED_DEADLINE for output in outputs)
+    output_list = [None if output is MISSED_DEADLINE or output is NO_TRIPLETS else output for output in outputs]
+    logging.info(
+        "extracted %s paragraphs (%s skipped as already extracted, %s missed the deadline), first LLM request after %s seconds, all done after %s seconds",
+        len(tasks),
+        skipped,
+        missed,
+        round(first_request_time or 0, 3),
+        round(time.perf_counter() - start_time, 3),
+    )
 
     # serialize results for batch and store in Macrostrat endpoint
     result = await store_results(ctx, output_list, run_metadata, return_results)
+    # recorded once the result sink has their results safe (see DeferredSkipIndex), also when they had no triplets,
+    # paragraphs that failed or missed the deadline are tried again
+    if skip_index is not None and not return_results:
+        extracted = [paragraph for paragraph, output in zip(paragraphs, outputs) if output is not None and output is not MISSED_DEADLINE]
+        await skip_index.add(skip_keys("weaviate_id", [paragraph.weaviate_id for paragraph in extracted]) + skip_keys("hashed_text", [paragraph.hashed_text for paragraph in extracted if paragraph.hashed_text]))
     if return_results:
         return result
 
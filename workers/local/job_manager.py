@@ -0,0 +1,207 @@
+import argparse
+import json
+import logging
+import sys
+import threading
+import time
+from collections import deque
+from concurrent import futures
+from typing import Iterable
+
+import grpc
+from google.protobuf import json_format
+
+import workers.pb.job_manager_pb2 as pb
+import workers.pb.job_manager_pb2_grpc as pb_grpc
+
+
+class LocalJobManager(pb_grpc.JobManagerServicer):
+    """In-memory stand-in for the coordinator so workers can be run and benchmarked offline."""
+
+    def __init__(
+        self,
+        jobs: Iterable[pb.GetJobResponse],
+        health_timeout: int = 30,
+        latency: float = 0.0,
+        run_id: str = "local",
+        pipeline_id: str = "local",
+        get_jobs: bool = True,
+        subscribe_jobs: bool = True,
+    ) -> None:
+        self.health_timeout = health_timeout
+        self.latency = latency
+        self.run_id = run_id
+        self.pipeline_id = pipeline_id
+        self.get_jobs = get_jobs
+        self.subscribe_jobs = subscribe_jobs
+
+        self.lock = threading.Lock()
+        self.available = threading.Condition(self.lock)
+        self.pending = deque()
+        self.leases = {}  # job id -> (job, lease deadline)
+        self.finished = set()
+        self.total = 0
+        self.done = threading.Event()
+        for job in jobs:
+            self.add_job(job)
+
+    def add_job(self, job: pb.GetJobResponse) -> None:
+        with self.available:
+            self.total += 1
+            job.id = self.total
+            job.type = pb.JobType.batch
+            self.pending.append(job)
+            self.done.clear()
+            self.available.notify_all()
+
+    def _simulate_latency(self) -> None:
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _requeue_expired(self) -> None:
+        # jobs whose lease was not renewed in time are handed out again
+        now = time.monotonic()
+        for job_id, (job, deadline) in list(self.leases.items()):
+            if deadline < now:
+                logging.warning("lease for job %s expired, requeueing", job_id)
+                del self.leases[job_id]
+                self.pending.appendleft(job)
+
+    def _lease(self) -> pb.GetJobResponse | None:
+        self._requeue_expired()
+        if not self.pending:
+            return None
+        job = self.pending.popleft()
+        self.leases[job.id] = (job, time.monotonic() + self.health_timeout)
+        return job
+
+    def GetJob(self, request: pb.GetJobRequest, context) -> pb.GetJobResponse:
+        self._simulate_latency()
+        with self.lock:
+            job = self._lease()
+        if job is None:
+            return pb.GetJobResponse(type=pb.JobType.wait)
+        return job
+
+    def GetJobs(self, request: pb.GetJobsRequest, context) -> pb.GetJobsResponse:
+        if not self.get_jobs:
+            context.abort(grpc.StatusCode.UNIMPLEMENTED, "GetJobs is disabled")
+        self._simulate_latency()
+        jobs = []
+        with self.lock:
+            while len(jobs) < max(request.max_jobs, 1):
+                job = self._lease()
+                if job is None:
+                    break
+                jobs.append(job)
+        return pb.GetJobsResponse(jobs=jobs)
+
+    def SubscribeJobs(self, request_iterator: Iterable[pb.SubscribeJobsRequest], context) -> Iterable[pb.GetJobResponse]:
+        if not self.subscribe_jobs:
+            context.abort(grpc.StatusCode.UNIMPLEMENTED, "SubscribeJobs is disabled")
+        credits = 0
+
+        def read_credits():
+            nonlocal credits
+            try:
+                for request in request_iterator:
+                    with self.available:
+                        credits += request.credits
+                        self.available.notify_all()
+            except grpc.RpcError:
+                pass  # worker disconnected
+
+        threading.Thread(target=read_credits, daemon=True).start()
+
+        # push a job whenever one is pending and the worker has credit left for it
+        while context.is_active():
+            with self.available:
+                job = self._lease() if credits else None
+                if job is None:
+                    # wake up periodically to requeue expired leases and notice disconnects
+                    self.available.wait(timeout=1)
+                    continue
+                credits -= 1
+            self._simulate_latency()
+            yield job
+
+    def FinishJob(self, request: pb.FinishJobRequest, context) -> pb.FinishJobResponse:
+        self._simulate_latency()
+        with self.lock:
+            self.leases.pop(request.id, None)
+            self.finished.add(request.id)
+            if len(self.finished) == self.total:
+                self.done.set()
+        return pb.FinishJobResponse()
+
+    def UpdateHealth(self, request: pb.UpdateHealthRequest, context) -> pb.UpdateHealthResponse:
+        self._simulate_latency()
+        with self.lock:
+            for job_id in [request.id, *request.ids]:
+                if job_id in self.leases:
+                    job, _ = self.leases[job_id]
+                    self.leases[job_id] = (job, time.monotonic() + self.health_timeout)
+        return pb.UpdateHealthResponse()
+
+    def GetMetadata(self, request: pb.GetMetadataRequest, context) -> pb.GetMetadataResponse:
+        self._simulate_latency()
+        return pb.GetMetadataResponse(run_id=self.run_id, pipeline_id=self.pipeline_id, health_timeout=self.health_timeout, batched_health=True)
+
+
+def serve(manager: LocalJobManager, address: str = "127.0.0.1:0", max_workers: int = 64) -> tuple[grpc.Server, int]:
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=max_workers))
+    pb_grpc.add_JobManagerServicer_to_server(manager, server)
+    port = server.add_insecure_port(address)
+    server.start()
+    return server, port
+
+
+def test_jobs(job_count: int, paragraphs_per_job: int = 1) -> Iterable[pb.GetJobResponse]:
+    for i in range(job_count):
+        paragraphs = [f"test paragraph {i}-{j}" for j in range(paragraphs_per_job)]
+        yield pb.GetJobResponse(test_data=pb.TestJob(paragraphs=paragraphs))
+
+
+def load_jobs(file_path: str) -> Iterable[pb.GetJobResponse]:
+    # each line holds the job_data oneof as json, e.g. {"weaviate_data": {"paragraph_ids": [...]}}
+    with open(file_path) as file:
+        for line in file:
+            if line.strip():
+                yield json_format.ParseDict(json.loads(line), pb.GetJobResponse())
+
+
+def main():
+    logging.basicConfig(format="[%(asctime)s] %(levelname)-8s %(message)s", level=logging.INFO, datefmt="%Y-%m-%d %H:%M:%S", stream=sys.stdout)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=50051)
+    parser.add_argument("--jobs", type=str, help="jsonl file of jobs to serve, test jobs are generated if omitted")
+    parser.add_argument("--test-jobs", type=int, default=100, help="number of test jobs to generate")
+    parser.add_argument("--health-timeout", type=int, default=30)
+    parser.add_argument("--latency", type=float, default=0.0, help="artificial delay added to every rpc in seconds")
+    parser.add_argument("--no-get-jobs", action="store_true", help="reject GetJobs like an older coordinator would")
+    parser.add_argument("--no-subscribe-jobs", action="store_true", help="reject SubscribeJobs so workers fall back to polling")
+    parser.add_argument("--add-interval", type=float, default=0.0, help="trickle test jobs in one at a time with this delay instead of serving them upfront")
+    args = parser.parse_args()
+
+    jobs = load_jobs(args.jobs) if args.jobs else test_jobs(args.test_jobs)
+    manager = LocalJobManager(
+        jobs if not args.add_interval else [],
+        health_timeout=args.health_timeout,
+        latency=args.latency,
+        get_jobs=not args.no_get_jobs,
+        subscribe_jobs=not args.no_subscribe_jobs,
+    )
+    server, port = serve(manager, f"0.0.0.0:{args.port}")
+    logging.info("serving %s jobs on port %s", manager.total, port)
+    for job in jobs if args.add_interval else []:
+        time.sleep(args.add_interval)
+        manager.add_job(job)
+        logging.info("added job %s", job.id)
+    manager.done.wait()
+    logging.info("all jobs finished")
+    server.stop(grace=1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,268 @@
+import argparse
+import json
+import logging
+import random
+import re
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_RESPONSE = json.dumps({"reasoning": "No relevant triplets are mentioned in the text.", "triplets": []})
+# rough stand-in for a tokenizer, a token is up to four characters with the whitespace before them
+TOKEN = re.compile(r"\s*\S{1,4}|\s+")
+
+
+class MockVLLM:
+    """Imitates the parts of the vLLM OpenAI server the workers use, with a simple continuous batching model.
+
+    At most `capacity` requests run at once, everything above that waits like it would in the vLLM scheduler,
+    and every running request slows down a little for each other request in the batch. With `token_latency`
+    the time also grows with every generated token, and `trailing_tokens` makes the model ramble on after the
+    response until it hits max_tokens, which streaming clients can cut short. A `straggler_rate` share of
+    requests is stuck for another `straggler_latency` seconds before its first token.
+    """
+
+    def __init__(
+        self,
+        model_name: str = "mock-model",
+        capacity: int = 16,
+        latency: float = 0.5,
+        batch_penalty: float = 0.02,
+        response: str = DEFAULT_RESPONSE,
+        max_model_len: int = 4096,
+        token_latency: float = 0.0,
+        trailing_tokens: int = 0,
+        straggler_rate: float = 0.0,
+        straggler_latency: float = 0.0,
+        seed: int | None = None,
+    ) -> None:
+        self.model_name = model_name
+        self.capacity = capacity
+        self.latency = latency
+        self.batch_penalty = batch_penalty
+        self.response = response
+        self.max_model_len = max_model_len
+        self.token_latency = token_latency
+        self.trailing_tokens = trailing_tokens
+        self.straggler_rate = straggler_rate
+        self.straggler_latency = straggler_latency
+        self.random = random.Random(seed)
+
+        self.lock = threading.Lock()
+        self.batch = threading.Semaphore(capacity)
+        self.running = 0
+        self.waiting = 0
+        self.latency_sum = 0.0
+        self.request_count = 0
+        self.generated_tokens = 0
+        self.rejected = 0
+
+    def check_length(self, request: dict) -> str | None:
+        # the error vLLM returns for a prompt and max_tokens that do not fit the context window
+        prompt_tokens = sum(len(TOKEN.findall(message["content"])) + 8 for message in request["messages"])
+        max_tokens = request.get("max_tokens") or 0
+        if prompt_tokens + max_tokens <= self.max_model_len:
+            return None
+        with self.lock:
+            self.rejected += 1
+        return (
+            f"This model's maximum context length is {self.max_model_len} tokens. However, you requested {prompt_tokens + max_tokens} tokens "
+            f"({prompt_tokens} in the messages, {max_tokens} in the completion). Please reduce the length of the messages or completion."
+        )
+
+    def tokens(self, request: dict) -> list[str]:
+        tokens = TOKEN.findall(self.response) + ["\n"] * self.trailing_tokens
+        return tokens[: request.get("max_tokens") or len(tokens)]
+
+    def straggle(self) -> float:
+        with self.lock:
+            return self.straggler_latency if self.random.random() < self.straggler_rate else 0.0
+
+    @contextmanager
+    def batch_slot(self):
+        # waits for a place in the batch, yields how much slower the batch makes this request
+        start = time.monotonic()
+        with self.lock:
+            self.waiting += 1
+        self.batch.acquire()
+        with self.lock:
+            self.waiting -= 1
+            self.running += 1
+            slowdown = 1 + self.batch_penalty * self.running
+        try:
+            yield slowdown
+        finally:
+            with self.lock:
+                self.running -= 1
+                self.latency_sum += time.monotonic() - start
+                self.request_count += 1
+            self.batch.release()
+
+    def complete(self, request: dict) -> str:
+        tokens = self.tokens(request)
+        with self.batch_slot() as slowdown:
+            time.sleep((self.latency + self.token_latency * len(tokens)) * slowdown + self.straggle())
+            with self.lock:
+                self.generated_tokens += len(tokens)
+        return "".join(tokens)
+
+    def stream(self, request: dict):
+        # yields tokens as they are generated, closing the generator aborts the request like a client disconnect does in vLLM
+        with self.batch_slot() as slowdown:
+            time.sleep(self.latency * slowdown + self.straggle())
+            for token in self.tokens(request):
+                time.sleep(self.token_latency * slowdown)
+                with self.lock:
+                    self.generated_tokens += 1
+                yield token
+
+    def metrics(self) -> str:
+        with self.lock:
+            labels = f'{{model_name="{self.model_name}"}}'
+            return "\n".join(
+                [
+                    "# TYPE vllm:num_requests_running gauge",
+                    f"vllm:num_requests_running{labels} {float(self.running)}",
+                    "# TYPE vllm:num_requests_waiting gauge",
+                    f"vllm:num_requests_waiting{labels} {float(self.waiting)}",
+                    "# TYPE vllm:e2e_request_latency_seconds histogram",
+                    f"vllm:e2e_request_latency_seconds_sum{labels} {self.latency_sum}",
+                    f"vllm:e2e_request_latency_seconds_count{labels} {float(self.request_count)}",
+                    "# TYPE vllm:generation_tokens_total counter",
+                    f"vllm:generation_tokens_total{labels} {float(self.generated_tokens)}",
+                    "",
+                ]
+            )
+
+
+class MockVLLMHandler(BaseHTTPRequestHandler):
+    server: "MockVLLMServer"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, body: str, content_type: str = "application/json", status: int = 200):
+        data = body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        mock = self.server.mock
+        if self.path == "/health":
+            self.send_body("")
+        elif self.path == "/metrics":
+            self.send_body(mock.metrics(), content_type="text/plain")
+        elif self.path == "/v1/models":
+            self.send_body(json.dumps({"object": "list", "data": [{"id": mock.model_name, "object": "model", "max_model_len": mock.max_model_len}]}))
+        else:
+            self.send_body(json.dumps({"error": "not found"}), status=404)
+
+    def do_POST(self):
+        if self.path != "/v1/chat/completions":
+            self.send_body(json.dumps({"error": "not found"}), status=404)
+            return
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        error = self.server.mock.check_length(request)
+        if error:
+            self.send_body(json.dumps({"object": "error", "message": error, "type": "BadRequestError", "param": None, "code": 400}), status=400)
+            return
+        if request.get("stream"):
+            self.send_stream(request)
+            return
+        content = self.server.mock.complete(request)
+        self.send_body(
+            json.dumps(
+                {
+                    "id": "cmpl-mock",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": request.get("model"),
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                    "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+                }
+            )
+        )
+
+
+    def send_stream(self, request: dict):
+        # server sent events like the OpenAI api, the response ends when the connection closes
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+
+        def event(delta: dict, finish_reason: str | None = None) -> bytes:
+            chunk = {"id": "cmpl-mock", "object": "chat.completion.chunk", "created": int(time.time()), "model": request.get("model"), "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+            return f"data: {json.dumps(chunk)}\n\n".encode()
+
+        tokens = self.server.mock.stream(request)
+        try:
+            self.wfile.write(event({"role": "assistant", "content": ""}))
+            for token in tokens:
+                self.wfile.write(event({"content": token}))
+                self.wfile.flush()
+            self.wfile.write(event({}, "stop"))
+            self.wfile.write(b"data: [DONE]\n\n")
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            tokens.close()
+
+
+class MockVLLMServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # the default listen backlog of 5 drops connections of concurrent requests, which then wait a second for the retry
+    request_queue_size = 1024
+
+    def __init__(self, mock: MockVLLM, address: tuple[str, int] = ("127.0.0.1", 0)) -> None:
+        super().__init__(address, MockVLLMHandler)
+        self.mock = mock
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def handle_error(self, request, client_address) -> None:
+        # clients that give up on a request, like a hedged or timed out one, close the connection
+        if isinstance(sys.exc_info()[1], ConnectionError):
+            return
+        super().handle_error(request, client_address)
+
+    def start(self) -> "MockVLLMServer":
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+def main():
+    logging.basicConfig(format="[%(asctime)s] %(levelname)-8s %(message)s", level=logging.INFO, datefmt="%Y-%m-%d %H:%M:%S", stream=sys.stdout)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--model-name", type=str, default="mock-model")
+    parser.add_argument("--capacity", type=int, default=16, help="requests generated at once, the rest wait")
+    parser.add_argument("--latency", type=float, default=0.5, help="seconds per request when running alone")
+    parser.add_argument("--response", type=str, help="file with the completion to return for every request")
+    parser.add_argument("--token-latency", type=float, default=0.0, help="seconds per generated token")
+    parser.add_argument("--trailing-tokens", type=int, default=0, help="tokens generated after the response, up to max_tokens")
+    parser.add_argument("--straggler-rate", type=float, default=0.0, help="share of requests that are stuck before their first token")
+    parser.add_argument("--straggler-latency", type=float, default=0.0, help="seconds a straggler is stuck")
+    args = parser.parse_args()
+
+    response = DEFAULT_RESPONSE
+    if args.response:
+        with open(args.response) as file:
+            response = file.read()
+    mock = MockVLLM(model_name=args.model_name, capacity=args.capacity, latency=args.latency, response=response, token_latency=args.token_latency, trailing_tokens=args.trailing_tokens, straggler_rate=args.straggler_rate, straggler_latency=args.straggler_latency)
+    server = MockVLLMServer(mock, ("0.0.0.0", args.port))
+    logging.info("mock vLLM server listening on port %s", args.port)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
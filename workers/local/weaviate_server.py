@@ -0,0 +1,123 @@
+import argparse
+import hashlib
+import json
+import logging
+import re
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ID_PATTERN = re.compile(r'valueText:\s*"([^"]+)"')
+
+
+class MockWeaviate:
+    """Serves Paragraph objects over the parts of the Weaviate REST and GraphQL api the workers use.
+
+    Every GraphQL query costs `latency` seconds plus `latency_per_object` for each object returned,
+    and the number of queries is counted so round trips can be compared.
+    """
+
+    def __init__(self, paragraphs: dict[str, dict], latency: float = 0.005, latency_per_object: float = 0.0) -> None:
+        self.paragraphs = paragraphs
+        self.latency = latency
+        self.latency_per_object = latency_per_object
+        self.lock = threading.Lock()
+        self.queries = 0
+
+    def query(self, query: str) -> dict:
+        # only `id` filters are supported, which is all the workers send
+        ids = ID_PATTERN.findall(query)
+        objects = []
+        for paragraph_id in ids:
+            if paragraph_id in self.paragraphs:
+                objects.append({**self.paragraphs[paragraph_id], "_additional": {"id": paragraph_id}})
+        with self.lock:
+            self.queries += 1
+        time.sleep(self.latency + self.latency_per_object * len(objects))
+        return {"data": {"Get": {"Paragraph": objects}}}
+
+
+def generate_paragraphs(count: int, seed: int = 0) -> dict[str, dict]:
+    paragraphs = {}
+    for i in range(count):
+        paragraph_id = str(uuid.UUID(int=seed * 1_000_000_007 + i))
+        text = f"Paragraph {i}: the formation consists of gray shale interbedded with thin beds of fine grained sandstone."
+        paragraphs[paragraph_id] = {
+            "preprocessor_id": "mock",
+            "paper_id": f"paper-{i // 20}",
+            "hashed_text": hashlib.sha256(text.encode()).hexdigest(),
+            "text_content": text,
+        }
+    return paragraphs
+
+
+class MockWeaviateHandler(BaseHTTPRequestHandler):
+    server: "MockWeaviateServer"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, body: dict, status: int = 200):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/v1/meta":
+            self.send_json({"hostname": "mock", "version": "1.24.0", "modules": {}})
+        elif self.path == "/v1/.well-known/ready":
+            self.send_json({})
+        else:
+            self.send_json({"error": "not found"}, status=404)
+
+    def do_POST(self):
+        if self.path != "/v1/graphql":
+            self.send_json({"error": "not found"}, status=404)
+            return
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.send_json(self.server.mock.query(request["query"]))
+
+
+class MockWeaviateServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, mock: MockWeaviate, address: tuple[str, int] = ("127.0.0.1", 0)) -> None:
+        super().__init__(address, MockWeaviateHandler)
+        self.mock = mock
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "MockWeaviateServer":
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+def main():
+    logging.basicConfig(format="[%(asctime)s] %(levelname)-8s %(message)s", level=logging.INFO, datefmt="%Y-%m-%d %H:%M:%S", stream=sys.stdout)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--paragraphs", type=int, default=1000, help="number of generated paragraphs to serve")
+    parser.add_argument("--latency", type=float, default=0.005, help="seconds per query")
+    parser.add_argument("--ids-out", type=str, help="write the generated paragraph ids to this file")
+    args = parser.parse_args()
+
+    paragraphs = generate_paragraphs(args.paragraphs)
+    if args.ids_out:
+        with open(args.ids_out, "w") as file:
+            file.write("\n".join(paragraphs))
+    server = MockWeaviateServer(MockWeaviate(paragraphs, latency=args.latency), ("0.0.0.0", args.port))
+    logging.info("mock Weaviate server with %s paragraphs listening on port %s", len(paragraphs), args.port)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
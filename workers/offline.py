@@ -0,0 +1,240 @@
+import argparse
+import asyncio
+import glob
+import json
+import logging
+import os
+import sys
+import time
+from itertools import islice
+from typing import AsyncIterator, Iterable, Iterator
+
+import workers.handlers.map_descriptions.map_worker as map_worker
+import workers.handlers.weaviate.weaviate_worker as weaviate_worker
+import workers.pb.job_manager_pb2 as pb
+from workers.worker import create_handlers
+from workers.wrapper_classes.llm_cache import LLMCache
+from workers.wrapper_classes.llm_dispatcher import LLMDispatcher, current_job
+from workers.wrapper_classes.result_sink import FORMATS, ArrowResultSink
+from workers.wrapper_classes.skip_index import DeferredSkipIndex, SkipIndex
+from workers.wrapper_classes.vllm_endpoints import VLLM_ENDPOINTS, EndpointPool, parse_endpoints
+from workers.wrapper_classes.weaviate_wrapper import WeaviateText
+from workers.wrapper_classes.worker_wrapper import Metadata
+
+JOB_TYPES = ("weaviate_data", "map_description_data")
+
+
+def read_records(path: str) -> Iterator[dict]:
+    # one dict per line of a jsonl file or per row of a parquet file, read a chunk at a time
+    if path.endswith(".parquet"):
+        import pyarrow.parquet as pq
+
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=10_000):
+            yield from batch.to_pylist()
+        return
+    with open(path) as file:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+
+
+def batches(records: Iterable[dict], size: int) -> Iterator[list[dict]]:
+    records = iter(records)
+    while batch := list(islice(records, size)):
+        yield batch
+
+
+def paragraph_text(record: dict) -> WeaviateText:
+    # the Paragraph fields of a Weaviate export, text_content and id are also accepted under their Weaviate names
+    return WeaviateText(
+        preprocessor_id=record.get("preprocessor_id", ""),
+        paper_id=record.get("paper_id", ""),
+        hashed_text=record.get("hashed_text", ""),
+        weaviate_id=record.get("weaviate_id") or record["id"],
+        paragraph=record.get("paragraph") or record["text_content"],
+    )
+
+
+class LocalParagraphs:
+    """Stands in for the Weaviate wrapper, serving the paragraphs of the jobs that are running from memory."""
+
+    def __init__(self) -> None:
+        self.paragraphs = {}
+
+    def add(self, paragraphs: list[WeaviateText]) -> list[str]:
+        for paragraph in paragraphs:
+            self.paragraphs[paragraph.weaviate_id] = paragraph
+        return [paragraph.weaviate_id for paragraph in paragraphs]
+
+    def remove(self, ids: list[str]) -> None:
+        for paragraph_id in ids:
+            self.paragraphs.pop(paragraph_id, None)
+
+    async def stream_paragraphs_for_ids(self, ids_to_load: Iterable[str]) -> AsyncIterator[WeaviateText]:
+        for paragraph_id in ids_to_load:
+            if paragraph_id in self.paragraphs:
+                yield self.paragraphs[paragraph_id]
+
+
+class Checkpoint:
+    """Batches of the input whose results are in completed result files, saved next to the input.
+
+    Jobs finish out of order, so the checkpoint keeps the number of leading batches that are all done
+    plus the done batches after them. A batch is only marked done once the result sink has its rows in a
+    completed file, a crash can repeat a batch but never lose one.
+    """
+
+    def __init__(self, path: str, input_path: str, batch_size: int) -> None:
+        self.path = path
+        self.input_path = input_path
+        self.batch_size = batch_size
+        self.done_before = 0
+        self.done = set()
+        self.pending = []  # (batch, jobs the sink must have made durable)
+        if os.path.exists(path):
+            with open(path) as file:
+                state = json.load(file)
+            if state["batch_size"] != batch_size:
+                raise ValueError(f"checkpoint {path} was written with --batch-size {state['batch_size']}, resume with the same batch size")
+            self.done_before = state["done_before"]
+            self.done = set(state["done"])
+
+    def is_done(self, batch: int) -> bool:
+        return batch < self.done_before or batch in self.done
+
+    def finished(self, batch: int, sink: ArrowResultSink) -> None:
+        # the job has handed its results to the sink, they are durable once the sink has written this many jobs
+        self.pending.append((batch, sink.counts["jobs"]))
+
+    def update(self, sink: ArrowResultSink) -> bool:
+        durable = [batch for batch, jobs in self.pending if jobs <= sink.durable_jobs]
+        if not durable:
+            return False
+        self.pending = [(batch, jobs) for batch, jobs in self.pending if jobs > sink.durable_jobs]
+        self.done.update(durable)
+        while self.done_before in self.done:
+            self.done.remove(self.done_before)
+            self.done_before += 1
+        self.save()
+        return True
+
+    def save(self) -> None:
+        state = {"input": self.input_path, "batch_size": self.batch_size, "done_before": self.done_before, "done": sorted(self.done)}
+        with open(self.path + ".tmp", "w") as file:
+            json.dump(state, file)
+        os.replace(self.path + ".tmp", self.path)
+
+    @property
+    def batches_done(self) -> int:
+        return self.done_before + len(self.done)
+
+
+async def run_offline(args: argparse.Namespace) -> None:
+    # partial files of a run that was killed, their batches are not in the checkpoint and run again
+    for path in glob.glob(os.path.join(args.output, "*.tmp")):
+        logging.warning("removing incomplete result file %s", path)
+        os.remove(path)
+
+    sink = ArrowResultSink(args.output, args.output_format, rows_per_file=args.rows_per_file)
+    sink.start()
+    endpoints = EndpointPool(parse_endpoints(args.vllm_endpoints))
+    dispatcher = LLMDispatcher(max_in_flight=args.max_in_flight)
+    cache = LLMCache(args.llm_cache) if args.llm_cache else None
+    skip_index = DeferredSkipIndex(SkipIndex(args.skip_index), sink) if args.skip_index else None
+    shared = {"dispatcher": dispatcher, "llm_cache": cache, "vllm_endpoints": endpoints, "result_sink": sink, "skip_index": skip_index}
+    paragraphs = None
+    if args.job_type == "weaviate_data" and not args.fetch_from_weaviate:
+        paragraphs = shared["weaviate"] = LocalParagraphs()
+    handler = (await create_handlers(shared))[args.job_type]
+    await handler.ensure_intialized()
+
+    checkpoint = Checkpoint(args.checkpoint or args.input + ".checkpoint", args.input, args.batch_size)
+    metadata = Metadata(run_id=args.run_id, pipeline_id=args.pipeline_id)
+    slots = asyncio.Semaphore(args.jobs_in_flight)
+    tasks = set()
+    counts = {"jobs": 0, "failed": 0, "records": 0, "skipped": 0}
+    start = time.perf_counter()
+
+    async def run_job(batch: int, records: list[dict]) -> None:
+        # jobs take turns at the dispatcher like jobs from the manager do
+        current_job.set(batch)
+        ids = []
+        try:
+            if args.job_type == "weaviate_data":
+                if paragraphs is not None:
+                    ids = paragraphs.add([paragraph_text(record) for record in records])
+                else:
+                    ids = [record.get("weaviate_id") or record["id"] for record in records]
+                job_data = pb.WeaviateJob(paragraph_ids=ids)
+            else:
+                job_data = pb.MapDescriptionJob(descriptions=[pb.MapDescription(legend_id=int(record["legend_id"]), text=record["text"]) for record in records])
+            await handler.process_job(handler.ctx, job_data, metadata, False)
+            checkpoint.finished(batch, sink)
+            counts["jobs"] += 1
+            counts["records"] += len(records)
+        except Exception:
+            logging.exception("batch %s failed, it runs again on the next resume", batch)
+            counts["failed"] += 1
+        finally:
+            if paragraphs is not None:
+                paragraphs.remove(ids)
+            slots.release()
+        if skip_index:
+            await skip_index.update()
+        if checkpoint.update(sink) or counts["jobs"] % args.log_every == 0:
+            elapsed = time.perf_counter() - start
+            logging.info("%s records in %s jobs, %s records/s, %s batches checkpointed, sink %s", counts["records"], counts["jobs"], round(counts["records"] / elapsed, 1), checkpoint.batches_done, sink.stats())
+
+    try:
+        for batch, records in enumerate(batches(read_records(args.input), args.batch_size)):
+            if checkpoint.is_done(batch):
+                counts["skipped"] += len(records)
+                continue
+            # reading stays at most jobs_in_flight batches ahead of the handlers
+            await slots.acquire()
+            task = asyncio.create_task(run_job(batch, records))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        await asyncio.gather(*tasks)
+    finally:
+        # whatever finished is written and checkpointed, also when interrupted
+        await sink.close()
+        checkpoint.update(sink)
+        await handler.shutdown_if_initialized()
+        await endpoints.close()
+        if cache:
+            cache.close()
+        if skip_index:
+            await skip_index.update()
+            skip_index.close()
+    logging.info("done: %s, %s batches checkpointed, sink %s, skip index %s, %s seconds", counts, checkpoint.batches_done, sink.stats(), skip_index.stats() if skip_index else None, round(time.perf_counter() - start, 1))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run paragraphs or map descriptions from a local JSONL or Parquet file through the handlers, without the job manager")
+    parser.add_argument("job_type", choices=JOB_TYPES, help="Handler to run the records through")
+    parser.add_argument("input", type=str, help="JSONL or Parquet file, paragraphs need weaviate_id and paragraph (or id and text_content), map descriptions legend_id and text")
+    parser.add_argument("--output", type=str, default="out/results", help="Directory result files are written to")
+    parser.add_argument("--output-format", choices=list(FORMATS), default="parquet")
+    parser.add_argument("--rows-per-file", type=int, default=100_000, help="Triplets per result file, batches are checkpointed as their files are completed")
+    parser.add_argument("--checkpoint", type=str, help="Checkpoint file, defaults to the input path with .checkpoint appended")
+    parser.add_argument("--batch-size", type=int, default=64, help="Records per job")
+    parser.add_argument("--jobs-in-flight", type=int, default=16, help="Jobs running at once")
+    parser.add_argument("--max-in-flight", type=int, default=64, help="Max LLM requests in flight across all jobs")
+    parser.add_argument("--vllm-endpoints", type=str, default=VLLM_ENDPOINTS, help="Comma separated vLLM server urls")
+    parser.add_argument("--llm-cache", type=str, help="SQLite file to cache LLM outputs in, disabled if omitted")
+    parser.add_argument("--skip-index", type=str, help="SQLite file of items already extracted per model and prompt, shared with the workers, disabled if omitted")
+    parser.add_argument("--fetch-from-weaviate", action="store_true", help="Only read paragraph ids from the input and fetch the text from Weaviate")
+    parser.add_argument("--run-id", type=str, default="offline")
+    parser.add_argument("--pipeline-id", type=str, default="offline")
+    parser.add_argument("--log-every", type=int, default=100, help="Log progress every this many jobs")
+    args = parser.parse_args()
+    if not parse_endpoints(args.vllm_endpoints):
+        parser.error("--vllm-endpoints (VLLM_ENDPOINTS) needs at least one url")
+    # an item left out for running late would still have its batch checkpointed and never be retried
+    if (args.job_type == "weaviate_data" and weaviate_worker.PARAGRAPH_DEADLINE) or (args.job_type == "map_description_data" and map_worker.DESCRIPTION_DEADLINE):
+        parser.error("PARAGRAPH_DEADLINE and DESCRIPTION_DEADLINE drop items that run late, unset them for offline runs")
+
+    logging.basicConfig(format="[%(asctime)s] %(levelname)-8s %(message)s", level=logging.INFO, datefmt="%Y-%m-%d %H:%M:%S", stream=sys.stdout)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    asyncio.run(run_offline(args))
@@ -4,6 +4,13 @@ import logging
 import sys
 import os
 from workers.wrapper_classes.worker_wrapper import Worker, Metadata
+from workers.wrapper_classes.concurrency_controller import ConcurrencyController
+from workers.wrapper_classes.llm_dispatcher import LLMDispatcher
+from workers.wrapper_classes.llm_cache import LLMCache
+from workers.wrapper_classes.result_sink import FORMATS, ArrowResultSink, ResultSinks
+from workers.wrapper_classes.result_uploader import ResultUploader
+from workers.wrapper_classes.skip_index import DeferredSkipIndex, SkipIndex
+from workers.wrapper_classes.vllm_endpoints import VLLM_ENDPOINTS, EndpointPool, parse_endpoints
 import workers.pb.job_manager_pb2 as pb
 from typing import Callable, Awaitable
 import workers.handlers.weaviate.weaviate_worker as weaviate_worker
@@ -16,6 +23,7 @@ class Handler:
     startup: Callable[[dict], Awaitable[None]]
     shutdown: Callable[[dict], Awaitable[None]]
     process_job: Callable[[dict, any, Metadata, bool], Awaitable[dict | None]]
+    shared: dict[str, any]
     has_initialized: bool
 
     def __init__(
@@ -23,14 +31,17 @@ class Handler:
         startup: Callable[[dict], Awaitable[None]],
         shutdown: Callable[[dict], Awaitable[None]],
         process_job: Callable[[dict, any, Metadata, bool], Awaitable[dict | None]],
+        shared: dict[str, any] = {},
     ):
         self.startup = startup
         self.shutdown = shutdown
         self.process_job = process_job
+        self.shared = shared
         self.has_initialized = False
 
     async def initialize_ctx(self) -> None:
-        self.ctx = {}
+        # resources shared by all handlers (e.g. the LLM dispatcher) are seeded into every handler ctx
+        self.ctx = dict(self.shared)
         await self.startup(self.ctx)
 
     async def ensure_intialized(self) -> None:
@@ -52,6 +63,20 @@ async def route_handlers(ctx: dict, job: pb.GetJobResponse, metadata: Metadata,
     handler = ctx["handlers"][job_type]
     await handler.ensure_intialized()
     await handler.process_job(handler.ctx, job_data, metadata, return_results)
+    if ctx.get("llm_cache"):
+        logging.info("llm cache: %s", ctx["llm_cache"].stats())
+    if "vllm" in handler.ctx:
+        logging.info("%s decoding: %s", job_type, handler.ctx["vllm"].policy.stats())
+        if handler.ctx["vllm"].hedging is not None:
+            logging.info("%s hedging: %s", job_type, handler.ctx["vllm"].hedging.stats())
+    if ctx.get("vllm_endpoints"):
+        logging.info("vllm endpoints: %s", ctx["vllm_endpoints"].stats())
+    if ctx.get("result_sink"):
+        logging.info("result sink: %s", ctx["result_sink"].stats())
+    if ctx.get("skip_index"):
+        if isinstance(ctx["skip_index"], DeferredSkipIndex):
+            await ctx["skip_index"].update()
+        logging.info("skip index: %s", ctx["skip_index"].stats())
 
 
 async def shutdown_handlers(ctx: dict) -> None:
@@ -59,37 +84,153 @@ async def shutdown_handlers(ctx: dict) -> None:
         await handler.shutdown_if_initialized()
 
 
-async def run_workers(worker_count: int) -> None:
+async def run_workers(
+    worker_count: int,
+    prefetch_count: int,
+    job_delivery: str,
+    controller: ConcurrencyController | None,
+    dispatcher: LLMDispatcher,
+    dispatch_controller: ConcurrencyController | None,
+    llm_cache: LLMCache | None,
+    endpoints: EndpointPool,
+    result_sink: ResultUploader | ArrowResultSink | ResultSinks | None,
+    skip_index: SkipIndex | DeferredSkipIndex | None,
+    inline_upload: bool,
+) -> None:
     ctx = {
-        "handlers": await create_handlers(),
+        "handlers": await create_handlers({"dispatcher": dispatcher, "llm_cache": llm_cache, "vllm_endpoints": endpoints, "result_sink": result_sink, "skip_index": skip_index, "inline_upload": inline_upload}),
+        "llm_cache": llm_cache,
+        "vllm_endpoints": endpoints,
+        "result_sink": result_sink,
+        "skip_index": skip_index,
     }
-    worker = Worker(os.getenv("MANAGER_HOST"), ctx=ctx)
+    worker = Worker(os.getenv("MANAGER_HOST"), ctx=ctx, job_delivery=job_delivery)
+    dispatch_task = asyncio.create_task(dispatch_controller.run(dispatcher)) if dispatch_controller else None
     try:
-        await worker.run_pool(route_handlers, worker_count)
+        await worker.run_pool(route_handlers, worker_count, prefetch_count, controller)
     except Exception as e:
         logging.exception("shutting down after error occurred: %s", e)
         await shutdown_handlers(ctx)
-
-
-async def create_handlers() -> dict[str, Handler]:
+    finally:
+        if dispatch_task:
+            dispatch_task.cancel()
+        if result_sink:
+            # results still queued are posted, spooled or written before exiting
+            await result_sink.close()
+            logging.info("result sink: %s", result_sink.stats())
+            if isinstance(skip_index, DeferredSkipIndex):
+                await skip_index.update()
+        if llm_cache:
+            llm_cache.close()
+        if skip_index:
+            skip_index.close()
+        await endpoints.close()
+        await worker.close()
+
+
+async def create_handlers(shared: dict) -> dict[str, Handler]:
     handlers = {
-        "weaviate_data": Handler(startup=weaviate_worker.startup, shutdown=weaviate_worker.shutdown, process_job=weaviate_worker.process_paragraphs),
-        "map_description_data": Handler(startup=map_worker.startup, shutdown=map_worker.shutdown, process_job=map_worker.process_descriptions),
-        "test_data": Handler(startup=test_worker.startup, shutdown=test_worker.shutdown, process_job=test_worker.process_text),
+        "weaviate_data": Handler(startup=weaviate_worker.startup, shutdown=weaviate_worker.shutdown, process_job=weaviate_worker.process_paragraphs, shared=shared),
+        "map_description_data": Handler(startup=map_worker.startup, shutdown=map_worker.shutdown, process_job=map_worker.process_descriptions, shared=shared),
+        "test_data": Handler(startup=test_worker.startup, shutdown=test_worker.shutdown, process_job=test_worker.process_text, shared=shared),
     }
     return handlers
 
 
-async def main(worker_count: int):
+async def main(
+    worker_count: int,
+    prefetch_count: int,
+    job_delivery: str,
+    adaptive: bool,
+    min_workers: int,
+    max_workers: int,
+    max_in_flight: int,
+    max_queued: int,
+    adaptive_in_flight: bool,
+    vllm_endpoints: str,
+    vllm_metrics_url: str | None,
+    llm_cache: str | None,
+    llm_cache_max_entries: int,
+    refresh_cache: bool,
+    result_spool: str,
+    upload_batch: int,
+    inline_upload: bool,
+    local_results: str | None,
+    local_results_format: str,
+    local_results_only: bool,
+    skip_index: str | None,
+    skip_index_capacity: int,
+):
     logging.basicConfig(format="[%(asctime)s] %(levelname)-8s %(message)s", level=logging.INFO, datefmt="%Y-%m-%d %H:%M:%S", stream=sys.stdout)
     logging.getLogger("httpx").setLevel(logging.WARNING)
 
-    await run_workers(worker_count)
+    # every handler sends its LLM requests to the least busy of these servers
+    endpoints = EndpointPool(parse_endpoints(vllm_endpoints))
+    metrics_urls = [vllm_metrics_url] if vllm_metrics_url else endpoints.metrics_urls
+
+    controller = None
+    if adaptive:
+        controller = ConcurrencyController(metrics_urls, min_limit=min_workers, max_limit=max_workers)
+
+    # every LLM request of every job goes through one dispatcher
+    dispatcher = LLMDispatcher(max_in_flight=max_in_flight, max_queued=max_queued)
+    dispatch_controller = None
+    if adaptive_in_flight:
+        dispatch_controller = ConcurrencyController(metrics_urls, min_limit=1, max_limit=max_in_flight)
+
+    # validated LLM outputs are reused across jobs and runs
+    cache = LLMCache(llm_cache, max_entries=llm_cache_max_entries, bypass=refresh_cache) if llm_cache else None
+
+    # results are posted in the background, merged across jobs of a run, and/or written to local files
+    sinks = []
+    if os.getenv("RESULT_ENDPOINT") and not inline_upload and not local_results_only:
+        sinks.append(ResultUploader(os.getenv("RESULT_ENDPOINT"), result_spool, max_results=upload_batch))
+    if local_results:
+        sinks.append(ArrowResultSink(local_results, local_results_format))
+    # with --inline-upload the handlers still post themselves, next to any local files
+    inline_upload = bool(os.getenv("RESULT_ENDPOINT")) and inline_upload and not local_results_only
+    result_sink = None
+    if sinks:
+        result_sink = sinks[0] if len(sinks) == 1 else ResultSinks(sinks)
+        result_sink.start()
+
+    # paragraphs and descriptions already extracted with the same model and prompt are skipped
+    # items are only recorded once the result sink has their results posted, spooled or in a completed file
+    index = SkipIndex(skip_index, capacity=skip_index_capacity) if skip_index else None
+    if index and result_sink:
+        index = DeferredSkipIndex(index, result_sink)
+
+    await run_workers(worker_count, prefetch_count, job_delivery, controller, dispatcher, dispatch_controller, cache, endpoints, result_sink, index, inline_upload)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--worker-count", type=int, default=4, help="Number of workers to run")
+    parser.add_argument("--prefetch-count", type=int, default=0, help="Number of jobs to lease ahead of the workers")
+    parser.add_argument("--job-delivery", choices=["stream", "poll"], default="stream", help="Receive jobs pushed by the manager or poll for them")
+    parser.add_argument("--adaptive", action="store_true", help="Scale the number of running jobs with vLLM load, starting from --worker-count")
+    parser.add_argument("--min-workers", type=int, default=1, help="Lower bound for --adaptive")
+    parser.add_argument("--max-workers", type=int, default=32, help="Upper bound for --adaptive")
+    parser.add_argument("--max-in-flight", type=int, default=64, help="Max LLM requests in flight across all jobs")
+    parser.add_argument("--max-queued", type=int, default=1024, help="Max LLM requests waiting for the dispatcher before jobs are held back")
+    parser.add_argument("--adaptive-in-flight", action="store_true", help="Scale LLM requests in flight with vLLM load, up to --max-in-flight")
+    parser.add_argument("--vllm-endpoints", type=str, default=VLLM_ENDPOINTS, help="Comma separated vLLM server urls, requests go to the one with the fewest outstanding")
+    parser.add_argument("--vllm-metrics-url", type=str, help="vLLM metrics endpoint read by --adaptive and --adaptive-in-flight, defaults to /metrics of every endpoint")
+    parser.add_argument("--llm-cache", type=str, help="SQLite file to cache LLM outputs in, disabled if omitted")
+    parser.add_argument("--llm-cache-max-entries", type=int, default=1_000_000, help="Least recently used outputs are evicted above this")
+    parser.add_argument("--refresh-cache", action="store_true", help="Ignore cached outputs and extract again, the cache is still updated")
+    parser.add_argument("--result-spool", type=str, default=os.getenv("RESULT_SPOOL_DIR", "spool"), help="Directory results are kept in while the results endpoint is down")
+    parser.add_argument("--upload-batch", type=int, default=1000, help="Max results per post to the results endpoint")
+    parser.add_argument("--inline-upload", action="store_true", help="Post the results of every job before it finishes instead of in the background")
+    parser.add_argument("--local-results", type=str, help="Directory to also write results to as rotating files, one row per triplet")
+    parser.add_argument("--local-results-format", choices=list(FORMATS), default="parquet", help="File format of --local-results")
+    parser.add_argument("--local-results-only", action="store_true", help="Only write results to --local-results, not to the results endpoint")
+    parser.add_argument("--skip-index", type=str, help="SQLite file of items already extracted per model and prompt, they are skipped, disabled if omitted")
+    parser.add_argument("--skip-index-capacity", type=int, default=10_000_000, help="Items the in-memory filter of --skip-index is sized for")
 
     args = parser.parse_args()
-    asyncio.run(main(worker_count=args.worker_count))
+    if not parse_endpoints(args.vllm_endpoints):
+        parser.error("--vllm-endpoints (VLLM_ENDPOINTS) needs at least one url")
+    if args.local_results_only and not args.local_results:
+        parser.error("--local-results-only needs --local-results")
+    asyncio.run(main(**vars(args)))
@@ -0,0 +1,129 @@
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import Protocol
+
+import httpx
+
+
+@dataclass
+class LoadSample:
+    running: float  # requests vLLM is currently generating for
+    waiting: float  # requests queued inside vLLM
+    latency: float | None  # mean end to end request latency since the last sample
+    busy: int  # slots in use on the controlled target
+    backlog: int  # work waiting locally for a free slot
+
+
+class Scalable(Protocol):
+    limit: int
+    busy: int
+    backlog: int
+
+    def resize(self, limit: int) -> None: ...
+
+
+def parse_metrics(text: str) -> dict[str, float]:
+    # sum prometheus samples over their labels, e.g. 'vllm:num_requests_running{model_name="x"} 3.0'
+    metrics = {}
+    for line in text.splitlines():
+        if not line or line.startswith("#"):
+            continue
+        name_and_labels, _, value = line.rpartition(" ")
+        name = name_and_labels.split("{", 1)[0]
+        try:
+            metrics[name] = metrics.get(name, 0.0) + float(value)
+        except ValueError:
+            continue
+    return metrics
+
+
+class ConcurrencyController:
+    """Scales a concurrency limit (running jobs or LLM requests in flight) with the load reported by vLLM.
+
+    The limit grows by one while there is more work than slots and vLLM keeps up, and backs off by a quarter
+    when requests queue up in vLLM or latency rises well above the best latency seen so far. It stops growing
+    while vLLM already runs as many requests as its batch holds, since more would only wait.
+    """
+
+    def __init__(
+        self,
+        metrics_urls: list[str],
+        min_limit: int = 1,
+        max_limit: int = 32,
+        interval: float = 5.0,
+        max_waiting: int = 4,
+        latency_tolerance: float = 3.0,
+    ) -> None:
+        self.metrics_urls = metrics_urls
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.interval = interval
+        self.max_waiting = max_waiting
+        self.latency_tolerance = latency_tolerance
+
+        self.baseline_latency = None
+        self.latency_totals = None
+        # most requests vLLM was seen running while others waited, i.e. its batch limit (max_num_seqs or kv cache)
+        self.batch_limit = None
+
+    async def fetch_metrics(self, client: httpx.AsyncClient) -> dict[str, float]:
+        # metrics from several vLLM servers are added up
+        totals = {}
+        for url in self.metrics_urls:
+            response = await client.get(url)
+            response.raise_for_status()
+            for name, value in parse_metrics(response.text).items():
+                totals[name] = totals.get(name, 0.0) + value
+        return totals
+
+    def mean_latency(self, metrics: dict[str, float]) -> float | None:
+        # the latency histogram is cumulative, so the mean over the last interval comes from the deltas
+        totals = (metrics.get("vllm:e2e_request_latency_seconds_sum", 0.0), metrics.get("vllm:e2e_request_latency_seconds_count", 0.0))
+        previous, self.latency_totals = self.latency_totals, totals
+        if previous is None or totals[1] <= previous[1]:
+            return None
+        return (totals[0] - previous[0]) / (totals[1] - previous[1])
+
+    def decide(self, limit: int, sample: LoadSample) -> int:
+        latency_high = False
+        if sample.latency is not None:
+            if self.baseline_latency is None or sample.latency < self.baseline_latency:
+                self.baseline_latency = sample.latency
+            else:
+                # let the baseline drift up slowly so one lucky sample does not pin it forever
+                self.baseline_latency += (sample.latency - self.baseline_latency) * 0.05
+            latency_high = sample.latency > self.baseline_latency * self.latency_tolerance
+
+        if sample.waiting > 0 and sample.running > 0:
+            self.batch_limit = max(self.batch_limit or 0, sample.running)
+        batch_full = self.batch_limit is not None and sample.running >= self.batch_limit
+
+        if sample.waiting > self.max_waiting or latency_high:
+            limit -= max(1, limit // 4)
+        elif (sample.busy >= limit or sample.backlog > 0) and not batch_full:
+            limit += 1
+        return max(self.min_limit, min(self.max_limit, limit))
+
+    async def run(self, target: Scalable) -> None:
+        async with httpx.AsyncClient(timeout=httpx.Timeout(self.interval)) as client:
+            while True:
+                await asyncio.sleep(self.interval)
+                try:
+                    metrics = await self.fetch_metrics(client)
+                except httpx.HTTPError as e:
+                    logging.warning("failed to read vLLM metrics: %s", e)
+                    continue
+
+                sample = LoadSample(
+                    running=metrics.get("vllm:num_requests_running", 0.0),
+                    waiting=metrics.get("vllm:num_requests_waiting", 0.0),
+                    latency=self.mean_latency(metrics),
+                    busy=target.busy,
+                    backlog=target.backlog,
+                )
+                limit = target.limit
+                new_limit = self.decide(limit, sample)
+                if new_limit != limit:
+                    logging.info("changing %s limit from %s to %s (%s)", type(target).__name__, limit, new_limit, sample)
+                    target.resize(new_limit)
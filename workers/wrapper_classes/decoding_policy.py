@@ -0,0 +1,51 @@
+from collections import Counter, deque
+
+
+class DecodingPolicy:
+    """Decides per (model, prompt_id) whether a request starts with unconstrained or constrained decoding.
+
+    Unconstrained decoding is faster but an output that fails validation (and cannot be repaired
+    locally) has to be generated again with `guided_json`. Once more than `threshold` of the last
+    `window` unconstrained attempts needed that second generation, requests start constrained. Every
+    `probe_interval`th request still starts unconstrained so the policy can switch back when the
+    failure rate drops.
+    """
+
+    def __init__(self, threshold: float = 0.2, window: int = 200, min_samples: int = 20, probe_interval: int = 20) -> None:
+        self.threshold = threshold
+        self.window = window
+        self.min_samples = min_samples
+        self.probe_interval = probe_interval
+        self.outcomes = {}
+        self.requests = Counter()
+        self.paths = {}
+
+    def failure_rate(self, key: tuple[str, int]) -> float:
+        outcomes = self.outcomes.get(key)
+        return sum(outcomes) / len(outcomes) if outcomes else 0.0
+
+    def constrained_first(self, key: tuple[str, int]) -> bool:
+        self.requests[key] += 1
+        if len(self.outcomes.get(key, ())) < self.min_samples or self.failure_rate(key) <= self.threshold:
+            return False
+        if self.requests[key] % self.probe_interval == 0:
+            self.count(key, "probe")
+            return False
+        return True
+
+    def record(self, key: tuple[str, int], failed: bool) -> None:
+        # outcome of an unconstrained attempt, failed means it had to be generated again
+        self.outcomes.setdefault(key, deque(maxlen=self.window)).append(failed)
+
+    def count(self, key: tuple[str, int], path: str) -> None:
+        self.paths.setdefault(key, Counter())[path] += 1
+
+    def stats(self) -> dict:
+        return {
+            f"{model_name}/{prompt_id}": {
+                **self.paths.get((model_name, prompt_id), {}),
+                "failure_rate": round(self.failure_rate((model_name, prompt_id)), 3),
+                "constrained_first": len(self.outcomes.get((model_name, prompt_id), ())) >= self.min_samples and self.failure_rate((model_name, prompt_id)) > self.threshold,
+            }
+            for model_name, prompt_id in self.requests
+        }
@@ -0,0 +1,88 @@
+import asyncio
+import math
+from collections import deque
+from typing import Awaitable, Callable, TypeVar
+
+T = TypeVar("T")
+
+
+class LatencyTracker:
+    """Keeps the latencies of the last `window` requests and the percentile a hedge waits for.
+
+    `budget` is the share of requests that may send a hedge, so a server that is slow for everyone
+    is not sent twice the load.
+    """
+
+    def __init__(self, percentile: float = 0.95, window: int = 500, min_samples: int = 50, budget: float = 0.1) -> None:
+        self.percentile = percentile
+        self.latencies = deque(maxlen=window)
+        self.min_samples = min_samples
+        self.budget = budget
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def record(self, seconds: float) -> None:
+        self.latencies.append(seconds)
+
+    def delay(self) -> float | None:
+        # None until there are enough samples to know what slow is
+        if len(self.latencies) < self.min_samples:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, math.ceil(self.percentile * len(latencies)) - 1)]
+
+    def allow_hedge(self) -> bool:
+        return self.hedges < self.budget * self.requests
+
+    def stats(self) -> dict:
+        delay = self.delay()
+        return {"requests": self.requests, "hedges": self.hedges, "hedge_wins": self.hedge_wins, "hedge_delay": None if delay is None else round(delay, 3)}
+
+
+async def hedged(request: Callable[[], Awaitable[T]], tracker: LatencyTracker) -> T | None:
+    """Runs `request`, and once it has taken longer than the tracked percentile runs it a second time.
+
+    The first result that is not None wins and the other request is cancelled. The latency recorded is
+    always that of the original request, also when it was hedged, a primary cancelled because its hedge
+    won is recorded with the time it had taken so far. Leaving hedged requests out would drop exactly the
+    slow ones and pull the percentile down towards the median.
+    """
+    loop = asyncio.get_running_loop()
+    tracker.requests += 1
+    start = loop.time()
+    primary = asyncio.ensure_future(request())
+
+    def record(task: asyncio.Future) -> None:
+        if not task.cancelled() and task.exception() is None:
+            tracker.record(loop.time() - start)
+
+    primary.add_done_callback(record)
+    tasks = [primary]
+    delay = tracker.delay()
+    try:
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if done or not tracker.allow_hedge():
+            return await primary
+
+        tracker.hedges += 1
+        tasks.append(asyncio.ensure_future(request()))
+        pending = set(tasks)
+        result = None
+        while pending and result is None:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None and task.result() is not None and result is None:
+                    result = task.result()
+                    if task is not primary:
+                        tracker.hedge_wins += 1
+        if result is None:
+            # both failed or came back empty, surface the error of the original request
+            return primary.result()
+        return result
+    finally:
+        if not primary.done():
+            # a lower bound, the request was at least this slow
+            tracker.record(loop.time() - start)
+        for task in tasks:
+            task.cancel()
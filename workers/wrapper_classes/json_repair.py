@@ -0,0 +1,59 @@
+import re
+
+CODE_FENCE = re.compile(r"^\s*```(?:json)?\s*|\s*```\s*$")
+TRAILING_COMMA = re.compile(r",(\s*[}\]])")
+
+
+def repair_json(text: str) -> str | None:
+    """Cheap fixes for the ways LLM json usually breaks, returns None when there is nothing to fix.
+
+    Handles markdown code fences, text before the first `{` or after the last closing bracket,
+    trailing commas, and output cut off by max_tokens (open strings, a dangling key or comma, and
+    unclosed objects and arrays are closed). The result is not guaranteed to be valid json.
+    """
+    original = text
+    text = CODE_FENCE.sub("", text)
+    start = text.find("{")
+    if start == -1:
+        return None
+    text = text[start:]
+
+    # walk the text once, tracking open brackets outside strings
+    stack = []
+    in_string = escaped = False
+    end = len(text)
+    for i, char in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in "{[":
+            stack.append("}" if char == "{" else "]")
+        elif char in "}]":
+            if not stack or stack[-1] != char:
+                return None
+            stack.pop()
+            if not stack:
+                # anything after the top level object is chatter
+                end = i + 1
+                break
+
+    repaired = text[:end]
+    if stack:
+        # truncated output
+        if escaped:
+            repaired = repaired[:-1]
+        if in_string:
+            repaired += '"'
+        repaired = repaired.rstrip()
+        # a key without a value or a value cut before it started cannot be completed, drop it
+        repaired = re.sub(r'(,|\{)\s*"(?:[^"\\]|\\.)*"\s*:?\s*$', r"\1", repaired) if stack[-1] == "}" else repaired
+        repaired = repaired.rstrip().rstrip(",").rstrip(":")
+        repaired += "".join(reversed(stack))
+    repaired = TRAILING_COMMA.sub(r"\1", repaired)
+    return None if repaired == original else repaired
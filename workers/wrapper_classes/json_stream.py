@@ -0,0 +1,111 @@
+import json
+
+# characters that can appear outside of strings in json
+JSON_SYNTAX = set('{}[],:-+.0123456789eEtrufalsn \t\r\n')
+
+
+class JSONStreamScanner:
+    """Follows a json object while it is being generated and hands out the items of one of its arrays as they complete.
+
+    `feed` returns the raw text of every object in `array_key` that the new text completed. `finished`
+    is set once that array is closed and every key in `required_keys` has its value, anything generated
+    after that can only be keys the schema does not need, and `content` returns the object closed right
+    after the last of those values. `invalid` is set as soon as the text can no longer become valid json. Text before
+    the first `{` is kept but otherwise ignored, like `repair_json` does.
+    """
+
+    def __init__(self, array_key: str, required_keys: set[str] = frozenset()) -> None:
+        self.array_key = array_key
+        self.required_keys = set(required_keys)
+        self.buffer = ""
+        self.stack = []
+        self.in_string = self.escaped = False
+        self.string_start = None
+        self.expect_key = False
+        self.key = None
+        self.completed_keys = set()
+        self.item_start = None
+        self.array_end = None
+        self.object_end = None
+        self.finished_end = None
+        self.finished = self.invalid = False
+
+    def feed(self, text: str) -> list[str]:
+        items = []
+        start = len(self.buffer)
+        self.buffer += text
+        for i in range(start, len(self.buffer)):
+            if self.finished or self.invalid:
+                break
+            char = self.buffer[i]
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+                    self.close_string(i)
+                continue
+
+            if not self.stack:
+                if char == "{":
+                    self.stack.append("}")
+                    self.expect_key = True
+                continue
+
+            if char not in JSON_SYNTAX and char != '"':
+                self.invalid = True
+            elif char == '"':
+                self.in_string = True
+                self.string_start = i
+            elif char in "{[":
+                if len(self.stack) == 2 and char == "{" and self.in_array():
+                    self.item_start = i
+                self.stack.append("}" if char == "{" else "]")
+            elif char in "}]":
+                if self.stack.pop() != char:
+                    self.invalid = True
+                elif len(self.stack) == 2 and self.item_start is not None and self.in_array():
+                    items.append(self.buffer[self.item_start : i + 1])
+                    self.item_start = None
+                elif len(self.stack) == 1:
+                    self.completed_keys.add(self.key)
+                    if self.key == self.array_key:
+                        self.array_end = i
+                elif not self.stack:
+                    self.completed_keys.add(self.key)
+                    self.object_end = i
+                    self.finished = True
+            elif char == "," and len(self.stack) == 1:
+                self.completed_keys.add(self.key)
+                self.expect_key = True
+            elif char == ":" and len(self.stack) == 1:
+                self.expect_key = False
+
+            if self.array_end is not None and self.required_keys <= self.completed_keys and not self.finished:
+                self.finished = True
+                # a comma completes the value before it and is left out
+                self.finished_end = i - 1 if char == "," else i
+        return items
+
+    def in_array(self) -> bool:
+        return self.stack[1] == "]" and self.key == self.array_key
+
+    def close_string(self, end: int) -> None:
+        if len(self.stack) != 1:
+            return
+        if self.expect_key:
+            try:
+                self.key = json.loads(self.buffer[self.string_start : end + 1])
+            except ValueError:
+                self.invalid = True
+        else:
+            self.completed_keys.add(self.key)
+
+    def content(self) -> str:
+        if self.object_end is not None:
+            return self.buffer[self.buffer.index("{") : self.object_end + 1]
+        if self.finished:
+            return self.buffer[self.buffer.index("{") : self.finished_end + 1] + "}"
+        return self.buffer
@@ -0,0 +1,82 @@
+import asyncio
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+
+class LLMCache:
+    """Persistent cache of validated LLM outputs, keyed on everything that determines the output.
+
+    Entries live in a SQLite file and the least recently used ones are evicted once there are more
+    than `max_entries`. With `bypass` set, lookups always miss but fresh outputs are still written,
+    which forces re-extraction and refreshes the cache at the same time.
+    """
+
+    def __init__(self, path: str, max_entries: int = 1_000_000, bypass: bool = False) -> None:
+        self.path = path
+        self.max_entries = max_entries
+        self.bypass = bypass
+        self.hits = 0
+        self.misses = 0
+
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value TEXT NOT NULL, last_used REAL NOT NULL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)")
+        self.entries = self.connection.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    @staticmethod
+    def key(model_name: str, prompt_id: int, schema: dict, prompt: list[dict]) -> str:
+        content = json.dumps([model_name, prompt_id, schema, prompt], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "entries": self.entries,
+        }
+
+    async def get(self, key: str) -> str | None:
+        if self.bypass:
+            self.misses += 1
+            return None
+        value = await asyncio.to_thread(self.read, key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    async def put(self, key: str, value: str) -> None:
+        await asyncio.to_thread(self.write, key, value)
+
+    def read(self, key: str) -> str | None:
+        with self.lock:
+            row = self.connection.execute("SELECT value FROM results WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self.connection.execute("UPDATE results SET last_used = ? WHERE key = ?", (time.time(), key))
+            return row[0]
+
+    def write(self, key: str, value: str) -> None:
+        with self.lock:
+            exists = self.connection.execute("SELECT 1 FROM results WHERE key = ?", (key,)).fetchone()
+            self.connection.execute("INSERT OR REPLACE INTO results (key, value, last_used) VALUES (?, ?, ?)", (key, value, time.time()))
+            if exists is None:
+                self.entries += 1
+            if self.entries > self.max_entries:
+                # evict down to 90% so eviction does not run on every write
+                excess = self.entries - int(self.max_entries * 0.9)
+                self.connection.execute("DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY last_used LIMIT ?)", (excess,))
+                self.entries -= excess
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,90 @@
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from contextvars import ContextVar
+from typing import Awaitable, Callable, TypeVar
+
+T = TypeVar("T")
+
+# set by the worker for every job so requests can be grouped per job without changing the handler signatures
+current_job: ContextVar[int | None] = ContextVar("current_job", default=None)
+
+
+class LLMDispatcher:
+    """Feeds the LLM requests of every running job into one stream with a bounded number in flight.
+
+    Requests wait in a queue per job and are started round robin across jobs, so a large batch cannot
+    starve the others. Once `max_queued` requests are waiting, new submissions block until there is room.
+    """
+
+    def __init__(self, max_in_flight: int = 64, max_queued: int = 1024) -> None:
+        self.max_in_flight = max_in_flight
+        self.max_queued = max_queued
+
+        self.queues = OrderedDict()  # job id -> deque of (request, future)
+        self.in_flight = 0
+        self.queued = 0
+        self.queue_space = asyncio.Semaphore(max_queued)
+        self.tasks = set()
+
+    @property
+    def limit(self) -> int:
+        return self.max_in_flight
+
+    @property
+    def busy(self) -> int:
+        return self.in_flight
+
+    @property
+    def backlog(self) -> int:
+        return self.queued
+
+    def resize(self, max_in_flight: int) -> None:
+        self.max_in_flight = max_in_flight
+        self.pump()
+
+    async def submit(self, request: Callable[[], Awaitable[T]]) -> T:
+        await self.queue_space.acquire()
+        self.queued += 1
+
+        future = asyncio.get_running_loop().create_future()
+        self.queues.setdefault(current_job.get(), deque()).append((request, future))
+        self.pump()
+        return await future
+
+    def pump(self) -> None:
+        while self.in_flight < self.max_in_flight and self.queues:
+            # take the next request from the job at the front and move that job to the back
+            job_id, queue = next(iter(self.queues.items()))
+            request, future = queue.popleft()
+            if queue:
+                self.queues.move_to_end(job_id)
+            else:
+                del self.queues[job_id]
+            self.queued -= 1
+            self.queue_space.release()
+
+            # the submitter went away while the request was queued
+            if future.done():
+                continue
+            self.in_flight += 1
+            task = asyncio.create_task(self.run(request, future))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+            future.add_done_callback(lambda future, task=task: task.cancel() if future.cancelled() else None)
+
+    async def run(self, request: Callable[[], Awaitable[T]], future: asyncio.Future) -> None:
+        try:
+            result = await request()
+            if not future.done():
+                future.set_result(result)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+            else:
+                logging.warning("LLM request failed after its caller went away: %s", e)
+        finally:
+            self.in_flight -= 1
+            self.pump()
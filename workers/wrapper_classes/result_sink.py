@@ -0,0 +1,185 @@
+import asyncio
+import logging
+import os
+import time
+
+# one row per triplet, the text it came from is repeated on every row and dictionary encoded in the files
+TEXT_COLUMNS = ("text_type", "paragraph_text", "preprocessor_id", "paper_id", "hashed_text", "weaviate_id", "legend_id")
+TRIPLET_COLUMNS = ("src", "relationship_type", "dst", "reasoning")
+HEADER_COLUMNS = ("run_id", "extraction_pipeline_id", "model_name", "model_version")
+COLUMNS = HEADER_COLUMNS + TEXT_COLUMNS + TRIPLET_COLUMNS
+INT_COLUMNS = {"model_version", "legend_id"}
+FORMATS = {"parquet": ".parquet", "arrow": ".arrow"}
+
+
+class ArrowResultSink:
+    """Writes job results to local Parquet or Arrow IPC files, one row per triplet.
+
+    Takes the same payloads as `ResultUploader`. Rows are buffered until there are `row_group_size` of
+    them and written as one row group (a record batch for Arrow), and a file is closed and a new one
+    started every `rows_per_file` rows, so memory stays bounded however long the run. Files are written
+    under a `.tmp` name and renamed once complete, anything without it can be read while the run goes on.
+    `durable_jobs` is how many of the submitted jobs have all their rows in completed files. If writing
+    fails (e.g. the disk is full), the error is logged, nothing more is written and `submit` raises.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        format: str = "parquet",
+        row_group_size: int = 50_000,
+        rows_per_file: int = 5_000_000,
+        max_queued: int = 256,
+        prefix: str = "results",
+    ) -> None:
+        # pyarrow is only needed when results are written locally
+        import pyarrow as pa
+
+        if format not in FORMATS:
+            raise ValueError(f"unknown result format {format}, expected one of {', '.join(FORMATS)}")
+        self.pa = pa
+        self.directory = directory
+        self.format = format
+        self.row_group_size = min(row_group_size, rows_per_file)
+        self.rows_per_file = rows_per_file
+        self.prefix = prefix
+        self.schema = pa.schema([(column, pa.int64() if column in INT_COLUMNS else pa.string()) for column in COLUMNS])
+
+        self.queue = asyncio.Queue(maxsize=max_queued)
+        self.task = None
+        self.error = None
+        self.columns = {column: [] for column in COLUMNS}
+        self.buffered = 0
+        self.writer = None
+        self.path = None
+        self.file_rows = 0
+        self.added_jobs = 0
+        self.durable_jobs = 0
+        self.counts = {"jobs": 0, "rows": 0, "row_groups": 0, "files": 0}
+        os.makedirs(directory, exist_ok=True)
+
+    def stats(self) -> dict:
+        return {**self.counts, "queued": self.queue.qsize()}
+
+    def start(self) -> None:
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def submit(self, payload: dict) -> None:
+        if self.error is not None:
+            raise RuntimeError(f"writing results to {self.directory} failed") from self.error
+        self.counts["jobs"] += 1
+        await self.queue.put(payload)
+
+    async def close(self) -> None:
+        # buffered rows are written and the open file is completed before this returns
+        if self.task is not None:
+            await self.queue.put(None)
+            await self.task
+        # after a failed write the open file is left as .tmp, its rows never counted as durable
+        if self.error is None:
+            await asyncio.to_thread(self.close_file)
+
+    async def run(self) -> None:
+        while True:
+            payload = await self.queue.get()
+            # after an error the queue is still drained so jobs waiting in submit are not stuck
+            if self.error is not None:
+                if payload is None:
+                    return
+                continue
+            try:
+                if payload is None:
+                    await asyncio.to_thread(self.write_row_group)
+                    return
+                self.add(payload)
+                if self.buffered >= self.row_group_size:
+                    await asyncio.to_thread(self.write_row_group)
+            except Exception as e:
+                self.error = e
+                logging.exception("writing results to %s failed, no more results are written", self.directory)
+                if payload is None:
+                    return
+
+    def add(self, payload: dict) -> None:
+        columns = self.columns
+        for result in payload["results"]:
+            text = result["text"]
+            for triplet in result["relationships"]:
+                for column in HEADER_COLUMNS:
+                    columns[column].append(payload[column])
+                for column in TEXT_COLUMNS:
+                    columns[column].append(text.get(column))
+                for column in TRIPLET_COLUMNS:
+                    columns[column].append(triplet[column])
+                self.buffered += 1
+        self.added_jobs += 1
+
+    def write_row_group(self) -> None:
+        if not self.buffered:
+            return
+        table = self.pa.Table.from_pydict(self.columns, schema=self.schema)
+        self.columns = {column: [] for column in COLUMNS}
+        self.buffered = 0
+        if self.writer is None:
+            self.open_file()
+        if self.format == "parquet":
+            self.writer.write_table(table, row_group_size=table.num_rows)
+        else:
+            self.writer.write_table(table, max_chunksize=table.num_rows)
+        self.file_rows += table.num_rows
+        self.counts["rows"] += table.num_rows
+        self.counts["row_groups"] += 1
+        if self.file_rows >= self.rows_per_file:
+            self.close_file()
+
+    def open_file(self) -> None:
+        self.path = os.path.join(self.directory, f"{self.prefix}-{time.time_ns()}{FORMATS[self.format]}")
+        if self.format == "parquet":
+            import pyarrow.parquet as pq
+
+            self.writer = pq.ParquetWriter(self.path + ".tmp", self.schema, compression="zstd")
+        else:
+            self.writer = self.pa.ipc.new_file(self.path + ".tmp", self.schema, options=self.pa.ipc.IpcWriteOptions(compression="zstd"))
+
+    def close_file(self) -> None:
+        # only called with nothing buffered, so every job added so far is in this file or an earlier one
+        if self.writer is None:
+            self.durable_jobs = self.added_jobs
+            return
+        self.writer.close()
+        os.replace(self.path + ".tmp", self.path)
+        self.durable_jobs = self.added_jobs
+        logging.info("wrote %s rows of results to %s", self.file_rows, self.path)
+        self.counts["files"] += 1
+        self.writer = None
+        self.file_rows = 0
+
+
+class ResultSinks:
+    """Hands every payload to several sinks, e.g. the results endpoint and local files."""
+
+    def __init__(self, sinks: list) -> None:
+        self.sinks = sinks
+        self.counts = {"jobs": 0}
+
+    @property
+    def durable_jobs(self) -> int:
+        # a job is durable once every sink has it
+        return min(sink.durable_jobs for sink in self.sinks)
+
+    def stats(self) -> dict:
+        return {type(sink).__name__: sink.stats() for sink in self.sinks}
+
+    def start(self) -> None:
+        for sink in self.sinks:
+            sink.start()
+
+    async def submit(self, payload: dict) -> None:
+        self.counts["jobs"] += 1
+        for sink in self.sinks:
+            await sink.submit(payload)
+
+    async def close(self) -> None:
+        for sink in self.sinks:
+            await sink.close()
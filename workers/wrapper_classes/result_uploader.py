@@ -0,0 +1,217 @@
+import asyncio
+import glob
+import gzip
+import logging
+import os
+import time
+import uuid
+from typing import Callable
+
+import httpx
+
+from workers.handlers.utils.serialization import dumps
+
+# keys of the payload that are the same for every result of a run, results that share them are posted together
+HEADER_KEYS = ("run_id", "extraction_pipeline_id", "model_name", "model_version")
+# outcomes of a post, a rejected payload is never accepted however often it is sent
+POSTED, FAILED, REJECTED = "posted", "failed", "rejected"
+# client errors worth retrying, the server timed out waiting or asks to slow down
+RETRY_STATUSES = {408, 429}
+
+
+class ResultUploader:
+    """Posts job results to the results endpoint in the background so jobs can finish without waiting on it.
+
+    `submit` hands over the results of a job and returns at once, it only waits while `max_queued` jobs are
+    already waiting to be sent. Results of the same run are merged into one payload of up to `max_results`
+    results, or whatever has arrived after `flush_interval` seconds, and posted gzip compressed. A failed post
+    is retried `max_retries` times with exponential backoff, after that the payload is written to `spool_dir`
+    and posted again once the endpoint answers, so nothing is lost while it is down or across restarts.
+    A payload the endpoint rejects with a 4xx is not retried, it is moved to `rejected/` in `spool_dir`.
+    `durable_jobs` is how many of the submitted jobs have all their results posted, spooled or set aside.
+    """
+
+    def __init__(
+        self,
+        endpoint: str,
+        spool_dir: str,
+        max_queued: int = 256,
+        max_results: int = 1000,
+        flush_interval: float = 2.0,
+        max_retries: int = 4,
+        backoff: float = 1.0,
+        replay_interval: float = 60.0,
+        compress: bool = True,
+        encode: Callable[[dict], bytes] = dumps,
+    ) -> None:
+        self.endpoint = endpoint
+        self.spool_dir = spool_dir
+        self.max_results = max_results
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.replay_interval = replay_interval
+        self.compress = compress
+        self.encode = encode
+
+        self.queue = asyncio.Queue(maxsize=max_queued)
+        self.client = httpx.AsyncClient(timeout=httpx.Timeout(30.0))
+        self.task = None
+        self.replay_task = None
+        self.durable_jobs = 0
+        self.counts = {"jobs": 0, "results": 0, "posts": 0, "retries": 0, "spooled": 0, "replayed": 0, "rejected": 0, "lost": 0, "bytes": 0}
+        self.rejected_dir = os.path.join(spool_dir, "rejected")
+        os.makedirs(self.rejected_dir, exist_ok=True)
+
+    def stats(self) -> dict:
+        return {**self.counts, "queued": self.queue.qsize()}
+
+    def start(self) -> None:
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+            self.replay_task = asyncio.create_task(self.run_replay())
+
+    async def submit(self, payload: dict) -> None:
+        # payload is what would have been posted for the job, its results may be sent along with those of other jobs
+        # jobs without results are queued too, so durable_jobs follows the order jobs were submitted in
+        results = payload["results"]
+        self.counts["jobs"] += 1
+        self.counts["results"] += len(results)
+        await self.queue.put((tuple(payload[key] for key in HEADER_KEYS), results))
+
+    async def close(self) -> None:
+        # everything submitted is posted or spooled before this returns
+        if self.replay_task is not None:
+            self.replay_task.cancel()
+        if self.task is not None:
+            await self.queue.put(None)
+            await self.task
+        await self.client.aclose()
+
+    async def run(self) -> None:
+        pending = {}  # header -> results waiting to be posted
+        count = 0
+        taken = 0
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                item = await asyncio.wait_for(self.queue.get(), timeout)
+            except asyncio.TimeoutError:
+                item = ()
+            if item:
+                header, results = item
+                taken += 1
+                if results:
+                    pending.setdefault(header, []).extend(results)
+                    count += len(results)
+                    deadline = deadline or time.monotonic() + self.flush_interval
+                if not pending:
+                    self.durable_jobs = taken
+                    continue
+                if count < self.max_results:
+                    continue
+            if pending:
+                lost = self.counts["lost"]
+                await self.flush(pending)
+                # once results are lost the jobs after them are never reported durable either
+                if lost == self.counts["lost"] == 0:
+                    self.durable_jobs = taken
+                pending, count, deadline = {}, 0, None
+            if item is None:
+                return
+
+    async def flush(self, pending: dict) -> None:
+        for header, results in pending.items():
+            for start in range(0, len(results), self.max_results):
+                chunk = results[start : start + self.max_results]
+                try:
+                    # encoding and compressing a large payload would stall the event loop
+                    body = await asyncio.to_thread(self.pack, {**dict(zip(HEADER_KEYS, header)), "results": chunk})
+                    status = await self.post(body, self.max_retries)
+                    if status == REJECTED:
+                        self.reject(body, self.spool_name())
+                    elif status == FAILED:
+                        self.spool(body)
+                except Exception:
+                    # e.g. a full disk while spooling, the uploader keeps going so submit never blocks for good
+                    self.counts["lost"] += len(chunk)
+                    logging.exception("%s results could not be posted or spooled and are lost", len(chunk))
+
+    def pack(self, payload: dict) -> bytes:
+        body = self.encode(payload)
+        return gzip.compress(body, compresslevel=5) if self.compress else body
+
+    async def post(self, body: bytes, retries: int) -> str:
+        headers = {"Content-Type": "application/json"}
+        if self.compress:
+            headers["Content-Encoding"] = "gzip"
+        for attempt in range(retries + 1):
+            if attempt:
+                self.counts["retries"] += 1
+                await asyncio.sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                response = await self.client.post(self.endpoint, headers=headers, content=body)
+                response.raise_for_status()
+                self.counts["posts"] += 1
+                self.counts["bytes"] += len(body)
+                return POSTED
+            except httpx.HTTPStatusError as e:
+                if e.response.status_code < 500 and e.response.status_code not in RETRY_STATUSES:
+                    logging.error("results endpoint rejected %s bytes of results: %s %s", len(body), e, e.response.text[:500])
+                    return REJECTED
+                logging.warning("posting %s bytes of results failed (attempt %s of %s): %s", len(body), attempt + 1, retries + 1, e)
+            except httpx.HTTPError as e:
+                logging.warning("posting %s bytes of results failed (attempt %s of %s): %s", len(body), attempt + 1, retries + 1, e)
+        return FAILED
+
+    def spool_name(self) -> str:
+        return f"{time.time_ns()}-{uuid.uuid4().hex}.json{'.gz' if self.compress else ''}"
+
+    def reject(self, body: bytes, name: str) -> None:
+        # kept for inspection, out of the way of the replay
+        with open(os.path.join(self.rejected_dir, name), "wb") as file:
+            file.write(body)
+        self.counts["rejected"] += 1
+        logging.error("kept rejected results in %s", os.path.join(self.rejected_dir, name))
+
+    def spool(self, body: bytes) -> None:
+        # written under a temporary name first so a replay never reads half a payload
+        path = os.path.join(self.spool_dir, self.spool_name())
+        with open(path + ".tmp", "wb") as file:
+            file.write(body)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(path + ".tmp", path)
+        self.counts["spooled"] += 1
+        logging.warning("results endpoint unavailable, spooled %s bytes of results to %s", len(body), path)
+
+    async def run_replay(self) -> None:
+        while True:
+            try:
+                await self.replay()
+            except Exception:
+                logging.exception("replaying spooled results failed, trying again in %s seconds", self.replay_interval)
+            await asyncio.sleep(self.replay_interval)
+
+    async def replay(self) -> None:
+        # oldest first, stops at the first failure since the endpoint is still down, rejected payloads are set aside
+        for path in sorted(glob.glob(os.path.join(self.spool_dir, "*.json*"))):
+            if path.endswith(".tmp"):
+                continue
+            with open(path, "rb") as file:
+                body = file.read()
+            compressed = path.endswith(".gz")
+            if compressed != self.compress:
+                body = gzip.compress(body, compresslevel=5) if self.compress else gzip.decompress(body)
+            status = await self.post(body, 0)
+            if status == FAILED:
+                return
+            if status == REJECTED:
+                os.replace(path, os.path.join(self.rejected_dir, os.path.basename(path)))
+                self.counts["rejected"] += 1
+                logging.error("moved rejected spooled results %s to %s", path, self.rejected_dir)
+                continue
+            os.remove(path)
+            self.counts["replayed"] += 1
+            logging.info("replayed spooled results %s", path)
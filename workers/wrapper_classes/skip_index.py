@@ -0,0 +1,142 @@
+import asyncio
+import hashlib
+import logging
+import math
+import sqlite3
+import threading
+
+
+class SkipIndex:
+    """Persistent set of paragraphs and map descriptions already extracted, per model and prompt.
+
+    Keys live in a SQLite file, and a Bloom filter over them is kept in memory so the lookup of an item
+    that was never extracted (most of a new run) does not touch the database. Items the filter reports
+    are confirmed against SQLite, so nothing is skipped by a false positive. The filter is saved in the
+    same file on close and rebuilt from the keys if it is missing or out of date, e.g. after a crash.
+    """
+
+    def __init__(self, path: str, capacity: int = 10_000_000, error_rate: float = 0.001) -> None:
+        self.path = path
+        # bits and hash functions for `capacity` keys at `error_rate` false positives
+        self.bits = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.bits / capacity * math.log(2)))
+        self.counts = {"checked": 0, "skipped": 0, "false_positives": 0, "added": 0}
+
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS extracted (key BLOB PRIMARY KEY) WITHOUT ROWID")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS bloom (bits INTEGER NOT NULL, hashes INTEGER NOT NULL, entries INTEGER NOT NULL, filter BLOB NOT NULL)")
+        self.entries = self.connection.execute("SELECT COUNT(*) FROM extracted").fetchone()[0]
+        self.filter = self.load_filter()
+
+    @staticmethod
+    def key(item_id: str, model_name: str, prompt_id: int) -> bytes:
+        return hashlib.blake2b(f"{model_name}\0{prompt_id}\0{item_id}".encode(), digest_size=16).digest()
+
+    def positions(self, key: bytes) -> list[int]:
+        # double hashing, the two halves of the key stand in for k independent hashes
+        first = int.from_bytes(key[:8], "little")
+        step = int.from_bytes(key[8:], "little") | 1
+        return [(first + i * step) % self.bits for i in range(self.hashes)]
+
+    def might_contain(self, key: bytes) -> bool:
+        return all(self.filter[position >> 3] & (1 << (position & 7)) for position in self.positions(key))
+
+    def set_bits(self, key: bytes) -> None:
+        for position in self.positions(key):
+            self.filter[position >> 3] |= 1 << (position & 7)
+
+    def stats(self) -> dict:
+        return {**self.counts, "entries": self.entries}
+
+    async def contains(self, keys: list[bytes]) -> list[bool]:
+        # only keys that pass the filter are looked up, in one query
+        candidates = [key for key in keys if self.might_contain(key)]
+        found = await asyncio.to_thread(self.read, candidates) if candidates else set()
+        self.counts["checked"] += len(keys)
+        self.counts["skipped"] += len(found)
+        self.counts["false_positives"] += len(candidates) - len(found)
+        return [key in found for key in keys]
+
+    async def add(self, keys: list[bytes]) -> None:
+        if not keys:
+            return
+        await asyncio.to_thread(self.write, keys)
+        for key in keys:
+            self.set_bits(key)
+
+    def read(self, keys: list[bytes]) -> set[bytes]:
+        found = set()
+        with self.lock:
+            # below sqlite's default limit of bound parameters
+            for i in range(0, len(keys), 500):
+                chunk = keys[i : i + 500]
+                rows = self.connection.execute(f"SELECT key FROM extracted WHERE key IN ({','.join('?' * len(chunk))})", chunk)
+                found.update(row[0] for row in rows)
+        return found
+
+    def write(self, keys: list[bytes]) -> None:
+        with self.lock:
+            before = self.connection.total_changes
+            self.connection.execute("BEGIN")
+            self.connection.executemany("INSERT OR IGNORE INTO extracted (key) VALUES (?)", [(key,) for key in keys])
+            self.connection.execute("COMMIT")
+            added = self.connection.total_changes - before
+            self.entries += added
+            self.counts["added"] += added
+
+    def load_filter(self) -> bytearray:
+        row = self.connection.execute("SELECT bits, hashes, entries, filter FROM bloom").fetchone()
+        if row is not None and row[:3] == (self.bits, self.hashes, self.entries):
+            return bytearray(row[3])
+        # saved for a different size, or keys were added after it was saved
+        logging.info("building skip index filter over %s keys", self.entries)
+        self.filter = bytearray(-(-self.bits // 8))
+        cursor = self.connection.execute("SELECT key FROM extracted")
+        while rows := cursor.fetchmany(10_000):
+            for (key,) in rows:
+                self.set_bits(key)
+        if self.entries > self.bits / self.hashes * math.log(2):
+            logging.warning("skip index holds %s keys, more than its filter is sized for, lookups will hit sqlite more often", self.entries)
+        return self.filter
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.execute("BEGIN")
+            self.connection.execute("DELETE FROM bloom")
+            self.connection.execute("INSERT INTO bloom (bits, hashes, entries, filter) VALUES (?, ?, ?, ?)", (self.bits, self.hashes, self.entries, bytes(self.filter)))
+            self.connection.execute("COMMIT")
+            self.connection.close()
+
+
+class DeferredSkipIndex:
+    """Holds back the items handlers add to the skip index until the result sink reports their job durable.
+
+    Sinks post, spool and write in the background, an item recorded before its results are safe would be
+    skipped for good if the process died first. `update` records whatever has become durable since.
+    """
+
+    def __init__(self, index: SkipIndex, sink) -> None:
+        self.index = index
+        self.sink = sink
+        self.pending = []  # (jobs the sink must have made durable, keys)
+
+    def stats(self) -> dict:
+        return {**self.index.stats(), "pending": sum(len(keys) for _, keys in self.pending)}
+
+    async def contains(self, keys: list[bytes]) -> list[bool]:
+        return await self.index.contains(keys)
+
+    async def add(self, keys: list[bytes]) -> None:
+        # handlers add right after submitting their results, so the job is at most this far into the sink
+        self.pending.append((self.sink.counts["jobs"], keys))
+
+    async def update(self) -> None:
+        durable = [keys for jobs, keys in self.pending if jobs <= self.sink.durable_jobs]
+        self.pending = [(jobs, keys) for jobs, keys in self.pending if jobs > self.sink.durable_jobs]
+        await self.index.add([key for keys in durable for key in keys])
+
+    def close(self) -> None:
+        self.index.close()
@@ -0,0 +1,83 @@
+import logging
+import math
+import re
+
+# without a tokenizer a token is assumed to be this many characters, on the low side for English text
+CHARS_PER_TOKEN = 3
+# chat template tokens around every message (role header, end of turn)
+MESSAGE_OVERHEAD = 8
+SENTENCE_END = re.compile(r"(?<=[.!?;])\s+")
+
+
+def load_tokenizer(model_name: str):
+    # transformers comes with vLLM but is not needed to run the workers
+    try:
+        from transformers import AutoTokenizer
+
+        return AutoTokenizer.from_pretrained(model_name)
+    except Exception as e:
+        logging.warning("no tokenizer for %s, estimating %s characters per token: %s", model_name, CHARS_PER_TOKEN, e)
+        return None
+
+
+class TokenCounter:
+    """Counts prompt tokens locally so a prompt that does not fit the context window is never sent."""
+
+    def __init__(self, tokenizer=None) -> None:
+        self.tokenizer = tokenizer
+        self.prefix_counts = {}
+
+    def count(self, text: str) -> int:
+        if self.tokenizer is None:
+            return math.ceil(len(text) / CHARS_PER_TOKEN)
+        return len(self.tokenizer.encode(text, add_special_tokens=False))
+
+    def count_messages(self, messages: list[dict]) -> int:
+        # the shared prefix is counted once, only the last message changes between requests
+        prefix_key = tuple(message["content"] for message in messages[:-1])
+        if prefix_key not in self.prefix_counts:
+            self.prefix_counts[prefix_key] = sum(self.count(content) + MESSAGE_OVERHEAD for content in prefix_key)
+        return self.prefix_counts[prefix_key] + self.count(messages[-1]["content"]) + MESSAGE_OVERHEAD
+
+
+def split_sentences(text: str) -> list[str]:
+    return [sentence for sentence in SENTENCE_END.split(text.strip()) if sentence]
+
+
+def split_windows(text: str, budget: int, count, overlap: int = 1) -> list[str]:
+    """Splits text into windows of whole sentences of at most `budget` tokens, each repeating the last
+    `overlap` sentences of the window before it so relations across the cut are still seen together.
+
+    A sentence longer than the budget on its own is cut into word chunks that fit.
+    """
+    sentences = []
+    for sentence in split_sentences(text):
+        if count(sentence) <= budget:
+            sentences.append(sentence)
+            continue
+        chunk, size = [], 0
+        for word in sentence.split():
+            word_count = count(" " + word)
+            if chunk and size + word_count > budget:
+                sentences.append(" ".join(chunk))
+                chunk, size = [], 0
+            chunk.append(word)
+            size += word_count
+        if chunk:
+            sentences.append(" ".join(chunk))
+
+    # sentences are counted once, a window is about the sum of its sentences
+    counts = [count(sentence) for sentence in sentences]
+    windows = []
+    start = 0
+    while start < len(sentences):
+        end, size = start + 1, counts[start]
+        while end < len(sentences) and size + counts[end] <= budget:
+            size += counts[end]
+            end += 1
+        windows.append(" ".join(sentences[start:end]))
+        if end == len(sentences):
+            break
+        # step back for the overlap but always move forward
+        start = max(end - overlap, start + 1)
+    return windows
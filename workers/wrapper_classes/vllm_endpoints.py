@@ -0,0 +1,108 @@
+import asyncio
+import logging
+import os
+
+import httpx
+from openai import AsyncOpenAI
+
+# comma separated base urls of the vLLM servers a worker drives
+VLLM_ENDPOINTS = os.getenv("VLLM_ENDPOINTS", "http://127.0.0.1:8000")
+VLLM_HEALTH_INTERVAL = float(os.getenv("VLLM_HEALTH_INTERVAL", "5"))
+
+
+def parse_endpoints(value: str) -> list[str]:
+    return [url.strip() for url in value.split(",") if url.strip()]
+
+
+class Endpoint:
+    def __init__(self, url: str, max_retries: int = 2) -> None:
+        self.url = url.rstrip("/")
+        self.client = AsyncOpenAI(base_url=f"{self.url}/v1", api_key="EMPTY", max_retries=max_retries)
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.healthy = False
+
+
+class EndpointPool:
+    """Spreads LLM requests over several vLLM servers (data parallel replicas of the same model).
+
+    Every request goes to the healthy endpoint with the fewest outstanding requests, ties go to the one
+    that has been picked least. An endpoint that cannot be reached or fails its `/health` check is taken
+    out until a later health check passes, and callers wait while no endpoint is healthy.
+    """
+
+    def __init__(self, urls: list[str], health_interval: float = VLLM_HEALTH_INTERVAL) -> None:
+        if not urls:
+            raise ValueError("EndpointPool needs at least one vLLM endpoint")
+        # with several servers a failed request goes to another one instead of being retried on the same
+        self.endpoints = [Endpoint(url, max_retries=2 if len(urls) == 1 else 0) for url in urls]
+        self.health_interval = health_interval
+        self.available = asyncio.Event()
+        self.health_client = httpx.AsyncClient(timeout=5.0)
+        self.health_task = None
+
+    @classmethod
+    def from_env(cls) -> "EndpointPool":
+        return cls(parse_endpoints(VLLM_ENDPOINTS))
+
+    async def start(self) -> None:
+        # waits until at least one server is up, safe to call from every handler sharing the pool
+        if self.health_task is None:
+            self.health_task = asyncio.create_task(self.run_health_checks())
+        await self.available.wait()
+
+    async def close(self) -> None:
+        if self.health_task is not None:
+            self.health_task.cancel()
+        await self.health_client.aclose()
+        for endpoint in self.endpoints:
+            await endpoint.client.close()
+
+    async def run_health_checks(self) -> None:
+        while True:
+            await asyncio.gather(*(self.check_health(endpoint) for endpoint in self.endpoints))
+            await asyncio.sleep(self.health_interval)
+
+    async def check_health(self, endpoint: Endpoint) -> None:
+        try:
+            response = await self.health_client.get(f"{endpoint.url}/health")
+            response.raise_for_status()
+        except httpx.HTTPError as e:
+            if endpoint.healthy:
+                self.mark_down(endpoint, e)
+            return
+        if not endpoint.healthy:
+            logging.info("vLLM endpoint %s is up", endpoint.url)
+        endpoint.healthy = True
+        self.available.set()
+
+    def mark_down(self, endpoint: Endpoint, error: Exception) -> None:
+        endpoint.failures += 1
+        if not endpoint.healthy:
+            return
+        endpoint.healthy = False
+        logging.warning("vLLM endpoint %s is down: %s", endpoint.url, error)
+        if not any(endpoint.healthy for endpoint in self.endpoints):
+            self.available.clear()
+
+    async def acquire(self) -> Endpoint:
+        while True:
+            healthy = [endpoint for endpoint in self.endpoints if endpoint.healthy]
+            if healthy:
+                break
+            await self.available.wait()
+        endpoint = min(healthy, key=lambda endpoint: (endpoint.outstanding, endpoint.requests))
+        endpoint.outstanding += 1
+        endpoint.requests += 1
+        return endpoint
+
+    def release(self, endpoint: Endpoint) -> None:
+        endpoint.outstanding -= 1
+
+    def stats(self) -> dict:
+        return {endpoint.url: {"healthy": endpoint.healthy, "outstanding": endpoint.outstanding, "requests": endpoint.requests, "failures": endpoint.failures} for endpoint in self.endpoints}
+
+    @property
+    def metrics_urls(self) -> list[str]:
+        return [f"{endpoint.url}/metrics" for endpoint in self.endpoints]
@@ -1,68 +1,263 @@
-from openai import AsyncOpenAI
 import asyncio
-import httpx
 import json
 from pydantic import BaseModel
 import logging
 import openai
+import os
+import typing
+from workers.wrapper_classes.llm_dispatcher import LLMDispatcher
+from workers.wrapper_classes.llm_cache import LLMCache
+from workers.wrapper_classes.decoding_policy import DecodingPolicy
+from workers.wrapper_classes.json_repair import repair_json
+from workers.wrapper_classes.hedging import LatencyTracker, hedged
+from workers.wrapper_classes.json_stream import JSONStreamScanner
+from workers.wrapper_classes.token_budget import TokenCounter, load_tokenizer
+from workers.wrapper_classes.vllm_endpoints import Endpoint, EndpointPool
+
+# share of unconstrained outputs that need a constrained regeneration before requests start constrained
+CONSTRAINED_FIRST_THRESHOLD = float(os.getenv("CONSTRAINED_FIRST_THRESHOLD", "0.2"))
+# stream completions and stop them as soon as the output is complete or cannot validate
+VLLM_STREAM = os.getenv("VLLM_STREAM", "").lower() in ("1", "true", "yes")
+# context window of the served model, read from /v1/models when not set (vLLM --max-model-len)
+MAX_MODEL_LEN = int(os.getenv("MAX_MODEL_LEN", "0")) or None
+MAX_OUTPUT_TOKENS = 1024
+# a prompt that leaves less room than this for the output is not sent
+MIN_OUTPUT_TOKENS = int(os.getenv("MIN_OUTPUT_TOKENS", "256"))
+# a request slower than this latency percentile is sent again and the first valid answer kept, 0 disables hedging
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "0"))
+# share of requests that may be hedged
+HEDGE_BUDGET = float(os.getenv("HEDGE_BUDGET", "0.1"))
+
+
+def list_field(schema: type[BaseModel]) -> tuple[str, type[BaseModel]] | tuple[None, None]:
+    # the first field holding a list of models, its items are validated while streaming
+    for name, field in schema.model_fields.items():
+        if typing.get_origin(field.annotation) is list:
+            (item,) = typing.get_args(field.annotation)
+            if isinstance(item, type) and issubclass(item, BaseModel):
+                return name, item
+    return None, None
 
 
 class VLLMWrapper:
-    def __init__(self, model_name: str, schema: BaseModel) -> None:
+    def __init__(
+        self,
+        model_name: str,
+        schema: BaseModel,
+        dispatcher: LLMDispatcher | None = None,
+        cache: LLMCache | None = None,
+        prompt_id: int = 0,
+        policy: DecodingPolicy | None = None,
+        stream: bool | None = None,
+        endpoints: EndpointPool | None = None,
+        hedging: LatencyTracker | None = None,
+    ) -> None:
         self.model_name = model_name
-        self.client = AsyncOpenAI(
-            base_url="http://127.0.0.1:8000/v1",
-            api_key="EMPTY",
-        )
+        self.dispatcher = dispatcher
+        self.cache = cache
+        self.prompt_id = prompt_id
+        # handlers share model names and prompt ids, so each wrapper keeps its own policy by default
+        self.policy = policy or DecodingPolicy(threshold=CONSTRAINED_FIRST_THRESHOLD)
+        self.policy_key = (model_name, prompt_id)
+        # a pool shared through the handler ctx balances all handlers over the same servers
+        self.owns_endpoints = endpoints is None
+        self.endpoints = endpoints or EndpointPool.from_env()
         self.schema = schema
         self.json_schema = schema.model_json_schema()
+        # serialized once, the same string every time lets vLLM reuse the compiled grammar
+        self.guided_json = json.dumps(self.json_schema)
+        self.stream = VLLM_STREAM if stream is None else stream
+        self.stream_field, self.stream_item = list_field(schema)
+        self.required_fields = {name for name, field in schema.model_fields.items() if field.is_required()}
+        self.max_model_len = MAX_MODEL_LEN
+        self.tokens = TokenCounter()
+        if hedging is None and HEDGE_PERCENTILE:
+            hedging = LatencyTracker(HEDGE_PERCENTILE, budget=HEDGE_BUDGET)
+        self.hedging = hedging
 
     async def startup(self) -> None:
-        # wait for vLLM server to start
-        async with httpx.AsyncClient() as httpx_client:
-            while True:
-                try:
-                    response = await httpx_client.get("http://127.0.0.1:8000/health")
-                    response.raise_for_status()
-                    break
-                except httpx.HTTPError:
-                    await asyncio.sleep(5)
+        # wait for a vLLM server to start
+        await self.endpoints.start()
+
+        # prompts are measured before they are sent
+        self.tokens = TokenCounter(await asyncio.to_thread(load_tokenizer, self.model_name))
+        if self.max_model_len is None:
+            endpoint = await self.endpoints.acquire()
+            try:
+                models = await endpoint.client.models.list()
+            finally:
+                self.endpoints.release(endpoint)
+            self.max_model_len = next((getattr(model, "max_model_len", None) for model in models.data if model.id == self.model_name), None)
+        logging.info("VLLM server ready, max model length %s.", self.max_model_len)
+
+    def room(self, prompt: list[dict]) -> int | None:
+        # tokens left for the output after the prompt, None when the context window is unknown
+        if self.max_model_len is None:
+            return None
+        return self.max_model_len - self.tokens.count_messages(prompt)
 
-        logging.info("VLLM server ready.")
+    def fits(self, prompt: list[dict]) -> bool:
+        room = self.room(prompt)
+        return room is None or room >= MIN_OUTPUT_TOKENS
+
+    def content_budget(self, prefix: list[dict]) -> int | None:
+        # tokens a user message after the prefix can have, leaving the full output budget when possible
+        room = self.room([*prefix, {"role": "user", "content": ""}])
+        if room is None:
+            return None
+        return room - MAX_OUTPUT_TOKENS if room - MAX_OUTPUT_TOKENS >= MIN_OUTPUT_TOKENS else room - MIN_OUTPUT_TOKENS
 
     async def shutdown(self):
-        await self.client.close()
+        if self.owns_endpoints:
+            await self.endpoints.close()
+
+    async def guided_generate(self, prompt: dict, constrained: bool = False, json_schema: str | None = None) -> BaseModel:
+        # json_schema replaces the schema used for constrained decoding of this request, it must still validate as self.schema
+        # identical prompts for the same model, prompt version and schema are answered from the cache
+        if self.cache is not None:
+            cache_key = self.cache.key(self.model_name, self.prompt_id, json_schema or self.json_schema, prompt)
+            cached_output = await self.cache.get(cache_key)
+            if cached_output is not None:
+                return self.schema.model_validate_json(cached_output)
+
+        # a prompt that cannot fit is dropped here instead of by a 400 from vLLM, the output gets the room that is left
+        room = self.room(prompt)
+        if room is not None and room < MIN_OUTPUT_TOKENS:
+            logging.warning("prompt leaves %s of %s tokens for the output, not sent", room, self.max_model_len)
+            self.policy.count(self.policy_key, "too_long")
+            return None
+        max_tokens = MAX_OUTPUT_TOKENS if room is None else min(MAX_OUTPUT_TOKENS, room)
+
+        def request():
+            return self.generate(prompt, constrained, json_schema, max_tokens)
+
+        # a straggler gets a second request, least outstanding routing sends it to another endpoint when there is one
+        if self.hedging is not None:
+            request = lambda generate=request: hedged(generate, self.hedging)
+
+        # queue behind the requests of other jobs when a shared dispatcher is used
+        if self.dispatcher is None:
+            output = await request()
+        else:
+            output = await self.dispatcher.submit(request)
 
-    async def guided_generate(self, prompt: dict, constrained: bool = False) -> BaseModel:
+        if self.cache is not None and output is not None:
+            await self.cache.put(cache_key, output.model_dump_json())
+        return output
+
+    async def generate(self, prompt: dict, constrained: bool = False, json_schema: str | None = None, max_tokens: int = MAX_OUTPUT_TOKENS) -> BaseModel:
+        # start constrained when unconstrained outputs of this model and prompt fail too often
+        retry = not constrained
+        if retry and self.policy.constrained_first(self.policy_key):
+            self.policy.count(self.policy_key, "started_constrained")
+            constrained, retry = True, False
+
+        content = await self.complete(prompt, constrained, json_schema, max_tokens)
+        if content is None:
+            return None
+        path = "constrained" if constrained else "unconstrained"
+
+        # validate llm output
+        try:
+            output = self.schema.model_validate_json(content)
+            self.policy.count(self.policy_key, path)
+            if retry:
+                self.policy.record(self.policy_key, False)
+            return output
+        except ValueError:
+            pass
+
+        # a local repair is much cheaper than generating again
+        repaired = repair_json(content)
+        if repaired is not None:
+            try:
+                output = self.schema.model_validate_json(repaired)
+                self.policy.count(self.policy_key, f"{path}_repaired")
+                if retry:
+                    self.policy.record(self.policy_key, False)
+                return output
+            except ValueError:
+                pass
+
+        self.policy.count(self.policy_key, f"{path}_invalid")
+        if not retry:
+            return None
+        # retry with constrained encoding
+        self.policy.record(self.policy_key, True)
+        return await self.generate(prompt, True, json_schema, max_tokens)
+
+    async def complete(self, prompt: dict, constrained: bool = False, json_schema: str | None = None, max_tokens: int = MAX_OUTPUT_TOKENS) -> str | None:
         extra_body = {}
         extra_body["stop_token_ids"] = [128001, 128009] # need to add this since there is a bug with llama 3 tokenizer
 
         if constrained:
-            extra_body["guided_json"] = json.dumps(self.json_schema)
+            extra_body["guided_json"] = json_schema or self.guided_json
             # extra_body["guided_decoding_backend"] = "lm-format-enforcer"
 
+        # a server that cannot be reached is taken out and the request goes to the next one, a server error
+        # only fails over the request, whether the server is down is left to the health checks
+        for attempt in range(len(self.endpoints.endpoints)):
+            endpoint = await self.endpoints.acquire()
+            try:
+                if self.stream and self.stream_field:
+                    return await self.stream_complete(endpoint, prompt, extra_body, max_tokens)
+                llm_output = await endpoint.client.chat.completions.create(
+                    model=self.model_name, 
+                    messages=prompt, 
+                    temperature=0.0, 
+                    max_tokens=max_tokens, 
+                    extra_body=extra_body
+                )
+                return llm_output.choices[0].message.content
+            except openai.BadRequestError as e:
+                if "maximum context length" in e.message:
+                    logging.warning("BadRequestError: %s", e.message)
+                    logging.warning("reached maximum length with a prompt of about %s tokens", self.tokens.count_messages(prompt))
+                    self.policy.count(self.policy_key, "context_length")
+                    return None
+                else:
+                    raise
+            except (openai.APIConnectionError, openai.InternalServerError) as e:
+                # APITimeoutError is an APIConnectionError
+                if isinstance(e, openai.APIConnectionError):
+                    self.endpoints.mark_down(endpoint, e)
+                else:
+                    endpoint.failures += 1
+                self.policy.count(self.policy_key, "failover")
+                if attempt == len(self.endpoints.endpoints) - 1:
+                    raise
+            finally:
+                self.endpoints.release(endpoint)
+
+    async def stream_complete(self, endpoint: Endpoint, prompt: dict, extra_body: dict, max_tokens: int = MAX_OUTPUT_TOKENS) -> str:
+        # validates list items as they complete and closes the stream, which aborts the request in vLLM, once the rest cannot matter
+        scanner = JSONStreamScanner(self.stream_field, self.required_fields)
+        stream = await endpoint.client.chat.completions.create(
+            model=self.model_name,
+            messages=prompt,
+            temperature=0.0,
+            max_tokens=max_tokens,
+            extra_body=extra_body,
+            stream=True,
+        )
+        stopped = False
         try:
-            llm_output = await self.client.chat.completions.create(
-                model=self.model_name, 
-                messages=prompt, 
-                temperature=0.0, 
-                max_tokens=1024, 
-                extra_body=extra_body
-            )
-
-            # validate llm output
-            validated_output = self.schema.model_validate_json(llm_output.choices[0].message.content)
-            return validated_output
-        except openai.BadRequestError as e:
-            if e.code == 400 and "maximum context length" in e.message:
-                logging.warning("BadRequestError: %s", e.message)
-                logging.warning("reached maximum length: %s", prompt)
-                return None
-            else:
-                raise
-        except ValueError:
-            # retry with constrained encoding
-            if not constrained:
-                return await self.guided_generate(prompt, True)
-            else:
-                return None
+            async for chunk in stream:
+                if not chunk.choices or not chunk.choices[0].delta.content:
+                    continue
+                self.policy.count(self.policy_key, "stream_chunks")
+                for item in scanner.feed(chunk.choices[0].delta.content):
+                    try:
+                        self.stream_item.model_validate_json(item)
+                    except ValueError:
+                        scanner.invalid = True
+                        break
+                if scanner.finished or scanner.invalid:
+                    stopped = True
+                    break
+        finally:
+            await stream.close()
+
+        if stopped:
+            self.policy.count(self.policy_key, "stream_stopped_invalid" if scanner.invalid else "stream_stopped_complete")
+        return scanner.content()
@@ -1,6 +1,7 @@
 import os
+import asyncio
 from dataclasses import dataclass
-from typing import Protocol, Iterable, Any, Callable
+from typing import Protocol, Iterable, Any, Callable, AsyncIterator
 import weaviate
 import json
 
@@ -20,26 +21,56 @@ class WeaviateWrapper:
             auth_client_secret=weaviate.auth.AuthApiKey(api_key),
         )
     
-    def get_paragraphs_for_ids(self, ids_to_load : "Iterable[str]") -> "Iterable[WeaviateText]":
-        for paragraph_id in ids_to_load:
-            # Make the query
-            response = (
-                self.client.query
-                .get("Paragraph", ['preprocessor_id', 'paper_id', 'hashed_text', 'text_content'])
-                .with_where({
-                    "path": "id",
-                    "operator": "Equal",
-                    "valueText": paragraph_id
-                })
-                .do()
-            )
+    def get_paragraphs_for_ids(self, ids_to_load : "Iterable[str]", chunk_size : int = 100) -> "Iterable[WeaviateText]":
+        ids_to_load = list(ids_to_load)
+        for start in range(0, len(ids_to_load), chunk_size):
+            yield from self.get_paragraph_chunk(ids_to_load[start:start + chunk_size])
+
+    async def stream_paragraphs_for_ids(self, ids_to_load : "Iterable[str]", chunk_size : int = 25, concurrency : int = 4) -> "AsyncIterator[WeaviateText]":
+        # Fetch chunks on worker threads and yield each chunk as soon as it arrives, in completion order
+        ids_to_load = list(ids_to_load)
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def fetch(chunk):
+            async with semaphore:
+                return await asyncio.to_thread(lambda: list(self.get_paragraph_chunk(chunk)))
+
+        tasks = [asyncio.create_task(fetch(ids_to_load[start:start + chunk_size])) for start in range(0, len(ids_to_load), chunk_size)]
+        try:
+            for next_chunk in asyncio.as_completed(tasks):
+                for paragraph in await next_chunk:
+                    yield paragraph
+        finally:
+            for task in tasks:
+                task.cancel()
 
-            # Ensure the result exists
-            if "data" not in response or "Get" not in response["data"] or "Paragraph" not in response["data"]["Get"]:
+    def get_paragraph_chunk(self, paragraph_ids : "list[str]") -> "Iterable[WeaviateText]":
+        # Load the whole chunk in one query
+        response = (
+            self.client.query
+            .get("Paragraph", ['preprocessor_id', 'paper_id', 'hashed_text', 'text_content'])
+            .with_additional("id")
+            .with_where({
+                "operator": "Or",
+                "operands": [
+                    {"path": ["id"], "operator": "Equal", "valueText": paragraph_id}
+                    for paragraph_id in paragraph_ids
+                ],
+            })
+            .with_limit(len(paragraph_ids))
+            .do()
+        )
+
+        # Ensure the result exists
+        if "data" not in response or "Get" not in response["data"] or not response["data"]["Get"].get("Paragraph"):
+            return
+
+        # Return the results in the requested order, ids that were not found are skipped
+        paragraphs = {paragraph_data["_additional"]["id"]: paragraph_data for paragraph_data in response["data"]["Get"]["Paragraph"]}
+        for paragraph_id in paragraph_ids:
+            if paragraph_id not in paragraphs:
                 continue
-            
-            # Return the result
-            paragraph_data = response["data"]["Get"]["Paragraph"][0]
+            paragraph_data = paragraphs[paragraph_id]
             yield WeaviateText(
                 preprocessor_id = paragraph_data["preprocessor_id"],
                 paper_id = paragraph_data["paper_id"],
@@ -5,12 +5,14 @@ from typing import Callable, Awaitable
 import logging
 import time
 import os
-import threading
+from collections import deque
 from contextlib import contextmanager
 from dataclasses import dataclass
 
 import workers.pb.job_manager_pb2 as pb
 import workers.pb.job_manager_pb2_grpc as pb_grpc
+from workers.wrapper_classes.concurrency_controller import ConcurrencyController
+from workers.wrapper_classes.llm_dispatcher import current_job
 
 
 @contextmanager
@@ -27,74 +29,308 @@ class Metadata:
     pipeline_id: str
 
 
+class Slots:
+    """Counting semaphore whose limit can be changed while slots are held."""
+
+    def __init__(self, limit: int) -> None:
+        self.limit = limit
+        self.used = 0
+        self.waiters = deque()
+
+    def locked(self) -> bool:
+        return self.used >= self.limit
+
+    async def acquire(self) -> None:
+        while self.locked():
+            waiter = asyncio.get_running_loop().create_future()
+            self.waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                # pass the wake up on if this waiter was woken right before being cancelled
+                if waiter.done() and not waiter.cancelled():
+                    self.wake()
+                raise
+        self.used += 1
+
+    def release(self) -> None:
+        self.used -= 1
+        self.wake()
+
+    def resize(self, limit: int) -> None:
+        # shrinking never interrupts held slots, they are just not handed out again
+        self.limit = limit
+        self.wake()
+
+    def wake(self) -> None:
+        free = self.limit - self.used
+        while free > 0 and self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+
+class Heartbeat:
+    """Renews the leases of all in-flight jobs with a single batched UpdateHealth call per interval.
+
+    Managers that do not advertise `batched_health` only read `id`, they get one call per job instead.
+    After 5 failed renewals in a row the leases are taken as lost and `run` raises, which stops the pool.
+    """
+
+    def __init__(self, stub: pb_grpc.JobManagerStub, interval: float, batched: bool = True) -> None:
+        self.stub = stub
+        self.interval = interval
+        self.batched = batched
+        self.job_ids = set()
+        self.task = None
+
+    def start(self) -> None:
+        self.task = asyncio.create_task(self.run())
+
+    def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+
+    def add(self, job_id: int) -> None:
+        self.job_ids.add(job_id)
+
+    def remove(self, job_id: int) -> None:
+        # takes effect on the next renewal, finished jobs are never renewed again
+        self.job_ids.discard(job_id)
+
+    async def run(self) -> None:
+        timeout_count = 0
+        while True:
+            if self.job_ids:
+                try:
+                    if self.batched:
+                        await self.stub.UpdateHealth(pb.UpdateHealthRequest(ids=sorted(self.job_ids)), timeout=self.interval)
+                    else:
+                        await asyncio.gather(*(self.stub.UpdateHealth(pb.UpdateHealthRequest(id=job_id), timeout=self.interval) for job_id in sorted(self.job_ids)))
+                    timeout_count = 0
+                except grpc.RpcError:
+                    timeout_count += 1
+                    logging.error("health check timed out. [%s/5]", timeout_count)
+                    if timeout_count == 5:
+                        logging.fatal("failed to renew job leases")
+                        raise Exception("failed to renew job leases")
+            await asyncio.sleep(self.interval)
+
+
 class Worker:
     def __init__(
         self,
         manager: str,
         ctx: dict = {},
         retry_after: int = 5,
+        job_delivery: str = "stream",
     ) -> None:
         self.manager = manager
         self.ctx = ctx
         self.retry_after = retry_after
+        self.job_delivery = job_delivery
         
         options = [
             ('grpc.keepalive_time_ms', 10_000),
             ('grpc.keepalive_timeout_ms', 1_000)  
         ]
-        self.channel = grpc.insecure_channel(manager, options=options)
+        # job polling goes through the asyncio channel so rpcs never block in-flight LLM requests
+        self.channel = grpc.aio.insecure_channel(manager, options=options)
         self.stub = pb_grpc.JobManagerStub(self.channel)
 
+    async def close(self) -> None:
+        await self.channel.close()
+
     async def run_pool(
         self,
         worker_func: Callable[[dict, pb.GetJobResponse, Metadata, bool], Awaitable[dict | None]],
         pool_count: int,
+        prefetch_count: int = 0,
+        controller: ConcurrencyController | None = None,
     ):
-        workers = []
+        await self.get_metadata()
+
+        # jobs are leased ahead of the pool so the next one is already local when a worker frees up,
+        # a slot is held from the moment a job is leased until it is finished
+        self.jobs = asyncio.Queue()
+        self.slots = Slots(pool_count + prefetch_count)
+        self.prefetch_count = prefetch_count
+        self.supports_get_jobs = True
+
+        # the number of jobs running at once can be changed by the controller up to its max
+        self.active = Slots(pool_count)
+        self.running = 0
+        max_count = max(pool_count, controller.max_limit) if controller else pool_count
+
+        # one heartbeat renews every leased job, queued or running
+        self.heartbeat = Heartbeat(self.stub, self.health_timeout / 4, self.batched_health)
+        self.heartbeat.start()
+
+        # jobs are either pushed by the manager as credits allow or polled for
+        receive_jobs = self.subscribe_jobs if self.job_delivery == "stream" else self.lease_jobs
+        tasks = [asyncio.create_task(receive_jobs(max_count, max_count + prefetch_count))]
+        for _ in range(max_count):
+            tasks.append(asyncio.create_task(self.run(worker_func)))
+        controller_task = asyncio.create_task(controller.run(self)) if controller else None
+        pool = asyncio.gather(*tasks)
+        try:
+            # a heartbeat that gives up fails the pool, the manager hands its jobs to other workers
+            await asyncio.wait([pool, self.heartbeat.task], return_when=asyncio.FIRST_COMPLETED)
+            if self.heartbeat.task.done():
+                self.heartbeat.task.result()
+            await pool
+        finally:
+            for task in tasks:
+                task.cancel()
+            if controller_task:
+                controller_task.cancel()
+            self.heartbeat.stop()
+            await asyncio.gather(pool, return_exceptions=True)
+
+    @property
+    def limit(self) -> int:
+        return self.active.limit
+
+    @property
+    def busy(self) -> int:
+        return self.running
+
+    @property
+    def backlog(self) -> int:
+        return self.jobs.qsize()
+
+    def resize(self, pool_count: int):
+        self.active.resize(pool_count)
+        self.slots.resize(pool_count + self.prefetch_count)
+
+    async def claim_slots(self, max_jobs: int) -> int:
+        # wait for one free slot, then claim every other slot that is free right now
+        await self.slots.acquire()
+        claimed = 1
+        while claimed < max_jobs and not self.slots.locked():
+            await self.slots.acquire()
+            claimed += 1
+        return claimed
+
+    def stop_workers(self, pool_count: int):
         for _ in range(pool_count):
-            workers.append(asyncio.create_task(self.run(worker_func)))
-        await asyncio.gather(*workers)
+            self.jobs.put_nowait(None)
 
-    async def run(self, worker_func: Callable[[dict, pb.GetJobResponse, Metadata, bool], Awaitable[dict | None]]):
-        await self.get_metadata()
+    async def subscribe_jobs(self, pool_count: int, max_jobs: int):
+        timeout_count = 0
+        while timeout_count < 5:
+            call = self.stub.SubscribeJobs()
+            self.stream_credits = 0
+            grant_task = asyncio.create_task(self.grant_credits(call, max_jobs))
+            try:
+                job_data = await call.read()
+                while job_data is not grpc.aio.EOF:
+                    timeout_count = 0
+                    self.stream_credits -= 1
+                    self.heartbeat.add(job_data.id)
+                    self.jobs.put_nowait(job_data)
+                    job_data = await call.read()
+            except grpc.RpcError as e:
+                if e.code() == grpc.StatusCode.UNIMPLEMENTED:
+                    logging.warning("Job manager does not support SubscribeJobs, falling back to polling.")
+                    break
+            finally:
+                # credits the manager did not use are handed back as free slots
+                grant_task.cancel()
+                await asyncio.gather(grant_task, return_exceptions=True)
+                call.cancel()
+                for _ in range(self.stream_credits):
+                    self.slots.release()
+
+            timeout_count += 1
+            logging.error(
+                "Job stream failed. Reconnecting in %s seconds... [%s/5]",
+                self.retry_after,
+                timeout_count,
+            )
+            await asyncio.sleep(self.retry_after)
+        else:
+            # stop the pool once the manager can no longer be reached
+            self.stop_workers(pool_count)
+            return
+
+        await self.lease_jobs(pool_count, max_jobs)
 
+    async def grant_credits(self, call: grpc.aio.StreamStreamCall, max_jobs: int):
+        # every credit sent to the manager holds a slot until a job arrives for it
+        while True:
+            claimed = await self.claim_slots(max_jobs)
+            self.stream_credits += claimed
+            await call.write(pb.SubscribeJobsRequest(credits=claimed))
+
+    async def lease_jobs(self, pool_count: int, max_jobs: int):
         timeout_count = 0
         while timeout_count < 5:
-            start_time = time.time()
-            # request job from manager
+            claimed = await self.claim_slots(max_jobs)
+
+            # request jobs from manager
             try:
-                response = self.stub.GetJob(pb.GetJobRequest())
+                jobs = await self.request_jobs(claimed)
                 timeout_count = 0
             except grpc.RpcError:
+                jobs = []
                 timeout_count += 1
                 logging.error(
                     "Job request failed. Retrying in %s seconds... [%s/5]",
                     self.retry_after,
                     timeout_count,
                 )
-                await asyncio.sleep(self.retry_after)
-                continue
 
-            job_data = response
-            if job_data.type == pb.JobType.wait:
+            for job_data in jobs:
+                self.heartbeat.add(job_data.id)
+                self.jobs.put_nowait(job_data)
+            for _ in range(claimed - len(jobs)):
+                self.slots.release()
+
+            if not jobs:
                 await asyncio.sleep(self.retry_after)
-                continue
 
-            # start sending health checks to manager
-            stop_event = {"stop": False}
-            health_task = threading.Thread(
-                target=self.health_update,
-                args=(job_data.id, stop_event),
-            )
-            health_task.start()
+        # stop the pool once the manager can no longer be reached
+        self.stop_workers(pool_count)
 
-            def stop():
-                stop_event["stop"] = True
+    async def request_jobs(self, max_jobs: int) -> list[pb.GetJobResponse]:
+        if self.supports_get_jobs:
+            try:
+                response = await self.stub.GetJobs(pb.GetJobsRequest(max_jobs=max_jobs))
+                return [job_data for job_data in response.jobs if job_data.type != pb.JobType.wait]
+            except grpc.RpcError as e:
+                if e.code() != grpc.StatusCode.UNIMPLEMENTED:
+                    raise
+                logging.warning("Job manager does not support GetJobs, falling back to GetJob.")
+                self.supports_get_jobs = False
+
+        response = await self.stub.GetJob(pb.GetJobRequest())
+        if response.type == pb.JobType.wait:
+            return []
+        return [response]
+
+    def finish_lease(self, job_id: int):
+        self.heartbeat.remove(job_id)
+        self.slots.release()
+        self.active.release()
+        self.running -= 1
+
+    async def run(self, worker_func: Callable[[dict, pb.GetJobResponse, Metadata, bool], Awaitable[dict | None]]):
+        while True:
+            await self.active.acquire()
+            job_data = await self.jobs.get()
+            if job_data is None:
+                self.active.release()
+                break
+            self.running += 1
+            current_job.set(job_data.id)
+            start_time = time.time()
 
-            # start worker function and stop health task once it is done
+            # start worker function and release the lease once it is done
             # need_return = job_data.type == job_manager_pb2.JobType.on_demand TODO: implement
             need_return = False
-            with deferred(stop):
+            with deferred(lambda: self.finish_lease(job_data.id)):
                 logging.info("Starting job id %s", job_data.id)
                 try:
                     result = await worker_func(self.ctx, job_data, self.metadata, need_return)
@@ -113,7 +349,7 @@ class Worker:
                     # )
                     pass
                 else:
-                    self.stub.FinishJob(
+                    await self.stub.FinishJob(
                         pb.FinishJobRequest(
                             id=job_data.id,
                         )
@@ -134,8 +370,11 @@ class Worker:
         retries = 0
         while retries < 5:
             try:
-                response = self.stub.GetMetadata(pb.GetMetadataRequest())
+                response = await self.stub.GetMetadata(pb.GetMetadataRequest())
                 self.health_timeout = response.health_timeout
+                self.batched_health = response.batched_health
+                if not self.batched_health:
+                    logging.info("manager does not renew leases in batches, sending one health update per job")
                 self.metadata = Metadata(run_id=response.run_id, pipeline_id=response.pipeline_id)
                 return
             except grpc.RpcError:
@@ -149,24 +388,6 @@ class Worker:
         logging.fatal("failed to retrieve run metadata")
         raise Exception("failed to retrieve run metadata")
 
-    def health_update(self, job_id: int, stop_event: dict):
-        timeout_count = 0
-        while not stop_event["stop"]:
-            try:
-                self.stub.UpdateHealth(
-                    pb.UpdateHealthRequest(
-                        id=job_id,
-                    )
-                )
-                timeout_count = 0
-            except grpc.RpcError:
-                timeout_count += 1
-                logging.error("health check timed out. [%s/5]", timeout_count)
-                if timeout_count == 5:
-                    return
-
-            time.sleep(self.health_timeout / 4)
-
 
 async def main():
     logging.basicConfig(level=logging.INFO)
@@ -182,6 +403,7 @@ async def main():
 
     worker = Worker(os.getenv("MANAGER_HOST"))
     await worker.run_pool(worker_func, 1)
+    await worker.close()
 
 
 if __name__ == "__main__":